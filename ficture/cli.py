@@ -1,31 +1,33 @@
 import sys, logging, importlib
 
-def main():
+# MAYBE.. should change legacy file names to match callable module names
+module_map = {\
+    "filter_by_density": "filter_poly", \
+    # "filter_by_density_v1": "filter_density", \
+    "filter_by_boundary": "filter_boundary", \
+    "make_spatial_minibatch": "make_spatial_minibatch",\
+    "make_dge": "make_dge_univ", \
+    "fit_model": "init_model_selection", \
+    # "lda": "lda_univ", \
+    "transform": "transform_univ", \
+    "format": "format_input", \
+    "choose_color": "choose_color", \
+    "plot_base": "plot_base", \
+    "de_bulk": "de_bulk", \
+    "factor_report": "factor_report", \
+    "slda_decode": "slda_decode", \
 
-    # MAYBE.. should change legacy file names to match callable module names
-    module_map = {\
-        "filter_by_density": "filter_poly", \
-        # "filter_by_density_v1": "filter_density", \
-        "filter_by_boundary": "filter_boundary", \
-        "make_spatial_minibatch": "make_spatial_minibatch",\
-        "make_dge": "make_dge_univ", \
-        "fit_model": "init_model_selection", \
-        # "lda": "lda_univ", \
-        "transform": "transform_univ", \
-        "choose_color": "choose_color", \
-        "plot_base": "plot_base", \
-        "de_bulk": "de_bulk", \
-        "factor_report": "factor_report", \
-        "slda_decode": "slda_decode", \
+    "plot_base": "plot_base", \
+    "plot_hexagon": "plot_hexagon", \
+    "plot_pixel_multi": "plot_pixel_multi", \
+    "plot_pixel_full": "plot_pixel_full", \
+    "plot_pixel_single": "plot_pixel_single", \
+    "plot_pyramid": "plot_pyramid", \
+}
 
-        "plot_base": "plot_base", \
-        "plot_hexagon": "plot_hexagon", \
-        "plot_pixel_multi": "plot_pixel_multi", \
-        "plot_pixel_full": "plot_pixel_full", \
-        "plot_pixel_single": "plot_pixel_single", \
-    }
+def main():
 
-    if len(sys.argv) < 2:
+    if len(sys.argv) < 2 or sys.argv[1] in ["-h", "--help"]:
         print("Usage: ficture <command> <args>, ficture <command> -h to see arguments for each command")
         print("Available commands:\n"+"\t".join(list(module_map.keys()) ))
         return
@@ -118,6 +118,7 @@ class PixelToUnit:
                         ct.rename(columns = {'X':'x', 'Y':'y'}, inplace=True)
                     ct.index = ct.hex_id.map(bt_dict)
                     ct.sort_index(inplace=True)
+                    ct['hex_key'] = hex_key(offs_x * self.n_move + offs_y, [v[0] for v in ct.hex_id.values], [v[1] for v in ct.hex_id.values])
                     ct['hex_id'] = ct.hex_id.map(lambda x : '_'.join([str(u) for u in x]))
                     ct.hex_id = offs_iden + '_' + ct.hex_id.values
                     ct[self.region_id] = reg
@@ -185,6 +186,7 @@ class PixelToUnit:
                 ct.rename(columns = {'X':'x', 'Y':'y'}, inplace=True)
                 ct.index = ct.hex_id.map(bt_dict)
                 ct.sort_index(inplace=True)
+                ct['hex_key'] = hex_key(offs_x * self.n_move + offs_y, [v[0] for v in ct.hex_id.values], [v[1] for v in ct.hex_id.values])
                 ct['hex_id'] = ct.hex_id.map(lambda x : '_'.join([str(u) for u in x]))
                 ct.hex_id = offs_iden + '_' + ct.hex_id.values
                 self.brc = pd.concat([self.brc, ct])
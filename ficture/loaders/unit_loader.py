@@ -6,6 +6,20 @@ from scipy.sparse import coo_array
 
 from ficture.models.lda_minibatch import PairedMinibatch
 
+def _count_units(unit, last_unit):
+    """Number of new units in a chunk grouped by unit, last_unit is the last unit seen before"""
+    if len(unit) == 0:
+        return 0
+    n = 1 + np.count_nonzero(unit[1:] != unit[:-1])
+    return n - 1 if unit[0] == last_unit else n
+
+def _split_last_unit(df):
+    """Split a dataframe grouped by unit into (complete units, the last unit)"""
+    unit = df.unit.values
+    st = np.where(unit != unit[-1])[0]
+    st = 0 if len(st) == 0 else st[-1] + 1
+    return df.iloc[:st], df.iloc[st:]
+
 class UnitLoaderAugmented:
 
     def __init__(self, reader, ft_dict, key, bkey, batch_id_prefix=0, min_ct_per_unit=1, unit_attr=['x','y']) -> None:
@@ -22,26 +36,33 @@ class UnitLoaderAugmented:
         self.unit_attr = list(unit_attr)
         self.M = max(self.ft_dict.values()) + 1
         self.batch_id_list = set()
+        self.buffer = []
+        self.n_unit = 0
+        self.last_unit = None
 
     def update_batch(self, bsize):
-        n_unit = 0
-        if len(self.df) > 0:
-            n_unit = len(self.df.unit.unique())
         if not self.file_is_open:
             return 0
-        while n_unit <= bsize:
+        while self.n_unit <= bsize:
             try:
                 chunk = next(self.reader)
             except StopIteration:
                 self.file_is_open = False
                 break
-            self.df = pd.concat([self.df, chunk])
-            n_unit = len(self.df.unit.unique())
+            if len(chunk) == 0:
+                continue
+            unit = chunk.unit.values
+            self.n_unit += _count_units(unit, self.last_unit)
+            self.last_unit = unit[-1]
+            self.buffer.append(chunk)
+        if len(self.buffer) == 0:
+            return 0
+        self.df = pd.concat(self.buffer)
         left = pd.DataFrame()
         if self.file_is_open:
-            last_indx = self.df.unit.iloc[-1]
-            left = self.df[self.df.unit == last_indx]
-            self.df = self.df[self.df.unit != last_indx]
+            self.df, left = _split_last_unit(self.df)
+        self.buffer = [left] if len(left) > 0 else []
+        self.n_unit = len(self.buffer)
         self.brc = self.df[['unit']+self.unit_attr].drop_duplicates(subset=['unit'])
         self.brc = self.brc.merge(right = self.df.groupby(by='unit').agg({self.key:sum, self.bkey:sum}).reset_index(), on = 'unit', how = 'inner' )
         self.brc = self.brc[self.brc[self.key] >= self.min_ct_per_unit]
@@ -62,7 +83,6 @@ class UnitLoaderAugmented:
                              self.df.gene.map(self.ft_dict).values) ), \
                             shape=(N, self.M)).tocsr(),
             buffer_weight = buffer_weight)
-        self.df = copy.copy(left)
         return self.batch.n
 
 
@@ -88,6 +108,9 @@ class UnitLoader:
         self.skip_epoch = set(skip_epoch)
         self.train_key = key if train_key is None else train_key
         self.test_mtx = None
+        self.buffer = []
+        self.n_unit = 0
+        self.last_unit = None
 
     def _make_matrix(self):
         self.brc = self.df[['unit']+self.unit_attr].drop_duplicates(subset=['unit'])
@@ -116,12 +139,9 @@ class UnitLoader:
         return N
 
     def update_batch(self, bsize):
-        n_unit = 0
-        if len(self.df) > 0:
-            n_unit = len(self.df.unit.unique())
         if len(self.batch_id_list) > self.epoch or not self.file_is_open:
             return 0
-        while n_unit <= bsize:
+        while self.n_unit <= bsize:
             try:
                 chunk = next(self.reader)
             except StopIteration:
@@ -136,16 +156,19 @@ class UnitLoader:
                 continue
             if self.debug:
                 print(f"Read {chunk.shape[0]} lines from file")
-            self.df = pd.concat([self.df, chunk])
-            n_unit = len(self.df.unit.unique())
+            unit = chunk.unit.values
+            self.n_unit += _count_units(unit, self.last_unit)
+            self.last_unit = unit[-1]
+            self.buffer.append(chunk)
+        if len(self.buffer) == 0:
+            return 0
+        self.df = pd.concat(self.buffer)
         left = pd.DataFrame()
         if self.file_is_open:
-            last_indx = self.df.unit.iloc[-1]
-            left = self.df[self.df.unit == last_indx]
-            self.df = self.df[self.df.unit != last_indx]
-        N = self._make_matrix()
-        self.df = copy.copy(left)
-        return N
+            self.df, left = _split_last_unit(self.df)
+        self.buffer = [left] if len(left) > 0 else []
+        self.n_unit = len(self.buffer)
+        return self._make_matrix()
 
 
     def read_one_epoch(self):
@@ -155,7 +178,8 @@ class UnitLoader:
             print(f"UnitLoader::read_one_epoch Will read the whole file")
         left = pd.DataFrame()
         local_epoch_list = []
-        if len(self.df > 0) and self.prefix > 0:
+        self.df = pd.concat(self.buffer) if len(self.buffer) > 0 else pd.DataFrame()
+        if len(self.df) > 0 and self.prefix > 0:
             local_epoch_list = list(np.unique([x[:self.prefix] for x in self.df.unit.unique()]) )
         while len(local_epoch_list) < 2:
             try:
@@ -177,5 +201,8 @@ class UnitLoader:
             if self.debug:
                 print(f"Read {chunk.shape[0]} lines from file")
         N = self._make_matrix()
-        self.df = copy.copy(left)
+        self.buffer = [left] if len(left) > 0 else []
+        self.n_unit = _count_units(left.unit.values, None) if len(left) > 0 else 0
+        if len(left) > 0:
+            self.last_unit = left.unit.values[-1]
         return N
@@ -0,0 +1,313 @@
+### Binary, epoch partitioned store of (randomized) hexagons
+### Each epoch is a CSR shard (indptr, indices, one data array per count column)
+### plus per unit arrays (unit id and attributes, kept as the original strings), all memory mapped when read
+import sys, os, gzip, json, logging
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+def _shard_file(store, epoch_id, name, suffix = "bin"):
+    return os.path.join(store, f"{epoch_id}.{name}.{suffix}")
+
+def _source(input, unit_key, gene_key, count_cols, unit_attr, epoch_id_length):
+    """What a store is built from, to tell if it is outdated"""
+    return {"input": os.path.abspath(input),
+            "size": os.path.getsize(input),
+            "mtime": os.path.getmtime(input),
+            "unit_key": unit_key,
+            "gene_key": gene_key,
+            "count_cols": list(count_cols),
+            "unit_attr": list(unit_attr),
+            "epoch_id_length": epoch_id_length}
+
+def _read_meta(store):
+    f = os.path.join(store, "meta.json")
+    if not os.path.exists(f):
+        return None
+    with open(f, 'r') as rf:
+        return json.load(rf)
+
+def is_unit_store(store, input=None, unit_key=None, gene_key=None, count_cols=[], unit_attr=[], epoch_id_length=-1):
+    '''
+    Check if store holds a unit store. If input is given, also check that
+    the store was built from the same (unchanged) input file with the same arguments
+    '''
+    meta = _read_meta(store)
+    if meta is None:
+        return False
+    if input is None:
+        return True
+    if not os.path.exists(input):
+        return False
+    return meta.get("source") == _source(input, unit_key, gene_key, count_cols, unit_attr, epoch_id_length)
+
+def _clear_store(store):
+    """Remove the meta data and the shards of an existing store"""
+    meta = _read_meta(store)
+    if meta is None:
+        return
+    os.remove(os.path.join(store, "meta.json"))
+    for e in meta["epoch"]:
+        for x in ["indptr", "indices"] + meta["count_cols"]:
+            if os.path.exists(_shard_file(store, e, x)):
+                os.remove(_shard_file(store, e, x))
+        for x in ["unit"] + meta["unit_attr"]:
+            if os.path.exists(_shard_file(store, e, x, "npy")):
+                os.remove(_shard_file(store, e, x, "npy"))
+
+class _ShardWriter:
+
+    def __init__(self, store, epoch_id, count_cols, unit_attr) -> None:
+        self.store = store
+        self.epoch_id = epoch_id
+        self.count_cols = count_cols
+        self.unit_attr = unit_attr
+        self.handle = {x : open(_shard_file(store, epoch_id, x), 'wb') for x in ["indptr", "indices"] + count_cols}
+        self.handle["indptr"].write(np.zeros(1, dtype=np.int64).tobytes())
+        self.unit = []
+        self.attr = {x : [] for x in unit_attr}
+        self.n_unit = 0
+        self.nnz = 0
+
+    def add(self, unit, indptr, indices, data, attr):
+        '''
+        unit: array of unit ids, indptr: boundaries of the units in indices/data (local, starting with 0)
+        '''
+        self.handle["indptr"].write((indptr[1:] + self.nnz).astype(np.int64).tobytes())
+        self.handle["indices"].write(indices.astype(np.int32).tobytes())
+        for x in self.count_cols:
+            self.handle[x].write(data[x].astype(np.int32).tobytes())
+        for x in self.unit_attr:
+            self.attr[x].append(attr[x])
+        self.unit.append(unit)
+        self.n_unit += len(unit)
+        self.nnz += indptr[-1]
+
+    def close(self):
+        for v in self.handle.values():
+            v.close()
+        unit = np.concatenate(self.unit) if len(self.unit) > 0 else np.array([], dtype=str)
+        np.save(_shard_file(self.store, self.epoch_id, "unit", "npy"), unit.astype(bytes))
+        for x, v in self.attr.items():
+            v = np.concatenate(v) if len(v) > 0 else np.array([], dtype=str)
+            np.save(_shard_file(self.store, self.epoch_id, x, "npy"), v.astype(str).astype(bytes))
+        return self.n_unit, int(self.nnz)
+
+class _StoreWriter:
+
+    def __init__(self, store, unit_key, gene_key, count_cols, unit_attr, epoch_id_length) -> None:
+        self.store = store
+        self.unit_key = unit_key
+        self.gene_key = gene_key
+        self.count_cols = count_cols
+        self.unit_attr = unit_attr
+        self.epoch_id_length = epoch_id_length
+        self.ft_dict = {}
+        self.epoch_list = []
+        self.shard_size = {}
+        self.writer = None
+
+    def add(self, df):
+        """Add complete units, df is grouped by unit"""
+        unit = df[self.unit_key].values
+        for x in pd.unique(df[self.gene_key].values):
+            if x not in self.ft_dict:
+                self.ft_dict[x] = len(self.ft_dict)
+        indices = df[self.gene_key].map(self.ft_dict).values
+        st = np.concatenate([[0], np.where(unit[1:] != unit[:-1])[0] + 1])
+        bound = np.append(st, len(unit))
+        if self.epoch_id_length > 0:
+            lab = pd.Series(unit[st]).str[:self.epoch_id_length].values
+        else:
+            lab = np.full(len(st), "0", dtype=object)
+        # Epochs are contiguous in the input, split the units by epoch
+        cut = np.concatenate([[0], np.where(lab[1:] != lab[:-1])[0] + 1, [len(st)]])
+        for i in range(len(cut) - 1):
+            e = lab[cut[i]]
+            if self.writer is None or self.writer.epoch_id != e:
+                self._close_shard()
+                if e in self.shard_size:
+                    sys.exit(f"ERROR: epoch {e} is not contiguous in the input, input should be sorted by {self.unit_key}")
+                self.epoch_list.append(e)
+                self.writer = _ShardWriter(self.store, e, self.count_cols, self.unit_attr)
+            u0, u1 = cut[i], cut[i+1]
+            r0, r1 = bound[u0], bound[u1]
+            self.writer.add(unit[st[u0:u1]], bound[u0:u1+1] - r0, indices[r0:r1], \
+                            {x:df[x].values[r0:r1] for x in self.count_cols}, \
+                            {x:df[x].values[st[u0:u1]] for x in self.unit_attr})
+
+    def _close_shard(self):
+        if self.writer is not None:
+            self.shard_size[self.writer.epoch_id] = self.writer.close()
+            self.writer = None
+
+    def close(self, source):
+        self._close_shard()
+        meta = {"source": source,
+                "feature": list(self.ft_dict.keys()),
+                "count_cols": self.count_cols,
+                "unit_attr": self.unit_attr,
+                "epoch": self.epoch_list,
+                "n_unit": {k:v[0] for k,v in self.shard_size.items()},
+                "nnz": {k:v[1] for k,v in self.shard_size.items()} }
+        with open(os.path.join(self.store, "meta.json"), 'w') as wf:
+            json.dump(meta, wf)
+        return meta
+
+def build_unit_store(input, store, unit_key, gene_key, count_cols, unit_attr=[], epoch_id_length=-1, chunksize=2000000):
+    '''
+    Convert a hexagon file (grouped by unit, sorted by the randomized unit id)
+    into per epoch CSR shards. Epochs are the unit id prefixes of length epoch_id_length,
+    the whole file is one epoch if epoch_id_length <= 0.
+    An existing store in the same directory is replaced
+    '''
+    if not os.path.exists(input):
+        sys.exit(f"ERROR: cannot find input file {input}")
+    source = _source(input, unit_key, gene_key, count_cols, unit_attr, epoch_id_length)
+    os.makedirs(store, exist_ok=True)
+    _clear_store(store)
+    with gzip.open(input, 'rt') as rf:
+        header = rf.readline().strip().split('\t')
+    header = [x.lower() for x in header]
+    for x in [unit_key, gene_key] + count_cols + unit_attr:
+        if x not in header:
+            sys.exit(f"ERROR: cannot find column {x} in input file")
+    adt = {unit_key:str, gene_key:str}
+    adt.update({x:int for x in count_cols})
+    adt.update({x:str for x in unit_attr})
+    reader = pd.read_csv(gzip.open(input, 'rt'), sep='\t', chunksize=chunksize, skiprows=1, names=header, usecols=list(adt.keys()), dtype=adt)
+
+    writer = _StoreWriter(store, unit_key, gene_key, count_cols, unit_attr, epoch_id_length)
+    left = None
+    for chunk in reader:
+        if left is not None:
+            chunk = pd.concat([left, chunk])
+        # Keep the last (possibly incomplete) unit for the next chunk
+        unit = chunk[unit_key].values
+        last = np.where(unit != unit[-1])[0]
+        if len(last) == 0:
+            left = chunk
+            continue
+        left = chunk.iloc[last[-1]+1:]
+        writer.add(chunk.iloc[:last[-1]+1])
+    if left is not None and len(left) > 0:
+        writer.add(left)
+    meta = writer.close(source)
+    logging.info(f"Stored {sum(meta['n_unit'].values())} units in {len(meta['epoch'])} epochs in {store}")
+    return meta
+
+class UnitStoreLoader:
+    '''
+    Read minibatches from a store made by build_unit_store,
+    same interface as UnitLoader (mtx, test_mtx, brc, batch_id_list, update_batch, read_one_epoch).
+    Minibatches have exactly bsize units (fewer at the end of an epoch), while UnitLoader
+    returns all complete units in the chunks read so far (more than bsize, depending on chunksize)
+    '''
+
+    def __init__(self, store, ft_dict, key, min_ct_per_unit=1, unit_attr=[], train_key=None, epoch = 2**15, skip_epoch=[]) -> None:
+        if not is_unit_store(store):
+            sys.exit(f"ERROR: {store} is not a unit store")
+        with open(os.path.join(store, "meta.json"), 'r') as rf:
+            self.meta = json.load(rf)
+        self.store = store
+        self.ft_dict = ft_dict
+        self.key = key
+        self.train_key = key if train_key is None else train_key
+        self.min_ct_per_unit = min_ct_per_unit
+        self.unit_attr = list(unit_attr)
+        for x in [self.key, self.train_key]:
+            if x not in self.meta["count_cols"]:
+                sys.exit(f"ERROR: column {x} is not in the unit store")
+        for x in self.unit_attr:
+            if x not in self.meta["unit_attr"]:
+                sys.exit(f"ERROR: unit attribute {x} is not in the unit store")
+        self.M = max(self.ft_dict.values()) + 1
+        # Map store feature indices to model feature indices
+        self.col_map = np.array([ft_dict.get(x, -1) for x in self.meta["feature"]], dtype=np.int64)
+        self.epoch = epoch
+        self.epoch_list = [x for x in self.meta["epoch"] if x not in set(skip_epoch)]
+        self.batch_id_list = []
+        self.file_is_open = len(self.epoch_list) > 0
+        self.mtx = None
+        self.test_mtx = None
+        self.brc = None
+        self.shard = None
+        self.shard_indx = -1
+        self.pos = 0
+
+    def _open_shard(self, i):
+        e = self.epoch_list[i]
+        n, nnz = self.meta["n_unit"][e], self.meta["nnz"][e]
+        shard = {"indptr": np.memmap(_shard_file(self.store, e, "indptr"), dtype=np.int64, mode='r', shape=(n+1,))}
+        shard["indices"] = np.memmap(_shard_file(self.store, e, "indices"), dtype=np.int32, mode='r', shape=(nnz,)) if nnz > 0 else np.zeros(0, dtype=np.int32)
+        for x in {self.key, self.train_key}:
+            shard[x] = np.memmap(_shard_file(self.store, e, x), dtype=np.int32, mode='r', shape=(nnz,)) if nnz > 0 else np.zeros(0, dtype=np.int32)
+        for x in self.unit_attr:
+            shard[x] = np.load(_shard_file(self.store, e, x, "npy"), mmap_mode='r')
+        shard["unit"] = np.load(_shard_file(self.store, e, "unit", "npy"), mmap_mode='r')
+        self.shard = shard
+        self.shard_indx = i
+        self.pos = 0
+        self.batch_id_list.append(e)
+
+    def _next_shard(self):
+        if self.shard_indx + 1 >= len(self.epoch_list):
+            self.file_is_open = False
+            return False
+        self._open_shard(self.shard_indx + 1)
+        return True
+
+    def _make_matrix(self, st, ed):
+        indptr = np.asarray(self.shard["indptr"][st:ed+1])
+        indices = self.col_map[np.asarray(self.shard["indices"][indptr[0]:indptr[-1]])]
+        row = np.repeat(np.arange(ed - st), np.diff(indptr))
+        kept = indices >= 0
+        row = row[kept]
+        indices = indices[kept]
+        data = {x:np.asarray(self.shard[x][indptr[0]:indptr[-1]])[kept] for x in {self.key, self.train_key}}
+        ct = {x:np.bincount(row, weights=v, minlength=ed-st) for x,v in data.items()}
+        unit_kept = ct[self.key] >= self.min_ct_per_unit
+        new_row = np.cumsum(unit_kept) - 1
+        N = unit_kept.sum()
+        entry_kept = unit_kept[row]
+        row = new_row[row[entry_kept]]
+        indices = indices[entry_kept]
+        new_indptr = np.concatenate([[0], np.cumsum(np.bincount(row, minlength=N))])
+        self.mtx = csr_matrix((data[self.train_key][entry_kept], indices, new_indptr), shape=(N, self.M))
+        brc = {"unit": self.shard["unit"][st:ed][unit_kept].astype(str)}
+        for x in self.unit_attr:
+            brc[x] = np.asarray(self.shard[x][st:ed])[unit_kept].astype(str)
+        brc[self.train_key] = ct[self.train_key][unit_kept].astype(int)
+        if self.key != self.train_key:
+            brc[self.key] = ct[self.key][unit_kept].astype(int)
+            self.test_mtx = csr_matrix(( (data[self.key] - data[self.train_key])[entry_kept], indices, new_indptr), shape=(N, self.M))
+            self.test_mtx.eliminate_zeros()
+        self.brc = pd.DataFrame(brc)
+        return N
+
+    def update_batch(self, bsize):
+        '''
+        Read the next bsize units, a batch does not span two epochs.
+        Unlike UnitLoader the batch size does not depend on how the input is chunked
+        '''
+        while self.file_is_open:
+            if len(self.batch_id_list) > self.epoch:
+                return 0
+            if self.shard is None or self.pos >= len(self.shard["unit"]):
+                if not self._next_shard():
+                    return 0
+                continue
+            st = self.pos
+            self.pos = min(st + bsize, len(self.shard["unit"]))
+            N = self._make_matrix(st, self.pos)
+            if N > 0:
+                return N
+        return 0
+
+    def read_one_epoch(self):
+        if self.shard is None or self.pos >= len(self.shard["unit"]):
+            if not self._next_shard():
+                return 0
+        st = self.pos
+        self.pos = len(self.shard["unit"])
+        return self._make_matrix(st, self.pos)
@@ -1,14 +1,10 @@
 import sys, os, copy, gc, re, gzip, pickle, argparse, logging, warnings
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-
-import sklearn.neighbors
 from scipy.sparse import coo_array
 from datetime import datetime
 
 from ficture.utils.utilt import plot_colortable
-from ficture.utils.mds_color_circle import assign_color_mds_circle
 
 def choose_color(_args):
 
@@ -26,6 +22,10 @@ def choose_color(_args):
         parser.print_help()
         return
 
+    import matplotlib.pyplot as plt
+    import sklearn.neighbors
+    from ficture.utils.mds_color_circle import assign_color_mds_circle
+
     ## obtain seed if not provided
     seed = args.seed
     if seed <= 0:
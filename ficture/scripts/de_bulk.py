@@ -3,9 +3,7 @@
 import sys, io, os, gzip, copy, re, time, argparse
 import numpy as np
 import pandas as pd
-import scipy.stats
 from scipy.sparse import *
-from joblib.parallel import Parallel, delayed
 
 from ficture.utils import utilt
 
@@ -20,7 +18,7 @@ def de_bulk(_args):
     parser.add_argument('--max_pval_output', default=1e-3, type=float, help='')
     parser.add_argument('--min_fold_output', default=1.5, type=float, help='')
     parser.add_argument('--min_output_per_factor', default=10, type=int, help='Even when there are no significant DE genes, output top genes for each factor')
-    parser.add_argument('--thread', default=1, type=int, help='')
+    parser.add_argument('--thread', default=1, type=int, help='Deprecated and ignored, all tests are computed in one vectorized pass')
     parser.add_argument('--use_input_header', action = 'store_true', help='')
     args = parser.parse_args(_args)
 
@@ -66,53 +64,7 @@ def de_bulk(_args):
 
     print(f"Testing {M} genes over {K} factors")
 
-    def chisq(k,info,total_k,total_umi):
-        res = []
-        if total_k <= 0:
-            return res
-        for name, v in info.iterrows():
-            if v[k] <= 0:
-                continue
-            tab=np.zeros((2,2))
-            tab[0,0]=v[str(k)]
-            tab[0,1]=v["gene_tot"]-tab[0,0]
-            tab[1,0]=total_k-tab[0,0]
-            tab[1,1]=total_umi-total_k-v["gene_tot"]+tab[0,0]
-            fd=tab[0,0]/total_k/tab[0,1]*(total_umi-total_k)
-            if fd < 1:
-                continue
-            tab = np.around(tab, 0).astype(int) + 1
-            chi2, p, dof, ex = scipy.stats.chi2_contingency(tab, correction=False)
-            res.append([name,k,chi2,p,fd,v["gene_tot"]])
-        return res
-
-    res = []
-    if args.thread > 1:
-        for k, kname in enumerate(header):
-            idx_slices = [idx for idx in utilt.gen_even_slices(M, args.thread)]
-            with Parallel(n_jobs=args.thread, verbose=0) as parallel:
-                result = parallel(delayed(chisq)(kname, \
-                            info.iloc[idx, :].loc[:, [kname, 'gene_tot']],\
-                            total_k[k], total_umi) for idx in idx_slices)
-            res += [item for sublist in result for item in sublist]
-    else:
-        for name, v in info.iterrows():
-            for k, kname in enumerate(header):
-                if total_k[k] <= 0 or v[str(k)] <= 0:
-                    continue
-                tab=np.zeros((2,2))
-                tab[0,0]=v[kname]
-                tab[0,1]=v["gene_tot"]-tab[0,0]
-                tab[1,0]=total_k[k]-tab[0,0]
-                tab[1,1]=total_umi-total_k[k]-v["gene_tot"]+tab[0,0]
-                fd=tab[0,0]/total_k[k]/tab[0,1]*(total_umi-total_k[k])
-                if fd < 1:
-                    continue
-                tab = np.around(tab, 0).astype(int) + 1
-                chi2, p, dof, ex = scipy.stats.chi2_contingency(tab, correction=False)
-                res.append([name,kname,chi2,p,fd,v["gene_tot"]])
-
-    chidf=pd.DataFrame(res,columns=['gene','factor','Chi2','pval','FoldChange','gene_total'])
+    chidf = utilt.chisq_table(info, header, total_k, total_umi)
     chidf["Rank"] = chidf.groupby(by = "factor")["Chi2"].rank(ascending=False)
     chidf = chidf.loc[((chidf.pval<pcut)&(chidf.FoldChange>fcut)) | (chidf.Rank < args.min_output_per_factor), :]
     chidf.sort_values(by=['factor','Chi2'],ascending=[True,False],inplace=True)
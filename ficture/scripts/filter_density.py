@@ -4,7 +4,8 @@ import pandas as pd
 import sklearn.neighbors
 import sklearn.mixture
 
-from ficture.utils.filter_fn import filter_by_density_mixture
+from ficture.utils.hexagon_fn import pixel_to_hex
+from ficture.utils.filter_fn import filter_by_density_mixture, fit_log_density_mixture, HistGaussianMixture, AnchorLatticeIndex
 
 def filter_by_density_v1(_args):
 
@@ -26,12 +27,15 @@ def filter_by_density_v1(_args):
     parser.add_argument('--hard_threshold', type=float, default=-1, help='If provided, filter by hard threshold (number of molecules per squared um)')
     parser.add_argument('--radius', type=float, default=7, help='')
     parser.add_argument('--hex_n_move', type=int, default=6, help='')
+    parser.add_argument('--hist_mixture', action='store_true', help='Fit the mixture model on a histogram of log densities accumulated over the whole input in one pass, instead of refitting for each window and offset')
+    parser.add_argument('--refit_per_window', action='store_true', help='With --hist_mixture, still fit a (histogram based) model for each window and offset')
 
     parser.add_argument('--xmin', type=float, default=-1, help='In um')
     parser.add_argument('--xmax', type=float, default=np.inf, help='In um')
     parser.add_argument('--ymin', type=float, default=-1, help='In um')
     parser.add_argument('--ymax', type=float, default=np.inf, help='In um')
 
+    parser.add_argument('--lattice_index', action='store_true', help='Filter molecules by lookups into the lattice of anchor points (rounded to --precision_um) instead of a BallTree')
     parser.add_argument('--redo_filter', action='store_true')
     parser.add_argument('--anchor_only', action='store_true')
     parser.add_argument('--debug', action='store_true')
@@ -78,6 +82,28 @@ def filter_by_density_v1(_args):
         pt = pd.read_csv(args.ref_pt, sep='\t')
         logging.info(f"Read existing anchor points")
     else:
+        model = None
+        if args.hist_mixture and not args.refit_per_window and args.hard_threshold <= 0:
+            # Collect hexagon densities (one offset) over the whole input, fit the model once
+            cnt = []
+            for chunk in pd.read_csv(gzip.open(args.input, 'rb'),\
+                sep='\t', usecols=["Y","X","gene",key], chunksize=chunk_size):
+                if len(gene_kept) != 0:
+                    chunk = chunk.loc[chunk.gene.isin(gene_kept)]
+                x = chunk.X.values * mu_scale
+                y = chunk.Y.values * mu_scale
+                indx = (x >= args.xmin) & (x <= args.xmax) & (y >= args.ymin) & (y <= args.ymax)
+                if indx.sum() == 0:
+                    continue
+                sub = pd.DataFrame({key:chunk[key].values[indx]})
+                sub["hex_x"], sub["hex_y"] = pixel_to_hex(np.column_stack([x[indx], y[indx]]), radius)
+                cnt.append(sub.groupby(by = ['hex_x','hex_y']).agg({key:"sum"}).reset_index())
+            cnt = pd.concat(cnt).groupby(by = ['hex_x','hex_y']).agg({key:"sum"})[key].values
+            cnt = cnt[cnt > hex_area * args.min_abs_mol_density_squm]
+            gm = HistGaussianMixture().partial_fit(np.log10(cnt))
+            model = fit_log_density_mixture(gm, hex_area, args)
+            logging.info(f"Fit density model on {len(cnt)} hexagons, dense v.s. background {model[2]:.3f} v.s. {model[3]:.3f}")
+
         pt = pd.DataFrame()
         df=pd.DataFrame()
         for chunk in pd.read_csv(gzip.open(args.input, 'rb'),\
@@ -112,7 +138,7 @@ def filter_by_density_v1(_args):
                 indx = df.win.eq(w)
                 xmin, ymin = df.loc[indx, ['X','Y']].min()
                 xmax, ymax = df.loc[indx, ['X','Y']].max()
-                sub, m0, m1 = filter_by_density_mixture(df.loc[indx, :], key, radius, n_move, args)
+                sub, m0, m1 = filter_by_density_mixture(df.loc[indx, :], key, radius, n_move, args, model)
                 pt = pd.concat([pt, sub])
                 logging.info(f"Window {str(w)} ({xmax-xmin:.1f} X {ymax-ymin:.1f} ):\t{m0:.3f} v.s. {m1:.3f}")
             df=pd.DataFrame()
@@ -133,7 +159,14 @@ def filter_by_density_v1(_args):
         sys.exit()
 
 
-    ref=sklearn.neighbors.BallTree(np.array(pt.loc[:, ['x','y']]))
+    ref = None
+    if args.lattice_index and args.precision_um > 0:
+        try:
+            ref = AnchorLatticeIndex(np.array(pt.loc[:, ['x','y']]), radius, args.precision_um)
+        except ValueError:
+            logging.warning(f"Anchor points are not on the --precision_um lattice, use BallTree instead")
+    if ref is None:
+        ref=sklearn.neighbors.BallTree(np.array(pt.loc[:, ['x','y']]))
     with gzip.open(args.input, 'rt') as rf:
         header = rf.readline()
     if args.output.endswith(".gz"):
@@ -155,10 +188,13 @@ def filter_by_density_v1(_args):
                         (y >= args.ymin) & (y <= args.ymax) ]
         if chunk.shape[0] == 0:
             continue
-        dv, iv = ref.query(X=np.array(chunk.loc[:, ["X","Y"]]) * mu_scale, \
-                        k=1, return_distance=True, sort_results=False)
-        dv = dv.squeeze()
-        chunk = chunk.loc[dv < radius, :]
+        if isinstance(ref, AnchorLatticeIndex):
+            kept = ref.query(chunk.X.values * mu_scale, chunk.Y.values * mu_scale)
+        else:
+            dv, iv = ref.query(X=np.array(chunk.loc[:, ["X","Y"]]) * mu_scale, \
+                            k=1, return_distance=True, sort_results=False)
+            kept = dv.squeeze() < radius
+        chunk = chunk.loc[kept, :]
         if chunk.shape[0] == 0:
             continue
         logging.info(f"Output {chunk.shape[0]} rows ...")
@@ -3,21 +3,115 @@ Identify high quality region
 Output two multi-polygon (geojson) and the filtered version of input file
 """
 
-import sys, os, copy, gzip, gc, argparse, warnings, logging
+import sys, io, os, copy, gzip, gc, argparse, warnings, logging
 import numpy as np
 import pandas as pd
-import sklearn.mixture
 
 import shapely
 from shapely.geometry import Polygon, MultiPolygon, Point
 from shapely.ops import unary_union
 from scipy.spatial import Delaunay
 import geojson
-import matplotlib.pyplot as plt
 
 from ficture.utils.hexagon_fn import collapse_to_hex
+from ficture.utils.filter_fn import HistGaussianMixture
+from ficture.utils.utilt import gen_text_blocks, ordered_map
+
+# Read-only parameters shared by the chunk workers, set once per process
+_worker = {}
+
+def _init_worker(param):
+    _worker.clear()
+    _worker.update(param)
+    for k in ["mpoly_lenient", "mpoly_strict"]:
+        if k in _worker:
+            shapely.prepare(_worker[k])
+
+def _collapse_block(block):
+    chunk = pd.read_csv(io.StringIO(block), sep='\t', usecols=_worker["use_header"])
+    if len(_worker["gene_kept"]) > 0:
+        chunk = chunk.loc[chunk.gene.isin(_worker["gene_kept"]), :].copy()
+    chunk.X /= _worker["mu_scale"]
+    chunk.Y /= _worker["mu_scale"]
+    gene = None
+    if len(_worker["gene_header"]) > 0:
+        gene = chunk[_worker["gene_header"]].drop_duplicates()
+    sub = collapse_to_hex(chunk, hex_width = _worker["hex_diam"], n_move = 2, key = _worker["key"], )
+    return sub, gene
+
+def _count_by_gene(gid, val, G):
+    ct = np.zeros((G, val.shape[1]))
+    for i in range(val.shape[1]):
+        ct[:, i] = np.bincount(gid, weights=val[:, i], minlength=G)
+    return ct
+
+def _filter_block(block):
+    '''
+    Return the rows inside the lenient boundary as text and
+    the per-gene counts (plus the number of rows) inside the lenient and strict boundaries
+    '''
+    chunk = pd.read_csv(io.StringIO(block), sep='\t', header=0)
+    if len(_worker["gene_kept"]) > 0:
+        chunk = chunk.loc[chunk.gene.isin(_worker["gene_kept"]), :]
+    x = chunk.X.values / _worker["mu_scale"]
+    y = chunk.Y.values / _worker["mu_scale"]
+    kept = shapely.contains_xy(_worker["mpoly_lenient"], x, y)
+    chunk = chunk.loc[kept, :]
+    G = len(_worker["gene_index"])
+    gid = _worker["gene_index"].get_indexer(pd.MultiIndex.from_frame(chunk[_worker["gene_header"]]))
+    val = np.hstack([chunk[_worker["count_header"]].values.astype(float), np.ones((chunk.shape[0], 1))])
+    ct_lenient = _count_by_gene(gid, val, G)
+    kept = shapely.contains_xy(_worker["mpoly_strict"], x[kept], y[kept])
+    ct_strict = _count_by_gene(gid[kept], val[kept, :], G)
+    return chunk.to_csv(sep='\t', index=False, header=False), chunk.shape[0], ct_lenient, ct_strict
+
+def feature_table(gene_info, ct, count_header):
+    '''
+    gene_info: dataframe of unique genes, rows correspond to rows of ct
+    ct: G x (C+1) array, per-gene counts for each of the C count columns and the number of observed rows
+    '''
+    kept = ct[:, -1] > 0
+    feature = gene_info.loc[kept, :].copy()
+    for i, x in enumerate(count_header):
+        v = ct[kept, i]
+        feature[x] = v.astype(int) if np.all(np.mod(v, 1) == 0) else v
+    return feature.sort_values(by = list(gene_info.columns))
+
+def point_to_multipoly(pts, max_edge_len, buffer = 5, poly_area_cutoff = 0):
+    '''
+    Union of Delaunay triangles with all edges shorter than max_edge_len (alpha shape),
+    built from the boundary edges (edges belonging to exactly one kept triangle)
+    and buffered once at the end
+    '''
+    tri = Delaunay(pts)
+    smpl = tri.simplices
+    crd = pts[smpl] # T x 3 x 2
+    max_edge = np.sqrt(((crd - np.roll(crd, -1, axis = 1))**2).sum(axis = 2)).max(axis = 1)
+    kept = max_edge < max_edge_len
+    if kept.sum() == 0:
+        return MultiPolygon()
+    # Undirected edges of kept triangles, packed into int64 keys
+    edge = np.vstack([smpl[kept][:, [i, (i+1) % 3]] for i in range(3)])
+    edge.sort(axis = 1)
+    n = np.int64(pts.shape[0])
+    edge_key, edge_ct = np.unique(edge[:, 0].astype(np.int64) * n + edge[:, 1], return_counts = True)
+    edge_key = edge_key[edge_ct == 1]
+    edge = np.column_stack([edge_key // n, edge_key % n])
+    # Faces enclosed by the boundary edges are either all covered or all uncovered,
+    # classify each by the triangle containing one of its interior points
+    faces = shapely.get_parts(shapely.polygonize(shapely.linestrings(pts[edge])))
+    ref = shapely.get_coordinates(shapely.point_on_surface(faces))
+    indx = tri.find_simplex(ref)
+    faces = faces[(indx >= 0) & kept[indx]]
+    mrg_poly = shapely.buffer(MultiPolygon(list(faces)), buffer)
+    if isinstance(mrg_poly, MultiPolygon) and poly_area_cutoff > 0:
+        mrg_poly = unary_union([P for P in mrg_poly.geoms if P.area > poly_area_cutoff ])
+    if isinstance(mrg_poly, Polygon):
+        mrg_poly = MultiPolygon([mrg_poly])
+    return mrg_poly
 
 def plot_boundary(mpoly, filename, bd=None):
+    import matplotlib.pyplot as plt
     if bd is None:
         bd = mpoly.bounds
     fig, ax = plt.subplots(figsize=(10, 10), dpi=600)
@@ -40,8 +134,8 @@ def filter_by_density(_args):
 
     parser.add_argument('--feature', type=str, default='', help='')
     parser.add_argument('--filter_based_on', type=str, default="Count", help='')
-    parser.add_argument('--gene_header', type = str, default = ['gene', 'gene_id'])
-    parser.add_argument('--count_header', type = str, default = ['gn', 'gt', 'spl', 'unspl', 'ambig'])
+    parser.add_argument('--gene_header', nargs='+', type = str, default = ['gene', 'gene_id'])
+    parser.add_argument('--count_header', nargs='+', type = str, default = ['gn', 'gt', 'spl', 'unspl', 'ambig'])
     parser.add_argument('--mu_scale', type=float, default=26.67, help='Coordinate to um translate')
     parser.add_argument('--max_npts_to_fit_model', type=float, default=1e6, help='')
     parser.add_argument('--min_abs_mol_density_squm_dense', type=float, default=0.1, help='Lowerbound for dense tissue region')
@@ -53,7 +147,9 @@ def filter_by_density(_args):
     parser.add_argument('--max_edge', type=float, default=-1, help='')
     parser.add_argument('--quartile', type=int, default=2, choices=[0,1,2,3], help='')
     parser.add_argument('--hard_mixture_bound', action='store_true', help='')
+    parser.add_argument('--hist_mixture', action='store_true', help='Fit the mixture model on a fine histogram of all log densities instead of (a subsample of) the individual values')
     parser.add_argument('--boundary_only', action='store_true', help='')
+    parser.add_argument('--thread', type=int, default=1, help='Number of processes to parse and filter chunks of the input')
 
     args = parser.parse_args(_args)
     if len(_args) == 0:
@@ -82,17 +178,21 @@ def filter_by_density(_args):
         feature = pd.read_csv(args.feature, sep='\t', header=0)
         gene_kept = set(feature.gene.values)
 
+    chunksize = 500000
+    gene_header = [] if args.boundary_only else args.gene_header
     use_header = ["X","Y",key]
     use_header += ['gene'] if len(gene_kept) > 0 else []
-    reader = pd.read_csv(gzip.open(args.input,'rb'), sep='\t', usecols=use_header, chunksize=500000)
-    brc = pd.DataFrame()
-    for chunk in reader:
-        chunk.X /= args.mu_scale
-        chunk.Y /= args.mu_scale
-        if len(gene_kept) > 0:
-            chunk.drop(index = chunk[~chunk.gene.isin(gene_kept)].index, inplace = True)
-        sub = collapse_to_hex(chunk, hex_width = hex_diam, n_move = 2, key = key, )
-        brc = pd.concat([brc, sub])
+    use_header += [x for x in gene_header if x not in use_header]
+    param = {"use_header":use_header, "gene_kept":gene_kept, "gene_header":gene_header,\
+             "mu_scale":args.mu_scale, "hex_diam":hex_diam, "key":key}
+    brc = []
+    gene_info = []
+    for sub, gene in ordered_map(_collapse_block, gen_text_blocks(args.input, chunksize),\
+                        thread=args.thread, initializer=_init_worker, initargs=(param,)):
+        brc.append(sub)
+        if gene is not None:
+            gene_info.append(gene)
+    brc = pd.concat(brc)
 
     ct = brc.groupby(by = ['ID']).agg({key:sum}).reset_index()
     brc = brc[["ID",'x','y']].drop_duplicates(subset='ID').merge(right = ct, on = 'ID')
@@ -105,11 +205,15 @@ def filter_by_density(_args):
     dcut_strict = args.hard_threshold * hex_area
 
     vorg = np.log10(brc[key].values)
-    v = copy.copy(vorg)
-    if len(vorg) > args.max_npts_to_fit_model:
-        v = np.random.choice(v, int(args.max_npts_to_fit_model), replace=False)
-    v = v.reshape(-1, 1)
-    gm = sklearn.mixture.GaussianMixture(n_components=2).fit(v)
+    if args.hist_mixture:
+        gm = HistGaussianMixture(n_components=2).fit(vorg)
+    else:
+        import sklearn.mixture
+        v = copy.copy(vorg)
+        if len(vorg) > args.max_npts_to_fit_model:
+            v = np.random.choice(v, int(args.max_npts_to_fit_model), replace=False)
+        v = v.reshape(-1, 1)
+        gm = sklearn.mixture.GaussianMixture(n_components=2).fit(v)
     lab_keep = np.argmax(gm.means_.squeeze())
     m0=(10**gm.means_.squeeze()[lab_keep])/hex_area
     m1=(10**gm.means_.squeeze()[1-lab_keep])/hex_area
@@ -134,21 +238,6 @@ def filter_by_density(_args):
     dcut_lenient *= hex_area
     dcut_strict *= hex_area
 
-    def point_to_multipoly(pts, max_edge_len, buffer = 5, poly_area_cutoff = 0):
-        tri = Delaunay(pts)
-        max_edge = [max([ np.sqrt(((pts[x[i], :] - pts[x[(i+2) % 3], :])**2).sum() ) for i in [0,1,2] ]) for x in tri.simplices]
-        kept_smpl_coord = []
-        for i, simplex in enumerate(tri.simplices):
-            if max_edge[i] < max_edge_len:
-                kept_smpl_coord.append( [ tuple(pts[simplex[i], :]) for i in [0,1,2]] )
-        mrg_poly = [ shapely.buffer(Polygon(x),buffer) for x in kept_smpl_coord ]
-        mrg_poly = unary_union(mrg_poly)
-        if isinstance(mrg_poly, MultiPolygon) and poly_area_cutoff > 0:
-            mrg_poly = unary_union([P for P in mrg_poly.geoms if P.area > poly_area_cutoff ])
-        if isinstance(mrg_poly, Polygon):
-            mrg_poly = MultiPolygon([mrg_poly])
-        return mrg_poly
-
     # Output lenient boundary
     kept_indx = brc.index[brc[key].gt(dcut_lenient)]
     pts = brc.loc[kept_indx, ['x', 'y']].values
@@ -180,47 +269,31 @@ def filter_by_density(_args):
     if os.path.isfile(args.output):
         warnings.warn("Output file already exists, fill be overwritten")
 
-    mrg_poly_lenient = shapely.prepared.prep(mrg_poly_lenient)
-    mrg_poly_strict = shapely.prepared.prep(mrg_poly_strict)
-    feature_lenient = pd.DataFrame()
-    feature_strict = pd.DataFrame()
-    ct = 0
-    for chunk in pd.read_csv(gzip.open(args.input, 'rb'),\
-        sep='\t', header=0, chunksize=500000):
-        if len(gene_kept) > 0:
-            chunk.drop(index = chunk[~chunk.gene.isin(gene_kept)].index, inplace = True)
-            if chunk.shape[0] == 0:
+    gene_info = pd.concat(gene_info).drop_duplicates().reset_index(drop=True)
+    G = len(gene_info)
+    param = {"gene_kept":gene_kept, "gene_header":gene_header, "count_header":args.count_header,\
+             "gene_index":pd.MultiIndex.from_frame(gene_info), "mu_scale":args.mu_scale,\
+             "mpoly_lenient":mrg_poly_lenient, "mpoly_strict":mrg_poly_strict}
+    ct_lenient = np.zeros((G, len(args.count_header) + 1))
+    ct_strict  = np.zeros((G, len(args.count_header) + 1))
+    with gzip.open(args.input, 'rt') as rf:
+        header = rf.readline()
+    wf = gzip.open(args.output, 'wt') if args.output.endswith(".gz") else open(args.output, 'w')
+    with wf:
+        _ = wf.write(header)
+        for text, n, ct_l, ct_s in ordered_map(_filter_block, gen_text_blocks(args.input, chunksize),\
+                        thread=args.thread, initializer=_init_worker, initargs=(param,)):
+            ct_lenient += ct_l
+            ct_strict  += ct_s
+            if n == 0:
                 continue
-        points = chunk.loc[:, ['X', 'Y']].values / args.mu_scale
-        kept = [mrg_poly_lenient.contains(Point(*p)) for p in points]
-        chunk = chunk.loc[kept, :]
-        if chunk.shape[0] == 0:
-            continue
-        feature_lenient = pd.concat([feature_lenient, \
-            chunk.groupby(by = args.gene_header).agg({x:sum for x in args.count_header}).reset_index()])
-        points = points[kept, :]
-
-        logging.info(f"Output {chunk.shape[0]} rows ...")
-        if ct == 0:
-            chunk.to_csv(args.output, sep='\t', index=False, header=True)
-        else:
-            chunk.to_csv(args.output, mode='a', sep='\t', index=False, header=False)
-
-        kept = [mrg_poly_strict.contains(Point(*p)) for p in points]
-        chunk = chunk.loc[kept, :]
-        if len(chunk) > 0:
-            feature_strict = pd.concat([feature_strict, \
-                chunk.groupby(by = args.gene_header).agg({x:sum for x in args.count_header}).reset_index()])
-
-        ct += 1
-
-    feature_strict = feature_strict.groupby(by = args.gene_header).agg({x:sum for x in args.count_header}).reset_index()
-    feature_lenient = feature_lenient.groupby(by = args.gene_header).agg({x:sum for x in args.count_header}).reset_index()
+            logging.info(f"Output {n} rows ...")
+            _ = wf.write(text)
 
     f = args.output_boundary + ".feature.strict.tsv.gz"
-    feature_strict.to_csv(f, sep='\t', index=False, header=True, compression='gzip')
+    feature_table(gene_info, ct_strict, args.count_header).to_csv(f, sep='\t', index=False, header=True, compression='gzip')
     f = args.output_boundary + ".feature.lenient.tsv.gz"
-    feature_lenient.to_csv(f, sep='\t', index=False, header=True, compression='gzip')
+    feature_table(gene_info, ct_lenient, args.count_header).to_csv(f, sep='\t', index=False, header=True, compression='gzip')
 
 if __name__ == "__main__":
     filter_by_density(sys.argv[1:])
@@ -0,0 +1,225 @@
+'''
+Convert transcript tables from Xenium, CosMx SMI, and Vizgen MERSCOPE
+to the sorted FICTURE input, the feature table, and the coordinate range
+Usage: ficture format {xenium,cosmx,vizgen} --input ... --output ...
+CSV files are parsed by the multithreaded pyarrow engine, the output is sorted by the
+major axis in memory bounded runs that are merged in one pass at the end
+'''
+import sys, os, shutil, tempfile, logging, argparse
+import numpy as np
+import pandas as pd
+
+def _read_batches(file, columns, block_size):
+    import pyarrow.csv, pyarrow.parquet
+    if file.endswith(".parquet"):
+        yield from pyarrow.parquet.ParquetFile(file).iter_batches(columns=columns, batch_size=block_size // 64)
+        return
+    reader = pyarrow.csv.open_csv(file,\
+        read_options=pyarrow.csv.ReadOptions(use_threads=True, block_size=block_size),\
+        convert_options=pyarrow.csv.ConvertOptions(include_columns=columns))
+    yield from reader
+
+def _xenium(batch, args):
+    import pyarrow as pa, pyarrow.compute as pc
+    kept = pc.greater(batch.column("qv"), args.min_phred_score)
+    tab = pa.table({"X":batch.column("x_location"), "Y":batch.column("y_location"),\
+                    "gene":batch.column("feature_name"), "cell_id":batch.column("cell_id"),\
+                    "overlaps_nucleus":batch.column("overlaps_nucleus")})
+    return tab.filter(kept)
+
+def _cosmx(batch, args):
+    import pyarrow as pa, pyarrow.compute as pc
+    tab = {"X":batch.column("x_global_px"), "Y":batch.column("y_global_px"), "gene":batch.column(args.gcol)}
+    tab.update({x:batch.column(x) for x in args.annotation})
+    tab = pa.table(tab)
+    if args.px_to_um != 1:
+        tab = tab.set_column(0, "X", pc.multiply(tab.column("X"), args.px_to_um))
+        tab = tab.set_column(1, "Y", pc.multiply(tab.column("Y"), args.px_to_um))
+    return tab
+
+def _vizgen(batch, args):
+    import pyarrow as pa
+    return pa.table({"X":batch.column("global_x"), "Y":batch.column("global_y"),\
+                     "gene":batch.column("gene"), "MoleculeID":batch.column(batch.schema.names[0]),\
+                     "transcript_id":batch.column("transcript_id")})
+
+VENDOR = {
+    "xenium": {"parse":_xenium, "columns":["cell_id","overlaps_nucleus","feature_name","x_location","y_location","qv"],\
+               "annotation":["cell_id","overlaps_nucleus"], "dummy_genes":"", "precision":2},
+    "cosmx":  {"parse":_cosmx, "columns":["x_global_px","y_global_px"],\
+               "annotation":[], "dummy_genes":"NegPrb", "precision":2},
+    "vizgen": {"parse":_vizgen, "columns":None,\
+               "annotation":["MoleculeID"], "dummy_genes":"", "precision":2},
+}
+
+def _write_table(writer, tab, precision):
+    import pyarrow.compute as pc
+    for i, x in enumerate(["X", "Y"]):
+        tab = tab.set_column(i, x, pc.round(tab.column(x), precision))
+    writer.write_table(tab)
+
+def _merge_runs(runs, key, writer, precision, batch_size):
+    '''
+    K-way merge of sorted runs (Arrow IPC files): in each round rows up to the smallest
+    of the largest buffered (major, minor) keys are sorted and written, exhausted buffers are refilled
+    '''
+    import pyarrow as pa, pyarrow.ipc
+    readers = [pa.ipc.open_file(f) for f in runs]
+    nxt = [0] * len(runs)
+    buf = [None] * len(runs)
+    while True:
+        for i, rd in enumerate(readers):
+            if (buf[i] is None or buf[i].num_rows == 0) and nxt[i] < rd.num_record_batches:
+                buf[i] = pa.Table.from_batches([rd.get_batch(nxt[i])])
+                nxt[i] += 1
+        live = [i for i in range(len(runs)) if buf[i] is not None and buf[i].num_rows > 0]
+        if len(live) == 0:
+            break
+        # Runs with unread batches bound how far the output can proceed
+        # Compare on the full key so rows tied on the major axis are not split across rounds
+        bound = [tuple(buf[i].column(x)[-1].as_py() for x in key) for i in live if nxt[i] < readers[i].num_record_batches]
+        cut = min(bound) if len(bound) > 0 else (np.inf, np.inf)
+        out = []
+        for i in live:
+            v = buf[i].column(key[0]).to_numpy()
+            lo, hi = np.searchsorted(v, cut[0], side='left'), np.searchsorted(v, cut[0], side='right')
+            n = lo + np.searchsorted(buf[i].column(key[1]).to_numpy()[lo:hi], cut[1], side='right')
+            out.append(buf[i].slice(0, n))
+            buf[i] = buf[i].slice(n)
+        out = pa.concat_tables(out)
+        if out.num_rows > 0:
+            out = out.take(np.lexsort([out.column(x).to_numpy() for x in key[::-1]]))
+            for b in out.to_batches(max_chunksize=batch_size):
+                _write_table(writer, pa.Table.from_batches([b]), precision)
+
+def format(_args):
+
+    parser = argparse.ArgumentParser(prog="format")
+    subparsers = parser.add_subparsers(dest="platform")
+    for name, info in VENDOR.items():
+        sub = subparsers.add_parser(name)
+        sub.add_argument('--input', type=str, required=True, help='Input transcript file (csv, csv.gz, or parquet)')
+        sub.add_argument('--output', type=str, required=True, help='Output file, sorted by --major_axis (tsv or tsv.gz)')
+        sub.add_argument('--feature', type=str, default='', help='Output gene list with total counts')
+        sub.add_argument('--coor_minmax', type=str, default='', help='Record coordinate ranges to a file, default is coordinate_minmax.tsv in the output directory')
+        sub.add_argument('--dummy_genes', type=str, default=info["dummy_genes"], help='A single name or a regex describing the names of negative control probes (case insensitive)')
+        sub.add_argument('--precision', type=int, default=info["precision"], help='Number of digits to store the transcript coordinates in micrometer')
+        sub.add_argument('--major_axis', type=str, default="Y", choices=["X", "Y"], help='Sort the output by this axis')
+        sub.add_argument('--max_rows_in_memory', type=int, default=50000000, help='Number of rows to sort in memory before writing a temporary sorted run')
+        sub.add_argument('--block_size', type=int, default=64, help='Size (MB) of each block parsed by the csv reader')
+        sub.add_argument('--tmp_dir', type=str, default='', help='Directory to store temporary sorted runs, default is the output directory')
+        if name == "xenium":
+            sub.add_argument('--min_phred_score', type=float, default=13, help='Quality score cutoff')
+        if name == "cosmx":
+            sub.add_argument('--gcol', type=str, default="target", help='The column name used as the gene/probe identifier')
+            sub.add_argument('--annotation', type=str, nargs='*', default=[], help='Additional information to carry over in the output file, such as "cell_ID", "CellComp"')
+            sub.add_argument('--px_to_um', type=float, default=1, help='Convert pixel unit as used in x_global_px to micrometer')
+    args = parser.parse_args(_args)
+    if len(_args) == 0 or args.platform is None:
+        parser.print_help()
+        return
+
+    try:
+        import pyarrow as pa, pyarrow.compute as pc, pyarrow.csv, pyarrow.ipc
+    except ImportError:
+        sys.exit("ficture format requires pyarrow")
+    logging.basicConfig(level= getattr(logging, "INFO", None))
+    if not os.path.isfile(args.input):
+        sys.exit(f"ERROR: cannot find input file \n {args.input}")
+
+    info = VENDOR[args.platform]
+    columns = info["columns"]
+    annotation = info["annotation"]
+    if args.platform == "cosmx":
+        columns = columns + [args.gcol] + args.annotation
+        annotation = args.annotation
+    oheader = ["X", "Y", "gene"] + annotation + ["Count"]
+    key = [args.major_axis, "Y" if args.major_axis == "X" else "X"]
+    outdir = os.path.dirname(os.path.abspath(args.output))
+    tmp_dir = tempfile.mkdtemp(dir = args.tmp_dir if os.path.isdir(args.tmp_dir) else outdir)
+
+    gene_dict = {}  # gene name -> index into the count array
+    gene_ct = np.zeros(0, dtype=np.int64)
+    transcript_id = {}
+    xmin, ymin, xmax, ymax = np.inf, np.inf, -np.inf, -np.inf
+    runs = []
+    buffer = []
+    nbuf = 0
+    ntot = 0
+
+    def flush(buffer):
+        tab = pa.concat_tables(buffer)
+        tab = tab.take(np.lexsort([tab.column(x).to_numpy() for x in key[::-1]]))
+        f = os.path.join(tmp_dir, f"run.{len(runs)}.arrow")
+        with pa.ipc.new_file(f, tab.schema) as wf:
+            for b in tab.to_batches(max_chunksize=1000000):
+                wf.write_batch(b)
+        runs.append(f)
+
+    for batch in _read_batches(args.input, columns, args.block_size << 20):
+        tab = info["parse"](batch, args)
+        gene = tab.column("gene").cast(pa.string())
+        if args.dummy_genes != '':
+            tab = tab.filter(pc.invert(pc.match_substring_regex(gene, args.dummy_genes, ignore_case=True)))
+            gene = tab.column("gene").cast(pa.string())
+        if tab.num_rows == 0:
+            continue
+        if args.platform == "cosmx":
+            # Collapse molecules (from different z-planes) at the same location
+            tab = pa.table({x:tab.column(x) for x in ["X","Y"] + annotation}).append_column("gene", gene)
+            tab = tab.group_by(["X","Y","gene"] + annotation, use_threads=False).aggregate([([], "count_all")])
+            tab = tab.append_column("Count", tab.column("count_all"))
+            gene = tab.column("gene")
+        else:
+            tab = tab.append_column("Count", pa.array(np.ones(tab.num_rows, dtype=np.int64)))
+        # Per gene counts through the dictionary encoding of this batch
+        denc = pc.dictionary_encode(gene).combine_chunks()
+        for g in denc.dictionary.to_pylist():
+            if g not in gene_dict:
+                gene_dict[g] = len(gene_dict)
+        gene_ct = np.pad(gene_ct, (0, len(gene_dict) - len(gene_ct)))
+        gid = np.array([gene_dict[g] for g in denc.dictionary.to_pylist()], dtype=np.int64)[denc.indices.to_numpy()]
+        gene_ct += np.bincount(gid, weights=tab.column("Count").to_numpy(), minlength=len(gene_ct)).astype(np.int64)
+        if args.platform == "vizgen":
+            for g, t in zip(denc.dictionary.to_pylist(), pc.take(tab.column("transcript_id"), pc.index_in(denc.dictionary, gene)).to_pylist()):
+                transcript_id.setdefault(g, t)
+        x = tab.column("X").to_numpy()
+        y = tab.column("Y").to_numpy()
+        xmin, xmax = min(xmin, x.min()), max(xmax, x.max())
+        ymin, ymax = min(ymin, y.min()), max(ymax, y.max())
+        tab = pa.table({x:(gene if x == "gene" else tab.column(x)) for x in oheader})
+        buffer.append(tab)
+        nbuf += tab.num_rows
+        ntot += tab.num_rows
+        if nbuf >= args.max_rows_in_memory:
+            flush(buffer)
+            logging.info(f"Read {ntot} molecules, wrote sorted run {len(runs)}")
+            buffer = []
+            nbuf = 0
+    if len(buffer) > 0:
+        flush(buffer)
+    logging.info(f"Read {ntot} molecules in {len(runs)} sorted runs")
+
+    sink = pa.CompressedOutputStream(args.output, "gzip") if args.output.endswith(".gz") else pa.OSFile(args.output, "wb")
+    wopt = pyarrow.csv.WriteOptions(include_header=False, delimiter='\t', quoting_style="none")
+    with sink:
+        _ = sink.write(('\t'.join(oheader)+'\n').encode())
+        if len(runs) > 0:
+            schema = pa.ipc.open_file(runs[0]).schema
+            with pyarrow.csv.CSVWriter(sink, schema, write_options=wopt) as writer:
+                _merge_runs(runs, key, writer, args.precision, 1000000)
+    shutil.rmtree(tmp_dir)
+    logging.info(f"Finished writing {args.output}")
+
+    if os.path.exists(os.path.dirname(os.path.abspath(args.feature))) and args.feature != '':
+        feature = pd.DataFrame({"gene":list(gene_dict.keys()), "Count":gene_ct})
+        if args.platform == "vizgen":
+            feature.insert(1, "transcript_id", feature.gene.map(transcript_id))
+        feature.sort_values(by = "gene").to_csv(args.feature, sep='\t', index=False)
+
+    f = args.coor_minmax if args.coor_minmax != '' else os.path.join(outdir, "coordinate_minmax.tsv")
+    with open(f, 'w') as wf:
+        _ = wf.write(f"xmin\t{xmin:.{args.precision}f}\nxmax\t{xmax:.{args.precision}f}\nymin\t{ymin:.{args.precision}f}\nymax\t{ymax:.{args.precision}f}\n")
+
+if __name__ == "__main__":
+    format(sys.argv[1:])
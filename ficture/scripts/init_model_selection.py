@@ -1,4 +1,4 @@
-import sys, io, os, gzip, glob, copy, re, time, warnings, pickle, argparse, logging
+import sys, io, os, gzip, glob, copy, re, time, warnings, pickle, argparse, logging, multiprocessing
 from collections import defaultdict,Counter
 import numpy as np
 import pandas as pd
@@ -7,13 +7,66 @@ from datetime import datetime
 from scipy.sparse import *
 from sklearn.utils import check_random_state
 from sklearn.preprocessing import normalize
-from joblib import Parallel, delayed
 from sklearn.decomposition import LatentDirichletAllocation as LDA
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from ficture.utils.utilt import gen_even_slices, chisq, make_mtx_from_dge
+from ficture.utils.utilt import chisq_table, make_mtx_from_dge, ordered_map, topic_coherence
 from ficture.loaders.unit_loader import UnitLoader
 
+# Read-only data shared by the restart workers, set once per process
+_worker = {}
+
+def _init_worker(param):
+    _worker.clear()
+    _worker.update(param)
+
+def _fit_restart(task):
+    '''
+    Continue fitting one restart on the given (shuffled) training rows.
+    If evaluate, score the model and compute the coherence of its top DE genes,
+    otherwise only return the held-out score
+    '''
+    r, model, perm_list, evaluate = task
+    t0 = time.time()
+    mtx_train, mtx_test, mtx = _worker["mtx_train"], _worker["mtx_test"], _worker["mtx"]
+    for perm in perm_list:
+        if len(perm) > 0:
+            _ = model.partial_fit(mtx_train[perm, :])
+    score_test = model.score(mtx_test)/mtx_test.shape[0]
+    if not evaluate:
+        return r, model, score_test
+    factor_header = _worker["factor_header"]
+    gene_f = _worker["gene_f"]
+    ft_dict = _worker["ft_dict"]
+    topM = _worker["topM"]
+    K = len(factor_header)
+    score_train = model.score(mtx_train)/mtx_train.shape[0]
+    logging.info(f"{r}: {score_train:.2f}, {score_test:.2f}")
+    # Transform the test set
+    theta = model.transform(mtx_test)
+    topk = theta.argmax(axis = 1)
+    logging.info(f"{Counter(topk)}")
+    # Get DE genes from the test data
+    info = mtx.T @ theta
+    info = pd.DataFrame(info, columns = factor_header)
+    info.index = _worker["gene"]
+    info['gene_tot'] = info[factor_header].sum(axis = 1)
+    info.drop(index = info.index[info.gene_tot < _worker["score_feature_min"]], inplace = True)
+    total_k = np.array(info[factor_header].sum(axis = 0) )
+    total_umi = info[factor_header].sum().sum()
+    chidf = chisq_table(info, factor_header, total_k, total_umi)
+    chidf["Rank"] = chidf.groupby(by = "factor")["Chi2"].rank(ascending=False)
+    chidf.gene_total = chidf.gene_total.astype(int)
+    chidf.sort_values(by=['factor','Chi2'],ascending=[True,False],inplace=True)
+    # Compute a "coherence" score using top DE gene co-occurrence
+    top_gene = [chidf.loc[chidf.factor.eq(str(k))].gene.iloc[:topM].map(ft_dict).values for k in range(K)]
+    s = topic_coherence(mtx, theta, gene_f, top_gene)
+    score = list(s / theta.sum(axis = 0))
+    coh_score = [[r, k, s[k], score[k]] for k in range(K)]
+    t1 = time.time() - t0
+    logging.info(f"R={r}, {np.mean(score):.2f}, {np.median(score):.2f}, {t1:.2f}s")
+    return r, {'score_train':score_train, 'score_test':score_test, 'model':model, 'coherence':score}, coh_score
+
 def fit_model(_args):
 
     parser = argparse.ArgumentParser()
@@ -26,7 +79,9 @@ def fit_model(_args):
     parser.add_argument('--epoch_init', type=int, default=1, help='')
     parser.add_argument('--epoch', type=int, default=1, help='')
     parser.add_argument('--test_split', type=float, default=.5, help='')
-    parser.add_argument('--thread', type=int, default=1, help='')
+    parser.add_argument('--thread', type=int, default=1, help='Total number of processes, split between parallel restarts and within each restart')
+    parser.add_argument('--prune_fraction', type=float, default=0, help='If > 0, fit all restarts on this fraction of the first epoch then only continue the ones with the best held-out scores')
+    parser.add_argument('--prune_keep', type=float, default=.5, help='Fraction of restarts to keep when --prune_fraction is set')
     parser.add_argument('--seed', type=int, default=-1, help='')
 
     parser.add_argument('--log_norm', action='store_true', help='')
@@ -41,6 +96,7 @@ def fit_model(_args):
     parser.add_argument('--epoch_id_length', type=int, default=2, help='')
     parser.add_argument('--min_ct_per_unit', type=int, default=50, help='')
     parser.add_argument('--min_ct_per_feature', type=int, default=50, help='')
+    parser.add_argument('--first_epoch_only', action='store_true', help='Only load units in the first epoch for model selection and the final output')
     parser.add_argument('--debug', action='store_true', help='')
 
     args = parser.parse_args(_args)
@@ -73,7 +129,9 @@ def fit_model(_args):
         min_ct_per_unit = args.min_ct_per_unit, \
         min_ct_per_feature = args.min_ct_per_feature, \
         feature_list = feature_list, \
-        unit = args.unit_label, key = key)
+        unit = args.unit_label, key = key, \
+        epoch_id_length = args.epoch_id_length, \
+        first_epoch_only = args.first_epoch_only)
     unit_sum = mtx_org.sum(axis = 1)
     unit_sum_mean = np.mean(unit_sum)
     size_factor = unit_sum / unit_sum_mean
@@ -103,65 +161,54 @@ def fit_model(_args):
         mtx_log_norm = mtx_org
 
     mtx_log_norm = mtx_log_norm.tocsr()
-    results = {}
-    coh_score = []
+    mtx_train = mtx_log_norm[train_idx, :]
+    mtx_test = mtx_log_norm[test_idx, :]
+    train_perm = np.arange(Ntrain)
     mtx = mtx_org[test_idx, :].tocsc()
     factor_header = list(np.arange(K).astype(str) )
+
+    # Split cores between restarts and the E-step of each restart
+    n_worker = max(1, min(R, thread))
+    e_thread = max(1, thread // n_worker)
+    # Training order of each restart, drawn in sequence as in a serial run
+    perm_list = []
     for r in range(R):
-        t0 = time.time()
-        model = LDA(n_components=K, learning_method='online', batch_size=b_size, total_samples = N, learning_offset = args.tau, learning_decay = args.kappa, doc_topic_prior = args.alpha, n_jobs = thread, verbose = 0, random_state=seed)
+        perm_list.append([])
         for e in range(args.epoch_init):
-            rng.shuffle(train_idx)
-            _ = model.partial_fit(mtx_log_norm[train_idx, :])
-        score_train = model.score(mtx_log_norm[train_idx, :])/Ntrain
-        score_test = model.score(mtx_log_norm[test_idx, :])/Ntest
-        logging.info(f"{r}: {score_train:.2f}, {score_test:.2f}")
-        # Transform the test set
-        theta = model.transform(mtx_log_norm[test_idx, :])
-        topk = theta.argmax(axis = 1)
-        logging.info(f"{Counter(topk)}")
-        # Get DE genes from the test data
-        info = mtx.T @ theta
-        info = pd.DataFrame(info, columns = factor_header)
-        info.index = feature.gene.values
-        info['gene_tot'] = info[factor_header].sum(axis = 1)
-        info.drop(index = info.index[info.gene_tot < score_feature_min], inplace = True)
-        total_k = np.array(info[factor_header].sum(axis = 0) )
-        total_umi = info[factor_header].sum().sum()
-        res = []
-        for k, kname in enumerate(factor_header):
-            idx_slices = [idx for idx in gen_even_slices(len(info), thread)]
-            with Parallel(n_jobs=thread, verbose=0) as parallel:
-                result = parallel(delayed(chisq)(kname, \
-                            info.iloc[idx, :].loc[:, [kname, 'gene_tot']],\
-                            total_k[k], total_umi) for idx in idx_slices)
-            res += [item for sublist in result for item in sublist]
-        chidf=pd.DataFrame(res,columns=['gene','factor','Chi2','pval','FoldChange','gene_total'])
-        chidf["Rank"] = chidf.groupby(by = "factor")["Chi2"].rank(ascending=False)
-        chidf.gene_total = chidf.gene_total.astype(int)
-        chidf.sort_values(by=['factor','Chi2'],ascending=[True,False],inplace=True)
-        # Compute a "coherence" score using top DE gene co-occurrence
-        score = []
-        for k in range(K):
-            wd_idx = chidf.loc[chidf.factor.eq(str(k))].gene.iloc[:topM].map(ft_dict).values
-            wd_idx = sorted( list(wd_idx), key = lambda x : -gene_f[x])
-            s = 0
-            for ii in range(topM - 1):
-                for jj in range(ii+1, topM):
-                    i = wd_idx[ii]
-                    j = wd_idx[jj]
-                    idx = mtx.indices[mtx.indptr[i]:mtx.indptr[i+1]]
-                    denom = mtx[:, [i]].toarray()[idx] * gene_f[j] / gene_f[i]
-                    num = mtx[:, [j]].toarray()[idx]
-                    s += (theta[idx, k].reshape((-1, 1)) * np.log(num/denom + 1)).sum()
-            s0 = s / theta[:, k].sum()
-            coh_score.append([r, k, s, s0])
-            score.append(s0)
-
-        t1 = time.time() - t0
-        t0 = time.time()
-        logging.info(f"R={r}, {np.mean(score):.2f}, {np.median(score):.2f}, {t1:.2f}s")
-        results[r] = {'score_train':score_train, 'score_test':score_test, 'model':model, 'coherence':score}
+            rng.shuffle(train_perm)
+            perm_list[r].append(train_perm.copy())
+    param = {"mtx_train":mtx_train, "mtx_test":mtx_test, "mtx":mtx, \
+             "gene":feature.gene.values, "ft_dict":ft_dict, "gene_f":gene_f, \
+             "factor_header":factor_header, "topM":topM, \
+             "score_feature_min":score_feature_min}
+    mp_context = multiprocessing.get_context("fork")
+    models = {r: LDA(n_components=K, learning_method='online', batch_size=b_size, total_samples = N, learning_offset = args.tau, learning_decay = args.kappa, doc_topic_prior = args.alpha, n_jobs = e_thread, verbose = 0, random_state=seed) for r in range(R)}
+    n_first = int(Ntrain * args.prune_fraction) // b_size * b_size
+    if R > 1 and n_first > 0 and args.prune_keep < 1:
+        # Fit all restarts on the beginning of the first epoch, drop the ones with low held-out score
+        # (the split is a multiple of the minibatch size so kept restarts are not affected)
+        tasks = [(r, models[r], [perm_list[r][0][:n_first]], False) for r in range(R)]
+        score = {}
+        for r, model, score_test in ordered_map(_fit_restart, tasks, thread=n_worker, initializer=_init_worker, initargs=(param,), mp_context=mp_context):
+            models[r] = model
+            score[r] = score_test
+            perm_list[r][0] = perm_list[r][0][n_first:]
+        n_keep = max(1, int(np.ceil(R * args.prune_keep)))
+        kept = sorted(score, key = lambda r : -score[r])[:n_keep]
+        logging.info(f"Held-out score after {n_first} units: " + ", ".join([f"{r}: {score[r]:.2f}" for r in range(R)]) + f". Keep {sorted(kept)}")
+        models = {r:models[r] for r in sorted(kept)}
+        n_worker = max(1, min(len(models), thread))
+        e_thread = max(1, thread // n_worker)
+        for model in models.values():
+            model.n_jobs = e_thread
+
+    results = {}
+    coh_score = []
+    tasks = [(r, model, perm_list[r], True) for r, model in models.items()]
+    for r, res, score in ordered_map(_fit_restart, tasks, thread=n_worker, initializer=_init_worker, initargs=(param,), mp_context=mp_context):
+        results[r] = res
+        coh_score += score
+        res["model"].n_jobs = thread
 
     pickle.dump(results, open(args.output + ".model_selection_candidates.p", 'wb'))
     coh_score = pd.DataFrame(coh_score, columns = ["R","K","Score0","Score"])
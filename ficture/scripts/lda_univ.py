@@ -1,14 +1,17 @@
 import sys, os, copy, gzip, logging
 import pickle, argparse
+from datetime import datetime
 import numpy as np
 import pandas as pd
 
 from scipy.sparse import *
 import sklearn.neighbors
 import sklearn.preprocessing
+from sklearn.preprocessing import normalize
 from sklearn.decomposition import LatentDirichletAllocation as LDA
 
 from ficture.loaders.unit_loader import UnitLoader
+from ficture.loaders.unit_store import UnitStoreLoader, build_unit_store, is_unit_store
 from ficture.utils.utilt import init_latent_vars
 
 def lda(_args):
@@ -23,6 +26,7 @@ def lda(_args):
     parser.add_argument('--key', default = 'count', type=str, help='')
     parser.add_argument('--train_on', default = '', type=str, help='')
     parser.add_argument('--log', default = '', type=str, help='files to write log to')
+    parser.add_argument('--unit_store', default = '', type=str, help='Directory of a binary, epoch partitioned copy of the input. Created from --input if it does not exist or was built from another input file or with other options, then read by memory mapping instead of parsing --input in every epoch')
     parser.add_argument('--shift_log_transform', action='store_true')
     parser.add_argument('--fix_scaling', type = float, default = -1,)
 
@@ -141,14 +145,24 @@ def lda(_args):
     epoch = 0
     n_unit = 0
     chunksize=100000 if args.debug else 2000000
+    if args.unit_store != '':
+        count_cols = [key] if key == train_on else [key, train_on]
+        if not is_unit_store(args.unit_store, args.input, unit_key, gene_key, count_cols, unit_attr=unit_attr, epoch_id_length=args.epoch_id_length):
+            if is_unit_store(args.unit_store):
+                logging.info(f"{args.unit_store} was built from a different input or with different options, rebuild")
+            _ = build_unit_store(args.input, args.unit_store, unit_key, gene_key, count_cols, unit_attr=unit_attr, epoch_id_length=args.epoch_id_length, chunksize=chunksize)
     while epoch < args.epoch:
-        reader = pd.read_csv(gzip.open(args.input, 'rt'), \
-                sep='\t',chunksize=chunksize, skiprows=1, names=header, \
-                usecols=[unit_key,gene_key,train_on], dtype=adt)
-        batch_obj =  UnitLoader(reader, ft_dict, train_on, \
-            batch_id_prefix=args.epoch_id_length, \
-            min_ct_per_unit=args.min_ct_per_unit,
-            unit_id=unit_key,unit_attr=[])
+        if args.unit_store != '':
+            batch_obj = UnitStoreLoader(args.unit_store, ft_dict, train_on, \
+                min_ct_per_unit=args.min_ct_per_unit, epoch=args.epoch)
+        else:
+            reader = pd.read_csv(gzip.open(args.input, 'rt'), \
+                    sep='\t',chunksize=chunksize, skiprows=1, names=header, \
+                    usecols=[unit_key,gene_key,train_on], dtype=adt)
+            batch_obj =  UnitLoader(reader, ft_dict, train_on, \
+                batch_id_prefix=args.epoch_id_length, \
+                min_ct_per_unit=args.min_ct_per_unit,
+                unit_id=unit_key,unit_attr=[])
         if args.shift_log_transform and n_unit == 0 and fix_scaling < 0:
             N = batch_obj.read_one_epoch();
             if N == 0:
@@ -214,13 +228,18 @@ def lda(_args):
     ucol = [unit_key,gene_key,key] + unit_attr
     if key != train_on:
         ucol += [train_on]
-    reader = pd.read_csv(gzip.open(args.input, 'rt'), \
-            sep='\t',chunksize=chunksize, skiprows=1, names=header, \
-            usecols=ucol, dtype=adt)
-    batch_obj =  UnitLoader(reader, ft_dict, key, \
-        batch_id_prefix=args.epoch_id_length, \
-        min_ct_per_unit=args.min_ct_per_unit, \
-        unit_id=unit_key, unit_attr=unit_attr, train_key=train_on)
+    if args.unit_store != '':
+        batch_obj = UnitStoreLoader(args.unit_store, ft_dict, key, \
+            min_ct_per_unit=args.min_ct_per_unit, \
+            unit_attr=unit_attr, train_key=train_on, epoch=1)
+    else:
+        reader = pd.read_csv(gzip.open(args.input, 'rt'), \
+                sep='\t',chunksize=chunksize, skiprows=1, names=header, \
+                usecols=ucol, dtype=adt)
+        batch_obj =  UnitLoader(reader, ft_dict, key, \
+            batch_id_prefix=args.epoch_id_length, \
+            min_ct_per_unit=args.min_ct_per_unit, \
+            unit_id=unit_key, unit_attr=unit_attr, train_key=train_on)
     post_count = np.zeros((K, M))
     while batch_obj.update_batch(b_size):
         N = batch_obj.mtx.shape[0]
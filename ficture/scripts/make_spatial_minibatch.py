@@ -3,11 +3,26 @@
 ### Output has the same columns as input with an extra column (1st) being the minibatch index
 
 import sys, os, argparse, gzip, logging, copy, time
-import subprocess as sp
 import numpy as np
 import pandas as pd
 import random as rng
 
+from ficture.utils.bgzf_fn import RegionReader
+
+def tile_membership(v, st, ed):
+    '''
+    Tiles are intervals (st[i], ed[i]] with increasing st
+    Return a n x k array of the (at most k) tiles containing each value in v, -1 for none
+    '''
+    i_hi = np.searchsorted(st, v, side='left') - 1
+    i_lo = np.searchsorted(np.maximum.accumulate(ed), v, side='left')
+    k = max(1, (i_hi - i_lo).max(initial=0) + 1)
+    tile = i_lo.reshape((-1, 1)) + np.arange(k).reshape((1, -1))
+    valid = (tile <= i_hi.reshape((-1, 1))) & (tile < len(st))
+    valid[valid] &= np.repeat(v, k).reshape((-1, k))[valid] <= ed[tile[valid]]
+    tile[~valid] = -1
+    return tile
+
 def make_spatial_minibatch(_args):
 
     parser = argparse.ArgumentParser(prog = "make_spatial_minibatch")
@@ -59,30 +74,28 @@ def make_spatial_minibatch(_args):
             input_header[i] = input_header[i].upper()
     dty = {x:float for x in ['X', 'Y']}
 
-    ### Streaming input (Is this safe?)
-    cmd = []
+    ### Streaming input, optionally only the specified regions
+    ### (file sorted by the first column then the major axis, as indexed by tabix -s1)
+    reg_list = []
     if os.path.exists(args.regions):
-        cmd = ["tabix", args.input, "-R", args.regions]
-    elif len(args.region) > 0:
-        cmd = ["tabix", args.input] + args.region
-    elif len(args.region_um) > 0:
-        reg_list = []
-        for v in args.region_um:
-            if ":" not in v or "-" not in v:
-                continue
-            l = v.split(':')[0]
-            st, ed = v.split(':')[1].split('-')
-            st = str(int(float(st) * args.mu_scale) )
-            ed = str(int(float(ed) * args.mu_scale) )
-            reg_list.append(l+':'+'-'.join([st,ed]) )
-    #     cmd = ["tabix", args.input] + reg_list
-    #     # if len(cmd) == 0:
-    #     #     p0 = sp.Popen(["zcat", args.input], stdout=sp.PIPE)
-    #     #     process = sp.Popen(["tail", "-n", "+2"], stdin=p0.stdout, stdout=sp.PIPE)
-    #     # else:
-    #     #     process = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.STDOUT)
-    process = gzip.open(args.input, "rt")
-    _ = process.readline()
+        with open(args.regions) as rf:
+            for line in rf:
+                wd = line.strip().split('\t')
+                if len(wd) >= 3 and line[0] != "#":
+                    reg_list.append((wd[0], float(wd[1]), float(wd[2])))
+    for v in args.region + args.region_um:
+        if ":" not in v or "-" not in v:
+            continue
+        l = v.split(':')[0]
+        st, ed = [float(x) for x in v.split(':')[1].split('-')]
+        if v in args.region_um:
+            st, ed = st * args.mu_scale, ed * args.mu_scale
+        reg_list.append((l, st, ed))
+    if len(reg_list) > 0:
+        process = RegionReader(args.input, reg_list, pos_col=input_header.index(args.major_axis))
+    else:
+        process = gzip.open(args.input, "rt")
+        _ = process.readline()
 
     ### Group pixels into minibatches
     output_header = copy.copy(input_header)
@@ -97,7 +110,7 @@ def make_spatial_minibatch(_args):
 
     df = pd.DataFrame()
     nbatch=0
-    reader = pd.read_csv(process.stdout,sep='\t',chunksize=1000000,\
+    reader = pd.read_csv(process,sep='\t',chunksize=1000000,\
         names=input_header, dtype=dty)
     end_of_file = False
 
@@ -140,24 +153,40 @@ def make_spatial_minibatch(_args):
         x_grd_ed[-1] = x_max
         y_grd_ed[-1] = y_max
 
-        for it_x in range(len(x_grd_st)):
-            for it_y in range(len(y_grd_st)):
-                xst = x_grd_st[it_x]
-                xed = x_grd_ed[it_x]
-                yst = y_grd_st[it_y]
-                yed = y_grd_ed[it_y]
-                indx = (df.X > xst) & (df.X <= xed) & (df.Y > yst) & (df.Y <= yed)
-                if sum(indx) < args.min_pixel:
-                    continue
-                df.loc[indx, "random_index"] = rng.randint(1, sys.maxsize//100)
-                ### Output
-                xst /= args.mu_scale
-                xed /= args.mu_scale
-                yst /= args.mu_scale
-                yed /= args.mu_scale
-                logging.info(f"Output region ({xed-xst:.2f}, {yed-yst:.2f}) ({xst:.1f}, {xed:.1f}) x ({yst:.1f}, {yed:.1f})")
-                df.loc[indx, output_header].to_csv(args.output, mode='a', sep='\t', index=False, header=False, float_format='%.2f')
-                nbatch += 1
+        # Assign pixels to all (overlapping) tiles containing them
+        x_grd_ed = np.array(x_grd_ed)
+        y_grd_ed = np.array(y_grd_ed)
+        ny = len(y_grd_st)
+        tx = tile_membership(df.X.values, x_grd_st, x_grd_ed)
+        ty = tile_membership(df.Y.values, y_grd_st, y_grd_ed)
+        rows, tile = [], []
+        for a in range(tx.shape[1]):
+            for b in range(ty.shape[1]):
+                indx = np.where((tx[:, a] >= 0) & (ty[:, b] >= 0))[0]
+                rows.append(indx)
+                tile.append(tx[indx, a] * ny + ty[indx, b])
+        rows = np.concatenate(rows)
+        tile = np.concatenate(tile)
+        ntile = len(x_grd_st) * ny
+        tile_ct = np.bincount(tile, minlength=ntile)
+        # Random index for tiles with enough pixels, drawn in the same order as the tiles are written
+        tile_id = np.zeros(ntile, dtype=np.int64) - 1
+        for t in np.where(tile_ct >= args.min_pixel)[0]:
+            tile_id[t] = rng.randint(1, sys.maxsize//100)
+        indx = tile_id[tile] > 0
+        rows = rows[indx]
+        tile = tile[indx]
+        o = np.lexsort((rows, tile))
+        rows = rows[o]
+        tile = tile[o]
+        df.loc[:, "random_index"] = -1
+        df.iloc[rows, df.columns.get_loc("random_index")] = tile_id[tile]
+        ### Output
+        out = df.iloc[rows].loc[:, output_header]
+        out["random_index"] = tile_id[tile]
+        out.to_csv(args.output, mode='a', sep='\t', index=False, header=False, float_format='%.2f')
+        nbatch += len(np.unique(tile))
+        logging.info(f"Output {len(np.unique(tile))} minibatches ({len(rows)} rows), {nbatch} so far")
 
         ### Leftover
         if end_of_file:
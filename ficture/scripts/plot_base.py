@@ -3,15 +3,11 @@ import numpy as np
 import pandas as pd
 from random import shuffle
 
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-from PIL import Image
-
 from scipy.sparse import *
-import sklearn.neighbors
-import sklearn.preprocessing
+from scipy.ndimage import distance_transform_edt
 
 from ficture.utils.hexagon_fn import *
+from ficture.utils.image_fn import cmap_lut, cmap_ids, render_pixels, save_image
 from ficture.utils.utilt import plot_colortable
 
 def plot_base(_args):
@@ -95,6 +91,7 @@ def plot_base(_args):
                     color_info[c] = color_info[c] / 255
             cmtx = np.array(color_info.loc[:, ["R","G","B"]])
         else:
+            import matplotlib.pyplot as plt
             cmap_name = args.cmap_name
             if args.cmap_name not in plt.colormaps():
                 cmap_name = "turbo"
@@ -145,6 +142,7 @@ def plot_base(_args):
 
     N0 = df.shape[0]
     df.index = range(N0)
+    fmtx = df.loc[:, factor_header].values.astype(float)
     hsize, wsize = df[['x_indx','y_indx']].max(axis = 0) + 1
     hsize_um = hsize * args.plot_um_per_pixel
     wsize_um = wsize * args.plot_um_per_pixel
@@ -163,30 +161,33 @@ def plot_base(_args):
         pts = df[['x_indx', 'y_indx']].values
         pts_indx = df.index.values
     else:
-        pts = np.zeros((0, 2), dtype=int)
-        pts_indx = []
+        # Nearest unit of each pixel from the distance transform of a label image,
+        # computed by bands of rows with a margin of the fill range
+        margin = int(np.ceil(radius))
+        pts = [np.zeros((0, 2), dtype=int)]
+        pts_indx = [np.zeros(0, dtype=int)]
         st = wst
-        while st < wed:
-            ed = min([st + wstep, wed])
+        while st <= wed:
+            ed = min([st + wstep, wed + 1])
             logging.info(f"Filling pixels {st} - {ed} / {wed}")
-            if ((df.y_indx > st) & (df.y_indx < ed)).sum() < 10:
-                st = ed
-                continue
-            block = df.index[(df.y_indx > st - 2*radius) & (df.y_indx < ed + 2*radius)]
-            ref = sklearn.neighbors.BallTree(np.array(df.loc[block, ['x_indx', 'y_indx']]))
-            mesh = np.meshgrid(np.arange(hsize), np.arange(st, ed))
-            nodes = np.array(list(zip(*(dim.flat for dim in mesh))), dtype=int)
-            dv, iv = ref.query(nodes, k = 1, dualtree=True)
-            indx = dv[:, 0] < radius
-            iv = block[iv[indx, 0] ]
-            if sum(indx) == 0:
+            lo, hi = max(st - margin, 0), min(ed + margin, wsize)
+            block = np.where((df.y_indx.values >= lo) & (df.y_indx.values < hi))[0]
+            if len(block) == 0:
                 st = ed
                 continue
-            pts = np.vstack((pts, nodes[indx, :]) )
-            pts_indx += list(iv)
+            label = np.full((hsize, hi - lo), -1, dtype=np.int64)
+            label[df.x_indx.values[block], df.y_indx.values[block] - lo] = block
+            dv, iv = distance_transform_edt(label < 0, return_indices=True)
+            dv = dv[:, st-lo:ed-lo]
+            indx = dv < radius
+            x, y = np.nonzero(indx)
+            pts.append(np.column_stack([x, y + st]))
+            pts_indx.append(label[iv[0][:, st-lo:ed-lo][indx], iv[1][:, st-lo:ed-lo][indx]])
             st = ed
             if args.debug:
                 break
+        pts = np.vstack(pts)
+        pts_indx = np.concatenate(pts_indx)
 
     # Note: PIL default origin is upper-left
     pts[:,0] = np.clip(hsize - pts[:, 0], 0, hsize-1)
@@ -197,60 +198,34 @@ def plot_base(_args):
         pts[:,1] = wsize - 1 - pts[:, 1]
 
     logging.info(f"Start constructing RGB image")
+    pixel = pts[:, 0] * wsize + pts[:, 1]
+    ext = ".tif" if args.tif else ".png"
 
     if not args.skip_mixture_plot:
-        rgb_mtx = np.clip(np.around(np.array(df.loc[pts_indx,factor_header]) @\
-                                    cmtx * 255),0,255).astype(dt)
-        img = np.zeros( (hsize, wsize, 3), dtype=dt)
-        for r in range(3):
-            img[:, :, r] = coo_array((rgb_mtx[:, r], (pts[:,0], pts[:,1])),\
-                shape=(hsize, wsize), dtype = dt).toarray()
-        if args.tif:
-            img = Image.fromarray(img, mode="I;16")
-        else:
-            img = Image.fromarray(img)
-
-        outf = args.output
-        outf += ".tif" if args.tif else ".png"
-        img.save(outf)
+        img = render_pixels(pixel, None, fmtx[pts_indx], cmtx, (hsize, wsize), dt)
+        outf = args.output + ext
+        save_image(outf, img)
         logging.info(f"Made fractional image\n{outf}")
 
     if args.plot_discretized:
-        kvec = np.array(df.loc[pts_indx,factor_header]).argmax(axis = 1)
-        cmtx = np.clip(np.around(cmtx * 255), 0, 255).astype(dt)
-        img = np.zeros( (hsize, wsize, 3), dtype=dt)
-        for r in range(3):
-            img[:, :, r] = coo_array((cmtx[kvec, r], (pts[:,0], pts[:,1])),\
-                shape=(hsize, wsize), dtype = dt).toarray()
-        if args.tif:
-            img = Image.fromarray(img, mode="I;16")
-        else:
-            img = Image.fromarray(img)
-
-        outf = args.output + ".top"
-        outf += ".tif" if args.tif else ".png"
-        img.save(outf)
+        kvec = fmtx[pts_indx].argmax(axis = 1)
+        img = render_pixels(pixel, kvec, np.ones(len(pixel)), cmtx, (hsize, wsize), dt)
+        outf = args.output + ".top" + ext
+        save_image(outf, img)
         logging.info(f"Made hard threshold image\n{outf}")
 
     if args.plot_individual_factor:
+        import matplotlib.pyplot as plt
         if args.binary_cmap_name not in plt.colormaps():
             args.binary_cmap_name = "plasma"
-        v = np.array(df.loc[pts_indx, factor_header].sum(axis = 0) )
+        lut = cmap_lut(args.binary_cmap_name)
+        v = fmtx[pts_indx].sum(axis = 0)
         u = np.argsort(-v)
         for k in u:
-            v = np.clip(df.loc[pts_indx, factor_header[k]].values,0,1)
-            rgb_mtx = np.clip(mpl.colormaps[args.binary_cmap_name](v)[:,:3]*255,0,255).astype(dt)
-            img = np.zeros( (hsize, wsize, 3), dtype=dt)
-            for r in range(3):
-                img[:, :, r] = coo_array((rgb_mtx[:, r], (pts[:,0], pts[:,1])),\
-                    shape=(hsize, wsize), dtype = dt).toarray()
-            if args.tif:
-                img = Image.fromarray(img, mode="I;16")
-            else:
-                img = Image.fromarray(img)
-            outf = args.output + ".F_"+str(k)
-            outf += ".tif" if args.tif else ".png"
-            img.save(outf)
+            v = np.clip(fmtx[pts_indx, k],0,1)
+            img = render_pixels(pixel, cmap_ids(v), np.ones(len(pixel)), lut, (hsize, wsize), dt)
+            outf = args.output + ".F_"+str(k) + ext
+            save_image(outf, img)
             logging.info(f"Made factor specific image - {k}\n{outf}")
 
 if __name__ == "__main__":
@@ -4,11 +4,8 @@ import pandas as pd
 from random import shuffle
 from scipy.sparse import *
 
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-from PIL import Image
-
 from ficture.utils.hexagon_fn import *
+from ficture.utils.image_fn import cmap_lut, cmap_ids, render_pixels, save_image
 from ficture.utils.utilt import plot_colortable
 
 def plot_hexagon(_args):
@@ -100,6 +97,7 @@ def plot_hexagon(_args):
                     color_info[c] = color_info[c] / 255
             cmtx = np.array(color_info.loc[:, ["R","G","B"]])
         else:
+            import matplotlib.pyplot as plt
             cmap_name = args.cmap_name
             if args.cmap_name not in plt.colormaps():
                 cmap_name = "turbo"
@@ -136,7 +134,13 @@ def plot_hexagon(_args):
         df = pd.concat([df, chunk])
 
     df.drop_duplicates(inplace=True,subset=['x_hex','y_hex'])
-    df.index = list(zip(df.x_hex, df.y_hex))
+    if df.shape[0] == 0:
+        sys.exit("ERROR: No hexagons found in the region")
+    # Sorted integer keys of the hexagons to look up image pixels
+    hex_keys = hex_key(0, df.x_hex.values, df.y_hex.values)
+    hex_order = np.argsort(hex_keys)
+    hex_keys = hex_keys[hex_order]
+    fmtx = df.loc[:, factor_header].values.astype(float)
 
     x_min = args.xmin
     y_min = args.ymin
@@ -171,33 +175,28 @@ def plot_hexagon(_args):
     wstep = np.max([10, int(args.batch_size)])
     print(wsize, wstep)
 
-    pts = np.zeros((0, 2), dtype=int)
+    pts = []
     pts_indx = []
     st = wst
     while st < wed:
         ed = min([st + wstep, wed])
         logging.info(f"Filling pixels {st} - {ed} / {wed}")
 
-        st_um = st / args.plot_um_per_pixel
-        ed_um = ed / args.plot_um_per_pixel
-        block = df.index[(df.y > st_um - radius) & (df.y < ed_um + radius)]
-
-        mesh = np.meshgrid(np.arange(hsize), np.arange(st, ed))
-        nodes = np.array(list(zip(*(dim.flat for dim in mesh))), dtype=float)
-        nodes[:, 0] += x_indx_min
-        nodes *= args.plot_um_per_pixel # original scale
+        # Hexagon of every pixel in the band, keep those present in the input
+        px = np.tile(np.arange(hsize), ed - st)
+        py = np.repeat(np.arange(st, ed), hsize)
+        nodes = np.column_stack([px + x_indx_min, py]) * args.plot_um_per_pixel
         x, y = pixel_to_hex(nodes, radius, 0, 0)
-        hex_xy = list(zip(x, y))
-        indx = [i for i,x in enumerate(hex_xy) if x in block]
-        nodes = nodes[indx, :]
-        pts_indx += [hex_xy[i] for i in indx]
-        nodes /= args.plot_um_per_pixel
-        nodes[:, 0] -= x_indx_min
-        nodes[:, 1] -= y_indx_min
-        pts = np.vstack((pts, nodes.astype(int) ) )
+        key = hex_key(0, x, y)
+        i = np.clip(np.searchsorted(hex_keys, key), 0, len(hex_keys) - 1)
+        indx = hex_keys[i] == key
+        pts_indx.append(hex_order[i[indx]])
+        pts.append(np.column_stack([px[indx], py[indx] - y_indx_min]))
         st = ed
         if args.debug:
             break
+    pts = np.vstack(pts)
+    pts_indx = np.concatenate(pts_indx)
 
     # Note: PIL default origin is upper-left
     pts[:,0] = np.clip(hsize - pts[:, 0], 0, hsize-1)
@@ -208,60 +207,34 @@ def plot_hexagon(_args):
         pts[:,1] = wsize - 1 - pts[:, 1]
 
     logging.info(f"Start constructing RGB image")
+    pixel = pts[:, 0] * wsize + pts[:, 1]
+    ext = ".tif" if args.tif else ".png"
 
     if not args.skip_mixture_plot:
-        rgb_mtx = np.clip(np.around(np.array(df.loc[pts_indx,factor_header]) @\
-                                    cmtx * 255),0,255).astype(dt)
-        img = np.zeros( (hsize, wsize, 3), dtype=dt)
-        for r in range(3):
-            img[:, :, r] = coo_array((rgb_mtx[:, r], (pts[:,0], pts[:,1])),\
-                shape=(hsize, wsize), dtype = dt).toarray()
-        if args.tif:
-            img = Image.fromarray(img, mode="I;16")
-        else:
-            img = Image.fromarray(img)
-
-        outf = args.output
-        outf += ".tif" if args.tif else ".png"
-        img.save(outf)
+        img = render_pixels(pixel, None, fmtx[pts_indx], cmtx, (hsize, wsize), dt)
+        outf = args.output + ext
+        save_image(outf, img)
         logging.info(f"Made fractional image\n{outf}")
 
     if args.plot_discretized:
-        kvec = np.array(df.loc[pts_indx,factor_header]).argmax(axis = 1)
-        cmtx = np.clip(np.around(cmtx * 255), 0, 255).astype(dt)
-        img = np.zeros( (hsize, wsize, 3), dtype=dt)
-        for r in range(3):
-            img[:, :, r] = coo_array((cmtx[kvec, r], (pts[:,0], pts[:,1])),\
-                shape=(hsize, wsize), dtype = dt).toarray()
-        if args.tif:
-            img = Image.fromarray(img, mode="I;16")
-        else:
-            img = Image.fromarray(img)
-
-        outf = args.output + ".top"
-        outf += ".tif" if args.tif else ".png"
-        img.save(outf)
+        kvec = fmtx[pts_indx].argmax(axis = 1)
+        img = render_pixels(pixel, kvec, np.ones(len(pixel)), cmtx, (hsize, wsize), dt)
+        outf = args.output + ".top" + ext
+        save_image(outf, img)
         logging.info(f"Made hard threshold image\n{outf}")
 
     if args.plot_individual_factor:
+        import matplotlib.pyplot as plt
         if args.binary_cmap_name not in plt.colormaps():
             args.binary_cmap_name = "plasma"
-        v = np.array(df.loc[pts_indx, factor_header].sum(axis = 0) )
+        lut = cmap_lut(args.binary_cmap_name)
+        v = fmtx[pts_indx].sum(axis = 0)
         u = np.argsort(-v)
         for k in u:
-            v = np.clip(df.loc[pts_indx, factor_header[k]].values,0,1)
-            rgb_mtx = np.clip(mpl.colormaps[args.binary_cmap_name](v)[:,:3]*255,0,255).astype(dt)
-            img = np.zeros( (hsize, wsize, 3), dtype=dt)
-            for r in range(3):
-                img[:, :, r] = coo_array((rgb_mtx[:, r], (pts[:,0], pts[:,1])),\
-                    shape=(hsize, wsize), dtype = dt).toarray()
-            if args.tif:
-                img = Image.fromarray(img, mode="I;16")
-            else:
-                img = Image.fromarray(img)
-            outf = args.output + ".F_"+str(k)
-            outf += ".tif" if args.tif else ".png"
-            img.save(outf)
+            v = np.clip(fmtx[pts_indx, k],0,1)
+            img = render_pixels(pixel, cmap_ids(v), np.ones(len(pixel)), lut, (hsize, wsize), dt)
+            outf = args.output + ".F_"+str(k) + ext
+            save_image(outf, img)
             logging.info(f"Made factor specific image - {k}\n{outf}")
 
 if __name__ == "__main__":
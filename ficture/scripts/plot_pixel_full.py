@@ -6,9 +6,10 @@ import sys, os, copy, gc, re, gzip, pickle, argparse, logging, warnings
 import numpy as np
 import pandas as pd
 from scipy.sparse import *
-import cv2
 
 from ficture.loaders.pixel_factor_loader import BlockIndexedLoader
+from ficture.utils.image_fn import color_lut, mix_colors, PixelAccumulator
+from ficture.utils.tile_fn import tiled_image_writer, mean_renderer, stream_frontier, TileAccumulator
 
 def plot_pixel_full(_args):
 
@@ -28,9 +29,12 @@ def plot_pixel_full(_args):
     parser.add_argument('--xmax', type=float, default=np.inf, help="in um")
     parser.add_argument('--ymax', type=float, default=np.inf, help="in um")
     parser.add_argument('--full', action='store_true', help="Read full input")
+    parser.add_argument('--roi_file', type=str, default='', help="TSV with columns name, xmin, xmax, ymin, ymax (um, same convention as --xmin etc.). Render every region from one pass over the input, to {output}.{name}.{ext}, --output is used as a prefix and its extension (.png, .tif or .tiff, default .png) is kept")
     parser.add_argument('--plot_um_per_pixel', type=float, default=1, help="Actual size (um) corresponding to each pixel in the output image")
     parser.add_argument('--org_coord', action='store_true', help="If the input coordinates do not include the offset (if your coordinates are from an existing figure, the offset is already factored in)")
     parser.add_argument('--plot_top', action='store_true', help="Plot top factor only")
+    parser.add_argument('--tiled', action='store_true', help="Write the image tile by tile as the input streams past, keeping only the current tiles in memory. Output is a tiled TIFF if --output ends with .tif/.tiff, otherwise PNG. PNG is written by bands of rows, for input blocked along X (BLOCK_AXIS=X) no band finishes before the end and all compressed tiles stay in memory, use TIFF")
+    parser.add_argument('--tile_size', type=int, default=512, help="Tile size (pixels) for --tiled, a multiple of 16")
     parser.add_argument('--debug', action='store_true')
 
     args = parser.parse_args(_args)
@@ -62,11 +66,46 @@ def plot_pixel_full(_args):
     if args.category_column != '':
         dty[args.category_column] = str
 
+    roi = None
+    if args.roi_file != '':
+        if not os.path.exists(args.roi_file):
+            sys.exit(f"ERROR: cannot find --roi_file {args.roi_file}")
+        roi = pd.read_csv(args.roi_file, sep='\t', dtype={'name':str})
+        roi.columns = roi.columns.str.lower()
+        if not set(['name', 'xmin', 'xmax', 'ymin', 'ymax']).issubset(roi.columns):
+            sys.exit(f"ERROR: --roi_file should contain columns name, xmin, xmax, ymin, ymax")
+        if roi.name.duplicated().any():
+            sys.exit(f"ERROR: region names in --roi_file are not unique")
+        # Read the bounding box of all regions once, each image extends up to 1um past its max
+        args.xmin, args.xmax = roi.xmin.min(), roi.xmax.max() + 1
+        args.ymin, args.ymax = roi.ymin.min(), roi.ymax.max() + 1
+        logging.info(f"Read {roi.shape[0]} regions")
+
     loader = BlockIndexedLoader(args.input, args.xmin, args.xmax, args.ymin, args.ymax, args.full, not args.org_coord, idtype=dty)
-    width = int((loader.xmax - loader.xmin + 1)/args.plot_um_per_pixel)
-    height= int((loader.ymax - loader.ymin + 1)/args.plot_um_per_pixel)
-    logging.info(f"Image size {height} x {width}")
     print(loader.header)
+    # Output images: (name, xmin, ymin, xmax, ymax, height, width, output file)
+    region = []
+    if roi is None:
+        if not args.output.lower().endswith((".png", ".tif", ".tiff")):
+            args.output += ".png"
+        region.append([None, loader.xmin, loader.ymin, loader.xmax, loader.ymax, args.output])
+    else:
+        # Keep the image format of --output for every region
+        m = re.search(r'\.(png|tif|tiff)$', args.output, flags=re.IGNORECASE)
+        prefix, ext = (args.output[:m.start()], m.group(0)) if m is not None else (args.output, ".png")
+        for v in roi.itertuples():
+            # Clip as the loader does for --xmin etc.
+            rx = [max(v.xmin, 0), min(v.xmax, loader.meta["SIZE_X"])]
+            ry = [max(v.ymin, 0), min(v.ymax, loader.meta["SIZE_Y"])]
+            if rx[1] <= rx[0] or ry[1] <= ry[0]:
+                logging.warning(f"Region {v.name} is empty, skip")
+                continue
+            region.append([v.name, rx[0], ry[0], rx[1], ry[1], f"{prefix}.{v.name}{ext}"])
+    for r in region:
+        width = int((r[3] - r[1] + 1)/args.plot_um_per_pixel)
+        height= int((r[4] - r[2] + 1)/args.plot_um_per_pixel)
+        r[5:5] = [height, width]
+        logging.info(f"Image size {height} x {width}" + ("" if r[0] is None else f" ({r[0]})"))
 
     categorical = False
     if args.category_column != '':
@@ -93,56 +132,69 @@ def plot_pixel_full(_args):
         if args.debug:
             print(category_list)
 
-    # Read input file, fill the rgb matrix
-    img = np.zeros((height,width,3), dtype=np.uint8)
+    # Read input file, accumulate colors
+    lut_index, lut = color_lut(color_info, rgb)
     bg = args.background
-    bg = [ np.uint8(int(bg[i:i+2], 16) ) for i in [0,2,4] ]
-    for c in range(3):
-        img[:,:,c] = bg[c]
-    keptcol = ['X','Y'] + rgb
+    bg = [ np.uint8(int(bg[i:i+2], 16) ) for i in [4,2,0] ] # hex is RGB, the image is BGR
+    acc = []
+    for name, xmin, ymin, xmax, ymax, height, width, outf in region:
+        if args.tiled:
+            writer = tiled_image_writer(outf, height, width, len(rgb), args.tile_size, bgr=True, block_axis=loader.meta.get('BLOCK_AXIS'))
+            acc.append(TileAccumulator(writer, len(rgb), mean_renderer(bg)))
+        else:
+            acc.append(PixelAccumulator(height, width, len(rgb)))
     for df in loader:
         if df.shape[0] == 0:
             continue
-        df['X'] = np.clip(((df.X - loader.xmin) / args.plot_um_per_pixel).astype(int),0,width-1)
-        df['Y'] = np.clip(((df.Y - loader.ymin) / args.plot_um_per_pixel).astype(int),0,height-1)
+        raw = df
         if categorical:
             if args.debug:
                 print(df.loc[~df[args.category_column].isin(category_map), :][args.category_column].unique() )
             if category_rename:
                 df[args.category_column] = df[args.category_column].map(category_map)
                 if args.unmapped != '':
-                    df[args.category_column].fillna(args.unmapped, inplace=True)
+                    df[args.category_column] = df[args.category_column].fillna(args.unmapped)
                 else:
                     df = df.loc[~df[args.category_column].isna(), :]
                 if args.debug:
                     print(df.shape[0], df[args.category_column].value_counts())
             else:
                 df = df.loc[df[args.category_column].isin(color_info.index), :]
-            for c in rgb:
-                df[c] = color_info.loc[df[args.category_column].values, c].values
+            val = mix_colors(lut_index.get_indexer(df[args.category_column].values), np.ones(df.shape[0]), lut)
             if args.debug:
                 print(df[args.category_column].value_counts())
+        elif args.plot_top:
+            val = mix_colors(lut_index.get_indexer(df['K1'].values), np.ones(df.shape[0]), lut)
         else:
-            if args.plot_top:
-                for c in rgb:
-                    df[c] = color_info.loc[df['K1'].values, c].values
+            topk = range(1,loader.meta['TOPK']+1)
+            ids = np.column_stack([lut_index.get_indexer(df['K'+str(k)].values) for k in topk])
+            val = mix_colors(ids, df[['P'+str(k) for k in topk]].values, lut)
+        # Route pixels to every image containing them
+        for (name, xmin, ymin, xmax, ymax, height, width, outf), a in zip(region, acc):
+            x = np.floor((df.X.values - xmin) / args.plot_um_per_pixel).astype(int)
+            y = np.floor((df.Y.values - ymin) / args.plot_um_per_pixel).astype(int)
+            if name is None:
+                indx = slice(None)
+                x = np.clip(x, 0, width-1)
+                y = np.clip(y, 0, height-1)
             else:
-                for c in rgb:
-                    df[c] = 0
-                    for k in range(1,loader.meta['TOPK']+1):
-                        df[c] += color_info.loc[df['K'+str(k)].values, c].values * df['P'+str(k)].values
-        df = df.groupby(by=['X','Y']).agg({c:np.mean for c in rgb}).reset_index()
-        logging.info(f"Reading pixels... {df.X.iloc[-1]}, {df.Y.iloc[-1]}, {df.shape[0]}")
-        for i,c in enumerate(rgb):
-            df[c] = np.clip(np.around(df[c] * 255),0,255).astype(np.uint8)
-            img[df.Y.values, df.X.values, [i]*df.shape[0]] = df[c].values
+                # Route by image pixel, the image covers (xmax - xmin + 1) um
+                indx = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+                x, y = x[indx], y[indx]
+            a.add(x, y, val[indx])
+            if args.tiled:
+                a.flush(stream_frontier(loader.meta, raw, xmin, ymin, args.plot_um_per_pixel))
+        if df.shape[0] > 0:
+            logging.info(f"Reading pixels... {df.X.iloc[-1]}, {df.Y.iloc[-1]}, {df.shape[0]}")
         if args.debug:
             break
-
-    if not args.output.endswith(".png"):
-        args.output += ".png"
-    cv2.imwrite(args.output,img)
-    logging.info(f"Finished\n{args.output}")
+    for r, a in zip(region, acc):
+        if args.tiled:
+            a.close()
+        else:
+            import cv2
+            cv2.imwrite(r[-1], a.render(bg))
+        logging.info(f"Finished\n{r[-1]}")
 
 if __name__ == "__main__":
     plot_pixel_full(sys.argv[1:])
@@ -7,9 +7,10 @@ import sys, os, copy, re, gzip, argparse, logging, warnings
 import numpy as np
 import pandas as pd
 from scipy.sparse import *
-import cv2
 
 from ficture.loaders.pixel_factor_loader import BlockIndexedLoader
+from ficture.utils.image_fn import mix_colors, to_dtype
+from ficture.utils.tile_fn import tiled_image_writer, stream_frontier, TileAccumulator
 
 def plot_pixel_multi(_args):
 
@@ -32,6 +33,9 @@ def plot_pixel_multi(_args):
     parser.add_argument('--full', action='store_true', help="")
     parser.add_argument('--plot_um_per_pixel', type=float, default=1, help="Actual size (um) corresponding to each pixel in the output image")
     parser.add_argument('--categorical', action='store_true', help="Plot top factor for each pixel categorically, without probability or mixture")
+    parser.add_argument('--premultiply_alpha', action='store_true', help="Store colors premultiplied by alpha")
+    parser.add_argument('--tiled', action='store_true', help="Write the image tile by tile as the input streams past, keeping only the current tiles in memory. Output is a tiled TIFF if --output ends with .tif/.tiff, otherwise PNG. PNG is written by bands of rows, for input blocked along X (BLOCK_AXIS=X) no band finishes before the end and all compressed tiles stay in memory, use TIFF")
+    parser.add_argument('--tile_size', type=int, default=512, help="Tile size (pixels) for --tiled, a multiple of 16")
     parser.add_argument('--debug', action='store_true', help="")
 
     args = parser.parse_args(_args)
@@ -42,10 +46,6 @@ def plot_pixel_multi(_args):
     logging.basicConfig(level= getattr(logging, "INFO", None), format='%(asctime)s %(message)s', datefmt='%I:%M:%S %p')
 
     rgb=list("RGB")
-    bgr=list("BGR") # opencv default channel order
-    bgra=list("BGRA") # opencv bgra
-    pcut = 0.01
-    spcut = 0.1
     if len(args.channel_list) > 5:
         logging.warning("Be colorblind friendly")
     channels = args.channel_list
@@ -85,51 +85,78 @@ def plot_pixel_multi(_args):
     height= int((loader.ymax - loader.ymin + 1)/args.plot_um_per_pixel)
     logging.info(f"Image size {height} x {width}")
 
+    # Color table with an alpha column, in opencv channel order
+    lut = np.zeros((len(channels) + 1, 4), dtype=np.float32)
+    for i, c in enumerate(channels):
+        lut[i, :3] = color_info[c][::-1]
+        lut[i, 3] = 1
+    channel_index = pd.Index(channels)
+    topk = range(1, loader.meta['TOPK']+1)
+
     # Read input file, fill the rgb matrix
-    img = np.zeros((height,width,4), dtype=np.uint8)
-    img[:,:,3] = 255
-    clps = {x:np.mean for x in rgb}
-    clps['A'] = np.max
+    if args.tiled:
+        if not args.output.lower().endswith((".png", ".tif", ".tiff")):
+            args.output += ".png"
+        def render(mean, count, amax):
+            out = np.zeros((mean.shape[0], 4), dtype=np.uint8)
+            out[:, 3] = 255
+            kept = (count > 0) & (amax[:, 0] > args.spcut)
+            out[kept] = to_dtype(mean[kept], alpha=amax[kept, 0], premultiply=args.premultiply_alpha)
+            return out
+        writer = tiled_image_writer(args.output, height, width, 4, args.tile_size, bgr=True, premultiplied=args.premultiply_alpha, block_axis=loader.meta.get('BLOCK_AXIS'))
+        acc = TileAccumulator(writer, 3, render, n_max=1)
+    else:
+        img = np.zeros((height,width,4), dtype=np.uint8)
+        img[:,:,3] = 255
     for df in loader:
         if df.shape[0] == 0:
             continue
-        indx = np.zeros(df.shape[0], dtype=bool)
+        frontier = stream_frontier(loader.meta, df, loader.xmin, loader.ymin, args.plot_um_per_pixel)
         if args.categorical:
-            indx = df.K1.isin(channels)
+            ids = channel_index.get_indexer(df.K1.values).reshape((-1, 1))
+            probs = np.ones(ids.shape)
+            indx = ids[:, 0] >= 0
         else:
-            for k in range(1, loader.meta['TOPK']):
-                indx = indx | (df[f"K{k}"].isin(channels) & df[f"P{k}"].gt(pcut))
-        df = df.loc[indx, :]
+            ids = np.column_stack([channel_index.get_indexer(df[f"K{k}"].values) for k in topk])
+            probs = df[[f"P{k}" for k in topk]].values
+            indx = ((ids >= 0) & (probs > args.pcut)).any(axis = 1)
         if args.debug:
-            print(df.shape[0])
-        if df.shape[0] == 0:
+            print(indx.sum())
+        if indx.sum() == 0:
+            if args.tiled:
+                acc.flush(frontier)
             continue
-        df['X'] = np.clip(((df.X - loader.xmin) / args.plot_um_per_pixel).astype(int),0,width-1)
-        df['Y'] = np.clip(((df.Y - loader.ymin) / args.plot_um_per_pixel).astype(int),0,height-1)
-        df[bgra] = 0
-        if args.categorical:
-            df.loc[:,rgb] = np.array(list(df.K1.map(color_info)) )
-            df['A'] = 1
-        else:
-            for k in range(1, loader.meta['TOPK']):
-                indx = df[f"K{k}"].isin(channels)
-                if indx.sum() == 0:
-                    continue
-                df.loc[indx, rgb] += np.array(list(df.loc[indx, f"K{k}"].map(color_info))) * df.loc[indx, f"P{k}"].values.reshape((-1,1))
-                df.loc[indx, 'A'] += df.loc[indx, f"P{k}"]
+        x = np.clip(((df.X.values[indx] - loader.xmin) / args.plot_um_per_pixel).astype(int),0,width-1)
+        y = np.clip(((df.Y.values[indx] - loader.ymin) / args.plot_um_per_pixel).astype(int),0,height-1)
+        val = mix_colors(ids[indx], probs[indx], lut) # B, G, R, A
         if args.debug:
-            print(df.shape[0], np.median(df.A), np.mean(df.A), df.A.gt(spcut).sum())
-        df = df.groupby(by=['X','Y']).agg(clps).reset_index()
-        df = df.loc[df.A.gt(spcut), :]
-        df[bgra] = np.clip(np.around(df[bgra] * 255),0,255).astype(np.uint8)
-        logging.info(f"Reading pixels... {df.X.iloc[-1]}, {df.Y.iloc[-1]}, {df.shape[0]}")
-        for i,c in enumerate(bgra):
-            img[df.Y.values, df.X.values, [i]*df.shape[0]] = df[c].values
+            print(len(x), np.median(val[:, 3]), np.mean(val[:, 3]), (val[:, 3] > args.spcut).sum())
+        if args.tiled:
+            acc.add(x, y, val[:, :3], val[:, 3:])
+            acc.flush(frontier)
+            logging.info(f"Reading pixels... {x[-1]}, {y[-1]}, {len(x)}")
+            if args.debug:
+                break
+            continue
+        # Mean color and max alpha of each pixel
+        u, inv = np.unique(y.astype(np.int64) * width + x, return_inverse=True)
+        n = np.bincount(inv)
+        mean = np.column_stack([np.bincount(inv, weights=val[:, c]) for c in range(3)]) / n.reshape((-1, 1))
+        amax = np.zeros(len(u), dtype=np.float32)
+        np.maximum.at(amax, inv, val[:, 3])
+        kept = amax > args.spcut
+        img.reshape((-1, 4))[u[kept]] = to_dtype(mean[kept], alpha=amax[kept], premultiply=args.premultiply_alpha)
+        logging.info(f"Reading pixels... {x[-1]}, {y[-1]}, {kept.sum()}")
         if args.debug:
             break
 
+    if args.tiled:
+        acc.close()
+        logging.info(f"Finished\n{args.output}")
+        return
     if not args.output.endswith(".png"):
         args.output += ".png"
+    import cv2
     cv2.imwrite(args.output,img)
     logging.info(f"Finished\n{args.output}")
 
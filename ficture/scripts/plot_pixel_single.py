@@ -1,16 +1,16 @@
 # Visualize pixel level single factor heatmap
 # Input file contains only top k factors and probabilities per pixel
 # Meant to make use of the indexed input to plot for specified regions quickly
-# Would take a huge amount of memory if trying to plot many factors simultaneously in a large region
+# All factors are rendered from one read of the input, use --tiled to bound memory by tiles in a large region
 
 import sys, os, copy, gc, re, gzip, pickle, argparse, logging, warnings
 import numpy as np
 import pandas as pd
 from scipy.sparse import *
-import matplotlib as mpl
-import cv2
 
 from ficture.loaders.pixel_factor_loader import BlockIndexedLoader
+from ficture.utils.image_fn import topk_entries, cmap_lut, cmap_ids, mix_colors, to_dtype, render_pixels, save_image
+from ficture.utils.tile_fn import tiled_image_writer, stream_frontier, SparseTileAccumulator
 
 def plot_pixel_single(_args):
 
@@ -28,7 +28,10 @@ def plot_pixel_single(_args):
     parser.add_argument('--org_coord', action='store_true', help="If the input coordinates do not include the offset (if your coordinates are from an existing figure, the offset is already factored in)")
     parser.add_argument('--full', action='store_true', help="Read full input")
     parser.add_argument('--plot_um_per_pixel', type=float, default=1, help="Actual size (um) corresponding to each pixel in the output image")
-    parser.add_argument('--all', action="store_true", help="Caution: when set, assume factors are named as 0, 1, ... K-1, where K is defined in the input header. Only use when plotting a small region.")
+    parser.add_argument('--all', action="store_true", help="Plot all factors, assume factors are named as 0, 1, ... K-1, where K is defined in the input header. Use with --tiled for a large region")
+    parser.add_argument('--tiled', action='store_true', help="Write the images tile by tile as the input streams past, keeping only the current tiles in memory. PNG is written by bands of rows, for input blocked along X (BLOCK_AXIS=X) no band finishes before the end and all compressed tiles stay in memory, use --tile_format tif")
+    parser.add_argument('--tile_size', type=int, default=512, help="Tile size (pixels) for --tiled, a multiple of 16")
+    parser.add_argument('--tile_format', type=str, default="png", choices=["png", "tif"], help="Output image format for --tiled")
     parser.add_argument('--debug', action='store_true', help="")
 
     args = parser.parse_args(_args)
@@ -51,38 +54,67 @@ def plot_pixel_single(_args):
     if args.all:
         id_list = [str(k) for k in range(loader.meta['K'])]
 
-    # Read input file
-    df = pd.DataFrame()
+    index = pd.Index(id_list)
+    lut = cmap_lut(args.binary_cmap_name)
+    if args.tiled:
+        def render(mean, count, amax):
+            out = np.zeros((mean.shape[0], 3), dtype=np.uint8)
+            kept = (count > 0) & (mean[:, 0] > args.pcut)
+            out[kept] = to_dtype(mix_colors(cmap_ids(mean[kept, 0]), np.ones(kept.sum()), lut))
+            return out
+        outf = [args.output +".F_" +k+"."+args.tile_format for k in id_list]
+        writers = [tiled_image_writer(f, height, width, 3, args.tile_size, block_axis=loader.meta.get('BLOCK_AXIS')) for f in outf]
+        acc = SparseTileAccumulator(writers, render, thresholds=[.5, args.pcut])
+
+    # Read input file, keep (pixel, factor, probability) of all factors in one pass
+    pix, ent_pix, ent_k, ent_p = [], [], [], []
     for chunk in loader:
         if chunk.shape[0] == 0:
             continue
-        chunk['X'] = np.clip(((chunk.X - loader.xmin) / args.plot_um_per_pixel).astype(int),0,width-1)
-        chunk['Y'] = np.clip(((chunk.Y - loader.ymin) / args.plot_um_per_pixel).astype(int),0,height-1)
-        for k in id_list:
-            chunk[k] = np.zeros(chunk.shape[0], dtype=np.float16)
-            for i in range(1, loader.meta['TOPK']+1):
-                indx = chunk['K'+str(i)].eq(k) & chunk['P'+str(i)].gt(args.pcut)
-                chunk.loc[indx, k] = chunk.loc[indx, 'P'+str(i)]
-        chunk = chunk.groupby(by=['X','Y']).agg({k:np.mean for k in id_list}).reset_index()
-        pmax = chunk.loc[:, id_list].max(axis = 1)
-        df = pd.concat([df, chunk.loc[pmax > args.pcut, :]])
-        logging.info(f"Reading pixels... {chunk.X.iloc[-1]}, {chunk.Y.iloc[-1]}, {df.shape[0]}")
-    df.drop_duplicates(subset=['X','Y'], inplace=True)
-    if df.shape[0] == 0:
-        sys.exit("ERROR: No pixels found")
+        x = np.clip(((chunk.X.values - loader.xmin) / args.plot_um_per_pixel).astype(int),0,width-1)
+        y = np.clip(((chunk.Y.values - loader.ymin) / args.plot_um_per_pixel).astype(int),0,height-1)
+        row, ch, prob = topk_entries(chunk, loader.meta['TOPK'], index, args.pcut)
+        if args.tiled:
+            acc.add(x, y, row, ch, prob)
+            acc.flush(stream_frontier(loader.meta, chunk, loader.xmin, loader.ymin, args.plot_um_per_pixel))
+            logging.info(f"Reading pixels... {x[-1]}, {y[-1]}")
+            continue
+        pid = y.astype(np.int64) * width + x
+        pix.append(pid)
+        ent_pix.append(pid[row])
+        ent_k.append(ch)
+        ent_p.append(prob)
+        logging.info(f"Reading pixels... {x[-1]}, {y[-1]}, {len(row)}")
+    if args.tiled:
+        acc.close()
+        # Same rule as below, images are only known to be (almost) empty once written
+        for i, k in enumerate(id_list):
+            if acc.n_above[i, 0] < 10 and acc.n_above[i, 1] < 100:
+                os.remove(outf[i])
+                logging.info(f"Too few pixels for {k}, removed its image")
+        logging.info(f"Finished")
+        return
 
-    logging.info(f"Read {df.shape[0]} pixels")
+    if len(pix) == 0:
+        sys.exit("ERROR: No pixels found")
+    # Mean probability of each factor in each image pixel
+    pix, count = np.unique(np.concatenate(pix), return_counts=True)
+    n = height * width
+    key, inv = np.unique(np.concatenate(ent_k).astype(np.int64) * n + np.concatenate(ent_pix), return_inverse=True)
+    total = np.bincount(inv, weights=np.concatenate(ent_p))
+    ent_k, ent_pix = np.divmod(key, n)
+    mean = total / count[np.searchsorted(pix, ent_pix)]
+    bound = np.searchsorted(ent_k, np.arange(len(id_list) + 1))
+    logging.info(f"Read {len(pix)} pixels")
 
-    for k in id_list:
-        indx = df[k] > args.pcut
-        if (df[k] > .5).sum() < 10 and indx.sum() < 100:
+    for i, k in enumerate(id_list):
+        v = mean[bound[i]:bound[i+1]]
+        indx = v > args.pcut
+        # Skip factors with too few pixels
+        if (v > .5).sum() < 10 and indx.sum() < 100:
             continue
-        rgb = np.clip(mpl.colormaps['plasma'](df.loc[indx, k].values)[:,:3]*255,0,255).astype(np.uint8)
-        img = np.zeros((height,width,3), dtype=np.uint8)
-        for i in range(3):
-            img[:, :, i] = coo_array( ( rgb[:, i], (df.loc[indx, 'Y'], df.loc[indx, 'X']) ), shape=(height, width) ).toarray()
-        img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
-        cv2.imwrite(args.output +".F_" +k+".png",img)
+        img = render_pixels(ent_pix[bound[i]:bound[i+1]][indx], cmap_ids(v[indx]), np.ones(indx.sum()), lut, (height, width))
+        save_image(args.output +".F_" +k+".png",img)
         logging.info(f"Made image for {k}")
 
     logging.info(f"Finished")
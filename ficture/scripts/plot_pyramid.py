@@ -0,0 +1,89 @@
+# Render pixel level factor analysis results as a multi-resolution tile pyramid
+# The finest level is rendered once from the (sorted) input stream, coarser levels are
+# made by repeated 2x downsampling, tiles are written to {output}/{z}/{x}/{y}.png
+# with a manifest.json describing the levels
+
+import sys, os, re, argparse, logging
+import numpy as np
+import pandas as pd
+
+from ficture.loaders.pixel_factor_loader import BlockIndexedLoader
+from ficture.utils.image_fn import color_lut, mix_colors
+from ficture.utils.tile_fn import TilePyramidWriter, mean_renderer, stream_frontier, TileAccumulator
+
+def plot_pyramid(_args):
+
+    parser = argparse.ArgumentParser(prog="plot_pyramid")
+    parser.add_argument('--input', type=str, help='')
+    parser.add_argument('--output', type=str, help='Output directory')
+    parser.add_argument('--color_table', type=str, help='Pre-defined color map')
+    parser.add_argument('--color_table_index_column', type=str, default='Name', help='')
+    parser.add_argument('--input_rgb_uint8', action="store_true",help="If input rgb is from 0-255 instead of 0-1")
+    parser.add_argument('--background', type=str, default="000000", help='')
+
+    parser.add_argument('--xmin', type=float, default=-np.inf, help="in um")
+    parser.add_argument('--ymin', type=float, default=-np.inf, help="in um")
+    parser.add_argument('--xmax', type=float, default=np.inf, help="in um")
+    parser.add_argument('--ymax', type=float, default=np.inf, help="in um")
+    parser.add_argument('--full', action='store_true', help="Read full input")
+    parser.add_argument('--plot_um_per_pixel', type=float, default=0.5, help="Size (um) of each pixel at the finest level")
+    parser.add_argument('--org_coord', action='store_true', help="If the input coordinates do not include the offset (if your coordinates are from an existing figure, the offset is already factored in)")
+    parser.add_argument('--plot_top', action='store_true', help="Plot top factor only")
+    parser.add_argument('--tile_size', type=int, default=256, help="Tile size (pixels)")
+    parser.add_argument('--tile_format', type=str, default="png", choices=["png", "webp"], help="")
+
+    args = parser.parse_args(_args)
+    if len(_args) == 0:
+        parser.print_help()
+        return
+
+    logging.basicConfig(level= getattr(logging, "INFO", None), format='%(asctime)s %(message)s', datefmt='%I:%M:%S %p')
+
+    # Read color table
+    rgb=['B','G','R'] # opencv rgb order
+    args.background = args.background.lstrip('#')
+    match = re.search(r'^(?:[0-9a-fA-F]{3}){1,2}$', args.background)
+    if not match:
+        logging.warning(f"Invalid background color {args.background}")
+        args.background = "000000"
+    cdty = {x:float for x in rgb}
+    cdty[args.color_table_index_column] = str
+    sep=',' if args.color_table.endswith(".csv") else '\t'
+    color_info = pd.read_csv(args.color_table, sep=sep, header=0, index_col=args.color_table_index_column, dtype=cdty)
+    if args.input_rgb_uint8 or color_info[rgb].max().max() > 2:
+        for c in rgb:
+            color_info[c] = color_info[c] / 255
+    logging.info(f"Read color table ({color_info.shape[0]})")
+    lut_index, lut = color_lut(color_info, rgb)
+    bg = args.background
+    bg = [ np.uint8(int(bg[i:i+2], 16) ) for i in [4,2,0] ] # hex is RGB, tiles are BGR
+
+    loader = BlockIndexedLoader(args.input, args.xmin, args.xmax, args.ymin, args.ymax, args.full, not args.org_coord)
+    width = int((loader.xmax - loader.xmin + 1)/args.plot_um_per_pixel)
+    height= int((loader.ymax - loader.ymin + 1)/args.plot_um_per_pixel)
+    logging.info(f"Finest level size {height} x {width}")
+
+    info = {"um_per_pixel": args.plot_um_per_pixel, "xmin": loader.xmin, "ymin": loader.ymin, \
+            "offset_x": loader.meta.get('OFFSET_X', 0), "offset_y": loader.meta.get('OFFSET_Y', 0)}
+    writer = TilePyramidWriter(args.output, height, width, len(rgb), args.tile_size, args.tile_format, bg, info=info)
+    acc = TileAccumulator(writer, len(rgb), mean_renderer(bg))
+    logging.info(f"{writer.n_level} levels")
+    for df in loader:
+        if df.shape[0] == 0:
+            continue
+        if args.plot_top:
+            val = mix_colors(lut_index.get_indexer(df['K1'].values), np.ones(df.shape[0]), lut)
+        else:
+            topk = range(1,loader.meta['TOPK']+1)
+            ids = np.column_stack([lut_index.get_indexer(df['K'+str(k)].values) for k in topk])
+            val = mix_colors(ids, df[['P'+str(k) for k in topk]].values, lut)
+        x = np.clip(((df.X.values - loader.xmin) / args.plot_um_per_pixel).astype(int),0,width-1)
+        y = np.clip(((df.Y.values - loader.ymin) / args.plot_um_per_pixel).astype(int),0,height-1)
+        acc.add(x, y, val)
+        acc.flush(stream_frontier(loader.meta, df, loader.xmin, loader.ymin, args.plot_um_per_pixel))
+        logging.info(f"Reading pixels... {x[-1]}, {y[-1]}, {len(x)}")
+    acc.close()
+    logging.info(f"Finished\n{os.path.join(args.output, 'manifest.json')}")
+
+if __name__ == "__main__":
+    plot_pyramid(sys.argv[1:])
@@ -3,7 +3,8 @@ Transform into factor space based on input model
 Model contains gene names and either Dirichlet parameters (or probabilities for more general use?)
 Input pixel level data will be grouped into (overlapping) hexagons
 '''
-import sys, os, copy, gzip, time, logging, pickle, argparse
+import sys, os, copy, gzip, time, logging, pickle, argparse, multiprocessing
+from collections import deque
 import numpy as np
 import pandas as pd
 import random as rng
@@ -13,7 +14,25 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from sklearn.decomposition._online_lda_fast import _dirichlet_expectation_2d
 
 from ficture.loaders.pixel_to_unit_loader import PixelToUnit
-from ficture.utils.utilt import init_latent_vars
+from ficture.utils.utilt import init_latent_vars, write_rows, ordered_map
+
+# Model and normalization parameters shared by the transform workers, set once per process
+_worker = {}
+
+def _init_worker(param):
+    _worker.clear()
+    _worker.update(param)
+
+def _transform_chunk(mtx):
+    if _worker["log_norm_size_factor"]:
+        rsum = mtx.sum(axis=1) / _worker["unit_sum_mean"]
+        mtx = mtx / rsum.reshape((-1,1))
+        mtx.data = np.log(mtx.data + 1) / _worker["scale_const"]
+        mtx = mtx.tocsr()
+    elif _worker["log_norm"]:
+        mtx = normalize(mtx, norm='l1', axis=1)
+        mtx.data = np.log(mtx.data + 1) / _worker["scale_const"]
+    return _worker["model"].transform(mtx)
 
 def transform(_args):
 
@@ -29,6 +48,7 @@ def transform(_args):
     parser.add_argument('--min_ct_per_unit', type=int, default=20, help='')
     parser.add_argument('--mu_scale', type=float, default=26.67, help='Coordinate to um translate')
     parser.add_argument('--thread', type=int, default=-1, help='')
+    parser.add_argument('--n_process', type=int, default=1, help='Number of processes transforming chunks in parallel while the next chunk is read, each process runs a single threaded E-step when > 1')
     parser.add_argument('--n_move', type=int, default=3, help='')
     parser.add_argument('--hex_width', type=float, default=24, help='')
     parser.add_argument('--hex_radius', type=float, default=-1, help='')
@@ -132,50 +152,51 @@ def transform(_args):
                 xy_lattice=(not args.xy_median))
 
     # Transform
-    post_count = np.zeros((K, M))
+    post_count = np.zeros((M, K))
     n_unit = 0
     n_batch= 0
     oheader = ["unit",key,"x","y","topK","topP"]+[str(x) for x in range(K)]
+    fmt = "\t".join(["%s", "%d", f"%.{args.precision}f", f"%.{args.precision}f", "%d"] + ["%.3e"] * (K+1))
     out_f = args.output + ".fit_result.tsv.gz"
+    param = {"model":model, "log_norm":args.log_norm, \
+             "log_norm_size_factor":args.log_norm_size_factor, \
+             "scale_const":scale_const, "unit_sum_mean":unit_sum_mean}
+    if args.n_process > 1:
+        model.n_jobs = 1
+    # Hexagons are built in this process while workers transform previous chunks
+    pending = deque()
+    def read_chunks():
+        n_read = 0
+        while batch_obj.read_chunk(min_size=b_size):
+            pending.append((batch_obj.brc, batch_obj.mtx))
+            yield batch_obj.mtx
+            n_read += batch_obj.mtx.shape[0]
+            if (args.debug > 0) and (n_read >= args.debug):
+                break
+    t0 = time.time()
+    last_batch = np.zeros(0, dtype=np.int64)
     with gzip.open(out_f, 'wt') as wf:
         wf.write('\t'.join(oheader) + '\n')
-    t0 = time.time()
-    last_batch = set()
-    while batch_obj.read_chunk(min_size=b_size):
-        if args.log_norm_size_factor:
-            rsum = batch_obj.mtx.sum(axis=1) / unit_sum_mean
-            mtx = batch_obj.mtx / rsum.reshape((-1,1))
-            mtx.data = np.log(mtx.data + 1) / scale_const
-            mtx = mtx.tocsr()
-        elif args.log_norm:
-            mtx = normalize(batch_obj.mtx, norm='l1', axis=1)
-            mtx.data = np.log(mtx.data + 1) / scale_const
-        else:
-            mtx = batch_obj.mtx
-        theta = model.transform(mtx)
-        post_count += np.array(theta.T @ batch_obj.mtx)
-        n_batch += 1
-        n_unit  += theta.shape[0]
-        t1 = time.time() - t0
-        batch_obj.brc['topK'] = np.argmax(theta, axis = 1)
-        batch_obj.brc['topP'] = theta.max(axis = 1)
-        batch_obj.brc = pd.concat([batch_obj.brc, pd.DataFrame(theta, columns=[str(x) for x in range(K)] )], axis=1)
-        batch_obj.brc['x'] = batch_obj.brc.x.map(lambda x : f"{x:.{args.precision}f}")
-        batch_obj.brc['y'] = batch_obj.brc.y.map(lambda x : f"{x:.{args.precision}f}")
-        batch_obj.brc.rename(columns = {'hex_id':'unit'}, inplace=True)
-        if len(last_batch) > 0:
-            batch_obj.brc.drop(index = batch_obj.brc.index[batch_obj.brc.unit.isin(last_batch)], inplace=True)
-        last_batch = set(batch_obj.brc.unit.values)
-        batch_obj.brc[oheader].to_csv(out_f, sep='\t', index=False, header=False, float_format='%.3e', mode='a', compression={"method":"gzip"})
-        logging.info(f"Transformed {n_batch} batches with total {n_unit} units, {t1/60:2f}min")
-        if (args.debug > 0) and (n_unit >= args.debug):
-            break
+        for theta in ordered_map(_transform_chunk, read_chunks(), thread=args.n_process, initializer=_init_worker, initargs=(param,), mp_context=multiprocessing.get_context("fork")):
+            brc, mtx = pending.popleft()
+            post_count += mtx.T @ theta
+            n_batch += 1
+            n_unit  += theta.shape[0]
+            t1 = time.time() - t0
+            # Units overlapping with the previous batch are already written
+            kept = ~np.isin(brc.hex_key.values, last_batch)
+            last_batch = brc.hex_key.values
+            theta = theta[kept, :]
+            write_rows(wf, fmt, [brc.hex_id.values[kept], brc[key].values[kept], \
+                brc.x.values[kept], brc.y.values[kept], \
+                np.argmax(theta, axis = 1), theta.max(axis = 1)] + list(theta.T))
+            logging.info(f"Transformed {n_batch} batches with total {n_unit} units, {t1/60:2f}min")
 
     out_f = args.output + ".posterior.count.tsv.gz"
     pd.concat([pd.DataFrame({'gene': feature_kept}),\
-            pd.DataFrame(post_count.T, dtype='float64',\
+            pd.DataFrame(post_count, dtype='float64',\
                             columns = factor_header)],\
                 axis = 1).to_csv(out_f, sep='\t', index=False, float_format='%.2f', compression={"method":"gzip"})
 
-if __name__ is '__main__':
+if __name__ == '__main__':
     transform(sys.argv[1:])
@@ -0,0 +1,176 @@
+### Random access to sorted, bgzip compressed pixel files without tabix
+### The index records, for every BGZF block, where the first line starting
+### in the block is (compressed block offset, offset within the block) and
+### the (sequence, position) key of that line
+
+import os, gzip, zlib, struct, logging
+import numpy as np
+import pandas as pd
+
+def is_bgzf(file):
+    with open(file, 'rb') as rf:
+        head = rf.read(18)
+    return len(head) == 18 and head[:4] == b'\x1f\x8b\x08\x04' and head[12:14] == b'BC'
+
+def bgzf_blocks(file):
+    """Yield (compressed offset, uncompressed data) of each BGZF block"""
+    with open(file, 'rb') as rf:
+        while True:
+            offset = rf.tell()
+            head = rf.read(12)
+            if len(head) < 12:
+                break
+            if head[:4] != b'\x1f\x8b\x08\x04':
+                raise ValueError("Not a BGZF file")
+            xlen = struct.unpack('<H', head[10:12])[0]
+            extra = rf.read(xlen)
+            bsize = -1
+            i = 0
+            while i < xlen:
+                slen = struct.unpack('<H', extra[i+2:i+4])[0]
+                if extra[i:i+2] == b'BC':
+                    bsize = struct.unpack('<H', extra[i+4:i+6])[0]
+                i += 4 + slen
+            if bsize < 0:
+                raise ValueError("Not a BGZF file")
+            data = rf.read(bsize - xlen - 11)
+            yield offset, zlib.decompress(data[:-8], -15)
+
+def _line_key(line, seq_col, pos_col):
+    wd = line.split(b'\t')
+    try:
+        return wd[seq_col].decode(), float(wd[pos_col])
+    except (IndexError, ValueError):
+        return None
+
+def build_bgzf_index(file, pos_col, seq_col=0):
+    '''
+    Scan the file once, return a dataframe with columns
+    block (compressed offset), offset (within the uncompressed block), seq, pos
+    '''
+    rec = []
+    at_line_start = True
+    pending = None # A line starting in a previous block
+    for block, data in bgzf_blocks(file):
+        if len(data) == 0:
+            continue
+        if pending is not None:
+            nl = data.find(b'\n')
+            pending[2] += data if nl < 0 else data[:nl]
+            if nl < 0:
+                continue
+            key = _line_key(pending[2], seq_col, pos_col)
+            if key is not None:
+                rec.append([pending[0], pending[1], *key])
+            pending = None
+        else:
+            st = 0 if at_line_start else data.find(b'\n') + 1
+            if at_line_start or st > 0:
+                nl = data.find(b'\n', st)
+                if nl < 0:
+                    pending = [block, st, data[st:]]
+                else:
+                    key = _line_key(data[st:nl], seq_col, pos_col)
+                    if key is not None:
+                        rec.append([block, st, *key])
+        at_line_start = data.endswith(b'\n')
+    return pd.DataFrame(rec, columns = ["block", "offset", "seq", "pos"])
+
+def load_bgzf_index(file, pos_col, seq_col=0):
+    """Read the index stored beside the file, build and store it if missing or outdated"""
+    f = file + f".{seq_col}_{pos_col}.fidx"
+    if os.path.exists(f) and os.path.getmtime(f) >= os.path.getmtime(file):
+        return pd.read_csv(f, sep='\t', dtype={"seq":str})
+    logging.info(f"Building index for {file}")
+    index = build_bgzf_index(file, pos_col, seq_col)
+    try:
+        index.to_csv(f, sep='\t', index=False)
+    except OSError:
+        logging.warning(f"Cannot store index as {f}")
+    return index
+
+class RegionReader:
+    '''
+    File-like object streaming the lines (without the header) of a file sorted by
+    (seq, pos) that fall in a list of regions (seq, start, end), start and end inclusive.
+    Only the BGZF blocks overlapping the regions are decompressed,
+    a plain gzip file is scanned from the beginning
+    '''
+    def __init__(self, file, regions, pos_col, seq_col=0) -> None:
+        self.file = file
+        self.regions = [(str(s), float(st), float(ed)) for s, st, ed in regions]
+        self.pos_col = pos_col
+        self.seq_col = seq_col
+        self.index = None
+        if is_bgzf(file):
+            self.index = load_bgzf_index(file, pos_col, seq_col)
+        else:
+            logging.warning(f"{file} is not bgzip compressed, will scan the whole file for each region")
+        self.lines = self._gen_lines()
+        self.buffer = ""
+
+    def _start(self, seq, st):
+        """
+        Virtual offset of a line at or before the first line of the region,
+        None to read from the beginning of the file (after the header)
+        """
+        if self.index is None:
+            return None
+        indx = np.where(self.index.seq.eq(seq).values)[0]
+        # A sequence without entries lies within blocks whose first line belongs to
+        # another sequence, its position in the file is unknown
+        if len(indx) == 0:
+            return None
+        j = indx[self.index.pos.values[indx] < st]
+        if len(j) > 0:
+            j = j[-1]
+        elif indx[0] > 0:
+            j = indx[0] - 1
+        else: # The first block (starting with the header) has no entry
+            return None
+        return self.index.block.iloc[j], self.index.offset.iloc[j]
+
+    def _gen_lines(self):
+        for seq, st, ed in self.regions:
+            vo = self._start(seq, st)
+            raw = open(self.file, 'rb')
+            if vo is not None:
+                raw.seek(vo[0])
+            with raw, gzip.GzipFile(fileobj=raw) as rf:
+                if vo is None:
+                    _ = rf.readline()
+                else:
+                    _ = rf.read(vo[1])
+                seen = False
+                for line in rf:
+                    key = _line_key(line, self.seq_col, self.pos_col)
+                    if key is None:
+                        continue
+                    if key[0] != seq:
+                        if seen:
+                            break
+                        continue
+                    seen = True
+                    if key[1] > ed:
+                        break
+                    if key[1] >= st:
+                        yield line.decode()
+
+    def read(self, size=-1):
+        out = [self.buffer]
+        n = len(self.buffer)
+        while size < 0 or n < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            out.append(line)
+            n += len(line)
+        out = ''.join(out)
+        if size < 0 or len(out) <= size:
+            self.buffer = ""
+            return out
+        self.buffer = out[size:]
+        return out[:size]
+
+    def __iter__(self):
+        return self.lines
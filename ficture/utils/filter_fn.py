@@ -1,21 +1,178 @@
 import sys, os, warnings, copy
 import numpy as np
 import pandas as pd
-import sklearn.neighbors
-import sklearn.mixture
+import scipy.ndimage
 
 from ficture.utils.hexagon_fn import pixel_to_hex, hex_to_pixel
 
+class HistGaussianMixture:
+    '''
+    1D Gaussian mixture fitted by weighted EM on the centers of a fine histogram
+    The histogram is a sufficient statistic that can be accumulated across chunks
+    and windows with partial_fit, then fit() runs EM on it (independent of the
+    number of observations). Mimics the parts of sklearn.mixture.GaussianMixture
+    used for density filtering (means_, predict)
+    '''
+    def __init__(self, n_components=2, bin_width=0.002, vmin=-3, vmax=7, max_iter=1000, tol=1e-8, reg_covar=1e-6) -> None:
+        self.n_components = n_components
+        self.bin_width = bin_width
+        self.max_iter = max_iter
+        self.tol = tol
+        self.reg_covar = reg_covar
+        self.n_bins = int(np.ceil((vmax - vmin) / bin_width))
+        self.vmin = vmin
+        self.centers = vmin + (np.arange(self.n_bins) + .5) * bin_width
+        self.hist = np.zeros(self.n_bins)
+
+    def partial_fit(self, X):
+        """Add observations to the histogram, values outside of the range are clipped to the boundary bins"""
+        indx = np.clip(((np.asarray(X).ravel() - self.vmin) / self.bin_width).astype(int), 0, self.n_bins - 1)
+        self.hist += np.bincount(indx, minlength=self.n_bins)
+        return self
+
+    def fit(self, X=None):
+        """Fit the mixture to the accumulated histogram (after adding X if provided)"""
+        if X is not None:
+            self.partial_fit(X)
+        indx = self.hist > 0
+        w = self.hist[indx] / self.hist.sum()
+        x = self.centers[indx]
+        K = self.n_components
+        cdf = np.cumsum(w)
+        mu = x[np.clip(np.searchsorted(cdf, (np.arange(K) + .5) / K), 0, len(x) - 1)].astype(float)
+        var = np.ones(K) * (w @ (x - w @ x)**2 + self.reg_covar)
+        pi = np.ones(K) / K
+        llk = -np.inf
+        for it in range(self.max_iter):
+            logp = np.log(pi) - .5 * np.log(2 * np.pi * var) - .5 * (x[:, None] - mu[None, :])**2 / var
+            mx = logp.max(axis = 1, keepdims = True)
+            p = np.exp(logp - mx)
+            s = p.sum(axis = 1, keepdims = True)
+            new_llk = w @ (np.log(s.ravel()) + mx.ravel())
+            r = w[:, None] * p / s
+            nk = r.sum(axis = 0) + 10 * np.finfo(float).eps
+            pi = nk / nk.sum()
+            mu = (r * x[:, None]).sum(axis = 0) / nk
+            var = (r * (x[:, None] - mu[None, :])**2).sum(axis = 0) / nk + self.bin_width**2 / 12 + self.reg_covar
+            if new_llk - llk < self.tol:
+                break
+            llk = new_llk
+        self.n_iter_ = it + 1
+        self.weights_ = pi
+        self.means_ = mu.reshape((-1, 1))
+        self.covariances_ = var.reshape((-1, 1, 1))
+        return self
+
+    def predict(self, X):
+        x = np.asarray(X).ravel()
+        mu = self.means_.ravel()
+        var = self.covariances_.ravel()
+        logp = np.log(self.weights_) - .5 * np.log(var) - .5 * (x[:, None] - mu[None, :])**2 / var
+        return logp.argmax(axis = 1)
+
+
+class AnchorLatticeIndex:
+    '''
+    Exact test of whether points are within radius of any anchor point,
+    for anchors lying on a square lattice with spacing step (e.g. rounded to precision_um)
+    Replace a nearest neighbor tree by lookups into the lattice:
+    the distance from each lattice node to the nearest anchor is computed once,
+    a point is surely kept (dropped) if its nearest node is closer (further)
+    than radius minus (plus) half the node diagonal, only the remaining points
+    near the boundary are checked against the anchors in a thin ring of nodes
+    '''
+    def __init__(self, pts, radius, step) -> None:
+        self.step = step
+        self.R = radius / step
+        ij = np.around(np.asarray(pts) / step).astype(np.int64)
+        if not np.allclose(ij * step, pts):
+            raise ValueError("Anchor points are not on the lattice")
+        pad = int(np.ceil(self.R + 1)) * 2
+        self.origin = ij.min(axis = 0) - pad
+        shape = ij.max(axis = 0) - self.origin + pad + 1
+        self.anchor = np.zeros(shape, dtype=bool)
+        self.anchor[ij[:, 0] - self.origin[0], ij[:, 1] - self.origin[1]] = True
+        dist = scipy.ndimage.distance_transform_edt(~self.anchor)
+        self.sure = dist < self.R - np.sqrt(2) / 2
+        self.near = dist < self.R + np.sqrt(2) / 2
+        r = int(np.ceil(self.R + 1))
+        dx, dy = np.meshgrid(np.arange(-r, r+1), np.arange(-r, r+1), indexing='ij')
+        d = np.sqrt(dx**2 + dy**2)
+        indx = (d >= self.R - np.sqrt(2) / 2) & (d < self.R + np.sqrt(2) / 2)
+        self.ring = np.column_stack([dx[indx], dy[indx]])
+
+    def query(self, x, y):
+        """Return a boolean array, True if the point (x, y) is within radius of an anchor point"""
+        qx = np.asarray(x) / self.step - self.origin[0]
+        qy = np.asarray(y) / self.step - self.origin[1]
+        gx = np.around(qx).astype(np.int64)
+        gy = np.around(qy).astype(np.int64)
+        inside = (gx >= 0) & (gy >= 0) & (gx < self.anchor.shape[0]) & (gy < self.anchor.shape[1])
+        kept = np.zeros(len(qx), dtype=bool)
+        kept[inside] = self.sure[gx[inside], gy[inside]]
+        amb = np.zeros(len(qx), dtype=bool)
+        amb[inside] = self.near[gx[inside], gy[inside]] & ~kept[inside]
+        amb = np.where(amb)[0]
+        for dx, dy in self.ring:
+            if len(amb) == 0:
+                break
+            ax = gx[amb] + dx
+            ay = gy[amb] + dy
+            hit = self.anchor[ax, ay] & ((ax - qx[amb])**2 + (ay - qy[amb])**2 < self.R**2)
+            kept[amb[hit]] = True
+            amb = amb[~hit]
+        return kept
+
+def fit_log_density_mixture(v, hex_area, args, hist_mixture=False):
+    '''
+    v: log10 transformed molecule count per hexagon (or a HistGaussianMixture with accumulated histogram)
+    Return the fitted model, the label of the dense component, and the mean densities of the
+    dense and the next densest component (per squared um)
+    '''
+    # 1st try: fit a 2-component mixture model to log transformed density
+    if isinstance(v, HistGaussianMixture):
+        gm = v
+        gm.n_components = 2
+        gm.fit()
+    elif hist_mixture:
+        gm = HistGaussianMixture(n_components=2).fit(v)
+    else:
+        import sklearn.mixture
+        v = np.asarray(v).reshape(-1, 1)
+        gm = sklearn.mixture.GaussianMixture(n_components=2, random_state=0).fit(v)
+    lab_keep = np.argmax(gm.means_.squeeze())
+    m0=(10**gm.means_.squeeze()[lab_keep])/hex_area
+    m1=(10**gm.means_.squeeze()[1-lab_keep])/hex_area
+    print(f"1st: log, 2 component. {m0:.3f} v.s. {m1:.3f}")
+    # If it does not seem right
+    # 2nd try: fit a 3-component mixture model to log transformed density
+    if m1 > m0 * 0.5 or m0 < args.min_abs_mol_density_squm_dense:
+        if isinstance(gm, HistGaussianMixture):
+            gm.n_components = 3
+            gm.fit()
+        else:
+            import sklearn.mixture
+            gm = sklearn.mixture.GaussianMixture(n_components=3, random_state=0).fit(v)
+        lab_rank = np.argsort(gm.means_.squeeze())
+        lab_keep = lab_rank[-1]
+        m0=(10**gm.means_.squeeze()[lab_keep])/hex_area
+        m1=(10**gm.means_.squeeze()[lab_rank[1]])/hex_area
+        m2=(10**gm.means_.squeeze()[lab_rank[0]])/hex_area
+        print(f"2nd: log, 3 component. {m0:.3f} v.s. {m1:.3f} & {m2:.3f}")
+    return gm, lab_keep, m0, m1
 
-def filter_by_density_mixture(df, key, radius, n_move, args):
+def filter_by_density_mixture(df, key, radius, n_move, args, model=None):
     '''
     df: dataframe with columns X, Y, and key, (X, Y) are in um
+    model: optional output of fit_log_density_mixture fitted once for the whole data,
+        if provided the mixture model is not refitted for each offset
     Return a dataframe with kept anchor point coordinates x, y
     '''
     pt = pd.DataFrame()
     m0v=[]
     m1v=[]
     hex_area = radius**2 * np.sqrt(3) * 3 / 2
+    hist_mixture = getattr(args, "hist_mixture", False)
     for i in range(n_move):
         for j in range(n_move):
             cnt = pd.DataFrame()
@@ -28,32 +185,17 @@ def filter_by_density_mixture(df, key, radius, n_move, args):
             if args.hard_threshold > 0:
                 cnt['det'] = cnt[key] > hex_area * args.hard_threshold
             else:
-                vorg = cnt[key].values
-                if len(vorg) > args.max_npts_to_fit_model:
-                    vorg = np.random.choice(vorg, int(args.max_npts_to_fit_model), replace=False)
-                print(f"[{i}, {j}], {len(vorg)} units")
-                # 1st try: fit a 2-component mixture model to log transformed density
-                v = np.log10(vorg).reshape(-1, 1)
-                gm = sklearn.mixture.GaussianMixture(n_components=2, random_state=0).fit(v)
-                lab_keep = np.argmax(gm.means_.squeeze())
-                cnt['det'] = gm.predict(v) == lab_keep
-                m0=(10**gm.means_.squeeze()[lab_keep])/hex_area
-                m1=(10**gm.means_.squeeze()[1-lab_keep])/hex_area
+                if model is None:
+                    vorg = cnt[key].values
+                    if len(vorg) > args.max_npts_to_fit_model and not hist_mixture:
+                        vorg = np.random.choice(vorg, int(args.max_npts_to_fit_model), replace=False)
+                    print(f"[{i}, {j}], {len(vorg)} units")
+                    gm, lab_keep, m0, m1 = fit_log_density_mixture(np.log10(vorg), hex_area, args, hist_mixture)
+                else:
+                    gm, lab_keep, m0, m1 = model
+                cnt['det'] = gm.predict(np.log10(cnt[key].values).reshape(-1, 1)) == lab_keep
                 kept_min = cnt.loc[cnt.det.eq(True), key].min() / hex_area
-                print(f"1st: log, 2 component. {m0:.3f} v.s. {m1:.3f}, kept min density {kept_min:.3f}")
-                # If it does not seem right
-                # 2nd try: fit a 3-component mixture model to log transformed density
-                if m1 > m0 * 0.5 or m0 < args.min_abs_mol_density_squm_dense:
-                    v = np.log10(vorg)
-                    gm = sklearn.mixture.GaussianMixture(n_components=3, random_state=0).fit(v)
-                    lab_rank = np.argsort(gm.means_.squeeze())
-                    lab_keep = lab_rank[-1]
-                    cnt['det'] = gm.predict(v) == lab_keep
-                    m0=(10**gm.means_.squeeze()[lab_keep])/hex_area
-                    m1=(10**gm.means_.squeeze()[lab_rank[1]])/hex_area
-                    m2=(10**gm.means_.squeeze()[lab_rank[0]])/hex_area
-                    kept_min = cnt.loc[cnt.det.eq(True), key].min() / hex_area
-                    print(f"2nd: log, 3 component. {m0:.3f} v.s. {m1:.3f} & {m2:.3f}, kept min density {kept_min:.3f}")
+                print(f"[{i}, {j}], kept min density {kept_min:.3f}")
                 # # 3rd try: fit a 2-component mixture model to density of original scale
                 # if m1 > m0 * 0.5 or m0 < args.min_abs_mol_density_squm_dense:
                 #     v = vorg.reshape(-1, 1)
@@ -34,6 +34,15 @@ def hex_to_pixel(x,y,size,offset_x=0,offset_y=0):
     pty = size * 3/2 * (y-offset_y)
     return ptx, pty
 
+def hex_key(offset, x, y):
+    '''
+    Integer key of hexagons from the sliding offset index and integer hexagon coordinates,
+    unique for |x|, |y| < 2^23
+    '''
+    x = np.asarray(x, dtype=np.int64) + (1 << 23)
+    y = np.asarray(y, dtype=np.int64) + (1 << 23)
+    return (np.asarray(offset, dtype=np.int64) << 48) | (x << 24) | y
+
 def collapse_to_hex(df, hex_width = -1, radius = -1, n_move = 1, key = "Count", ):
     if hex_width > 0:
         radius = hex_width / np.sqrt(3)
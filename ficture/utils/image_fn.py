@@ -1,9 +1,135 @@
 import copy
 import numpy as np
 import pandas as pd
-import sklearn.neighbors
 from scipy.sparse import *
-import matplotlib as mpl
+# matplotlib, sklearn, PIL and cv2 are imported where used
+
+#########################################################
+############# Color kernel shared by the plot commands
+#########################################################
+def color_lut(color_info, rgb):
+    '''
+    Color table as an array for integer coded names
+    Return the name index and a (K+1) x len(rgb) array, the last row (for unknown names) is zero
+    '''
+    index = pd.Index(color_info.index)
+    lut = np.zeros((len(index) + 1, len(rgb)), dtype=np.float32)
+    lut[:-1, :] = color_info.loc[:, rgb].values
+    return index, lut
+
+def cmap_lut(name, n=256):
+    '''
+    Color table (n+1) x 3 of a matplotlib colormap sampled at n levels, the last row is zero
+    '''
+    import matplotlib as mpl
+    lut = np.zeros((n + 1, 3), dtype=np.float32)
+    lut[:-1, :] = mpl.colormaps[name].resampled(n)(np.arange(n))[:, :3]
+    return lut
+
+def cmap_ids(v, n=256):
+    '''
+    Colormap level of values in [0, 1], as matplotlib does for a colormap with n levels
+    '''
+    return np.clip((np.asarray(v, dtype=float) * n).astype(int), 0, n - 1)
+
+def mix_colors(ids, probs, lut):
+    '''
+    Probability weighted sum of colors (N x C, float32)
+    ids: N x k rows of lut (-1 for unknown, the last row of lut should be zero), probs: N x k
+    If ids is None, probs are the loadings of all factors (N x K) in the order of lut
+    '''
+    if ids is None:
+        return np.asarray(probs, dtype=np.float32) @ lut[:probs.shape[1]]
+    ids = np.asarray(ids).reshape((len(ids), -1))
+    probs = np.asarray(probs).reshape((len(ids), -1))
+    val = np.zeros((ids.shape[0], lut.shape[1]), dtype=np.float32)
+    for j in range(ids.shape[1]):
+        val += lut[ids[:, j]] * probs[:, j].reshape((-1, 1))
+    return val
+
+def to_dtype(val, dtype=np.uint8, alpha=None, premultiply=False):
+    '''
+    Scale colors from [0, 1] to the range of dtype (uint8 or uint16),
+    append alpha as the last channel if given, premultiply the colors by alpha if asked
+    '''
+    vmax = np.iinfo(dtype).max
+    if alpha is not None:
+        alpha = np.clip(np.asarray(alpha, dtype=np.float32).reshape((-1, 1)), 0, 1)
+        if premultiply:
+            val = val * alpha
+        val = np.hstack([val, alpha])
+    return np.clip(np.around(val * vmax), 0, vmax).astype(dtype)
+
+def render_pixels(pixel, ids, probs, lut, shape, dtype=np.uint8, background=None, alpha=None, premultiply=False):
+    '''
+    Image (height x width x C) with the mixed colors (see mix_colors) of the pixels
+    at flat indices pixel (y * width + x), other pixels are set to background
+    '''
+    val = to_dtype(mix_colors(ids, probs, lut), dtype, alpha, premultiply)
+    img = np.zeros((shape[0] * shape[1], val.shape[1]), dtype=dtype)
+    if background is not None:
+        img[:] = background
+    img[pixel] = val
+    return img.reshape((shape[0], shape[1], val.shape[1]))
+
+def save_image(file, img):
+    '''
+    Save an RGB(A) image, uint16 images are written as 16-bit TIFF/PNG
+    '''
+    if img.dtype == np.uint8:
+        from PIL import Image
+        Image.fromarray(img).save(file)
+        return
+    import cv2
+    cv2.imwrite(file, img[:, :, [2, 1, 0] + list(range(3, img.shape[2]))])
+
+#########################################################
+############# Accumulate colors of streamed pixels
+#########################################################
+
+def topk_entries(df, topk, index, pcut=0):
+    '''
+    Non-zero entries (row, channel, probability) from the columns K1..Ktopk, P1..Ptopk,
+    channel is the position of the factor in index. Factors not in index
+    and probabilities <= pcut are dropped
+    '''
+    channel = np.stack([index.get_indexer(df['K'+str(k)].values) for k in range(1, topk+1)], axis=1).ravel()
+    prob = np.stack([df['P'+str(k)].values for k in range(1, topk+1)], axis=1).ravel()
+    row = np.repeat(np.arange(df.shape[0]), topk)
+    kept = (channel >= 0) & (prob > pcut)
+    return row[kept], channel[kept], prob[kept]
+
+class PixelAccumulator:
+    '''
+    Sum and count planes of an image, input pixels falling into the same
+    image pixel (within or across chunks) are averaged when rendered
+    '''
+    def __init__(self, height, width, channel=3):
+        self.height = height
+        self.width = width
+        self.channel = channel
+        self.sum = np.zeros((height * width, channel), dtype=np.float32)
+        self.count = np.zeros(height * width, dtype=np.float32)
+
+    def add(self, x, y, val):
+        if len(x) == 0:
+            return
+        u, inv = np.unique(np.asarray(y, dtype=np.int64) * self.width + x, return_inverse=True)
+        self.count[u] += np.bincount(inv, minlength=len(u))
+        for c in range(self.channel):
+            self.sum[u, c] += np.bincount(inv, weights=val[:, c], minlength=len(u))
+
+    def render(self, background=None, dtype=np.uint8):
+        '''
+        Mean color of each pixel (scaled from [0, 1] to the range of dtype)
+        '''
+        img = np.zeros((self.height * self.width, self.channel), dtype=dtype)
+        if background is not None:
+            img[:] = background
+        kept = self.count > 0
+        img[kept] = to_dtype(self.sum[kept] / self.count[kept].reshape((-1, 1)), dtype)
+        return img.reshape((self.height, self.width, self.channel))
+
 
 #########################################################
 ############# Whole data in memory, write image by row
@@ -30,7 +156,8 @@ class ImgRowIterator:
             self.buffer_index = np.arange(self.N)[indx]
         assert len(self.buffer_index) > 1, "Input coordinates are ouside input range"
         if self.radius >= 1:
-            self.ref = sklearn.neighbors.BallTree(self.pts[self.buffer_index, :])
+            from sklearn.neighbors import BallTree
+            self.ref = BallTree(self.pts[self.buffer_index, :])
         print(f"Initialized buffer for block {self.buffer_lower} - {self.buffer_upper}")
         return
 
@@ -76,7 +203,8 @@ class ImgRowIterator:
             indx = (self.pts[:, 1] >= self.buffer_lower) & (self.pts[:, 1] <= self.buffer_upper)
             self.buffer_index = np.arange(self.N)[indx]
         if len(self.buffer_index) > 0:
-            self.ref = sklearn.neighbors.BallTree(self.pts[self.buffer_index, :])
+            from sklearn.neighbors import BallTree
+            self.ref = BallTree(self.pts[self.buffer_index, :])
             return
 
 
@@ -86,6 +214,19 @@ class ImgRowIterator:
 #########################################################
 ############# Stream in data, write image by row
 #########################################################
+def _sort_buffer(pts, mtx):
+    """Sort the buffered pixels by row, return y, x and the colors in the same order"""
+    y = pts.y.values.astype(int)
+    order = np.argsort(y, kind='stable')
+    return y[order], pts.x.values.astype(int)[order], mtx[order]
+
+def _buffer_row(row_y, row_x, mtx, current, width, dtype):
+    """One image row (flattened width x 3) from the buffered pixels sorted by row"""
+    st, ed = np.searchsorted(row_y, [current, current + 1])
+    out = np.zeros((width, 3), dtype = dtype)
+    out[row_x[st:ed]] = mtx[st:ed]
+    return out.ravel()
+
 class ImgRowIterator_stream:
     def __init__(self, reader, w, h, cmtx,\
                  xmin = 0, ymin = 0, pixel_size = 1, \
@@ -110,6 +251,8 @@ class ImgRowIterator_stream:
         self.data_header = ["x", "y"] + self.feature_header
         self.pts = pd.DataFrame([], columns = ["x", "y"])
         self.mtx = np.zeros((0, 3))
+        self.row_y = np.zeros(0, dtype=int)
+        self.row_x = np.zeros(0, dtype=int)
         self.leftover = pd.DataFrame([], columns = self.data_header)
         while self.buffer_y < 0 and self.file_is_open:
             self.file_is_open = self.read_chunk()
@@ -134,14 +277,7 @@ class ImgRowIterator_stream:
         while self.buffer_y < self.current and self.file_is_open:
             # Read more data
             self.file_is_open = self.read_chunk()
-        iv = np.arange(self.pts.shape[0])[self.pts.y.eq(self.current)]
-        out = np.zeros(self.width * 3, dtype = self.dtype)
-        if len(iv) == 0:
-            return out
-        for c in range(3):
-            for i in iv:
-                out[self.pts.x.iloc[i]*3+c] = self.mtx[i, c]
-        return out
+        return _buffer_row(self.row_y, self.row_x, self.mtx, self.current, self.width, self.dtype)
 
     def read_chunk(self):
         try:
@@ -187,6 +323,7 @@ class ImgRowIterator_stream:
             self.mtx = np.clip(np.around(np.array(\
                     chunk.loc[:, self.feature_header]) @ self.cmtx * 255),\
                     0, 255).astype(self.dtype)
+        self.row_y, self.row_x, self.mtx = _sort_buffer(self.pts, self.mtx)
         return 1
 
 
@@ -222,6 +359,8 @@ class ImgRowIterator_stream_singlechannel:
         self.data_header = ["x", "y", self.key]
         self.pts = pd.DataFrame([], columns = ["x", "y"])
         self.mtx = np.zeros((0, 3))
+        self.row_y = np.zeros(0, dtype=int)
+        self.row_x = np.zeros(0, dtype=int)
         self.leftover = pd.DataFrame([], columns = self.data_header)
         while self.buffer_y < 0 and self.file_is_open:
             self.file_is_open = self.read_chunk()
@@ -229,6 +368,7 @@ class ImgRowIterator_stream_singlechannel:
             print("Input does not contain pixels in range")
             return
         print(f"Image size (w x h): {self.width} x {self.height}")
+        import matplotlib as mpl
         if self.cmap not in mpl.colormaps():
             self.cmap = "plasma"
         y0, y1 = self.pts.y.min(), self.pts.y.max()
@@ -248,14 +388,7 @@ class ImgRowIterator_stream_singlechannel:
         while self.buffer_y < self.current and self.file_is_open:
             # Read more data
             self.file_is_open = self.read_chunk()
-        iv = np.arange(self.pts.shape[0])[self.pts.y.eq(self.current)]
-        out = np.zeros(self.width * 3, dtype = self.dtype)
-        if len(iv) == 0:
-            return out
-        for c in range(3):
-            for i in iv:
-                out[self.pts.x.iloc[i]*3+c] = self.mtx[i, c]
-        return out
+        return _buffer_row(self.row_y, self.row_x, self.mtx, self.current, self.width, self.dtype)
 
     def read_chunk(self):
         try:
@@ -294,6 +427,8 @@ class ImgRowIterator_stream_singlechannel:
         self.pts.y = np.clip(self.pts.y, 0, self.height-1)
         self.buffer_y = self.pts.y.max()
         v = np.clip(chunk[self.key].values,0,1)
+        import matplotlib as mpl
         self.mtx = np.clip(mpl.colormaps[self.cmap](v)[:,:3] * 255,\
                            0, 255).astype(self.dtype)
+        self.row_y, self.row_x, self.mtx = _sort_buffer(self.pts, self.mtx)
         return 1
@@ -1,48 +1,58 @@
-import torch
-import pymde
 import numpy as np
-import matplotlib.colors
-import matplotlib.pyplot as plt
 import re, os, sys
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+# torch, pymde and matplotlib are imported when the embedding is computed
 
-# A constraint class that implements the unit circle constraint
-class circle(pymde.constraints.Constraint):
-    def name(self):
-        return "circle"
+def _circle_constraint():
+    '''
+    A constraint class that implements the unit circle constraint
+    '''
+    import torch
+    import pymde
 
-    def initialization(self, n_items, embedding_dim, device=None):
-        assert embedding_dim == 2, "Embedding dimension must be 2"
-        angles = torch.rand(n_items, device=device) * 2 * torch.tensor([3.141592653589793])
-        x_coords = torch.cos(angles)
-        y_coords = torch.sin(angles)
-        return torch.stack((x_coords, y_coords), dim=1)
+    class circle(pymde.constraints.Constraint):
+        def name(self):
+            return "circle"
 
-    def project_onto_tangent_space(self, X, Z, inplace=True):
-        assert Z.shape == X.shape, "Z and X must have the same shape"
-        if not torch.all(torch.isclose(torch.norm(X, dim=1), \
-                         torch.tensor(1.0), atol=1e-6)):
-            X = self.project_onto_constraint(X, inplace=True)
-        assert torch.all(torch.isclose(torch.norm(X, dim=1), \
-                         torch.tensor(1.0), atol=1e-6)), "X must lie on the unit circle"
-        # Compute the dot product of Z and X
-        dot_product = torch.sum(Z * X, dim=1, keepdim=True)
-        # Subtract the result from Z to get the orthogonal component
-        if inplace:
-            Z.sub_(dot_product * X)
-            return Z
-        else:
-            return Z - dot_product * X
+        def initialization(self, n_items, embedding_dim, device=None):
+            assert embedding_dim == 2, "Embedding dimension must be 2"
+            angles = torch.rand(n_items, device=device) * 2 * torch.tensor([3.141592653589793])
+            x_coords = torch.cos(angles)
+            y_coords = torch.sin(angles)
+            return torch.stack((x_coords, y_coords), dim=1)
 
-    def project_onto_constraint(self, Z, inplace=True):
-        if inplace:
-            Z.div_(torch.norm(Z, dim=1).unsqueeze(-1))
-            return Z
-        else:
-            return torch.div(Z, torch.norm(Z, dim=1).unsqueeze(-1))
+        def project_onto_tangent_space(self, X, Z, inplace=True):
+            assert Z.shape == X.shape, "Z and X must have the same shape"
+            if not torch.all(torch.isclose(torch.norm(X, dim=1), \
+                             torch.tensor(1.0), atol=1e-6)):
+                X = self.project_onto_constraint(X, inplace=True)
+            assert torch.all(torch.isclose(torch.norm(X, dim=1), \
+                             torch.tensor(1.0), atol=1e-6)), "X must lie on the unit circle"
+            # Compute the dot product of Z and X
+            dot_product = torch.sum(Z * X, dim=1, keepdim=True)
+            # Subtract the result from Z to get the orthogonal component
+            if inplace:
+                Z.sub_(dot_product * X)
+                return Z
+            else:
+                return Z - dot_product * X
+
+        def project_onto_constraint(self, Z, inplace=True):
+            if inplace:
+                Z.div_(torch.norm(Z, dim=1).unsqueeze(-1))
+                return Z
+            else:
+                return torch.div(Z, torch.norm(Z, dim=1).unsqueeze(-1))
+
+    return circle
 
 # Map pairwise factor proximity to an unit circle embedding then to RGB colors
 def assign_color_mds_circle(mtx, cmap_name, weight=None, top_color=None, seed=None):
+    import torch
+    import pymde
+    import matplotlib.colors
+    import matplotlib.pyplot as plt
+    circle = _circle_constraint()
     if seed is not None:
         pymde.seed(seed)
     # mtx is a K by K similarity/proximity matrix
@@ -0,0 +1,418 @@
+### Write large images tile by tile while the (sorted) pixel input streams past
+### Writers take finished tiles in any order: tiled (Big)TIFF, PNG written
+### row by row as soon as a band of tiles is complete, or a multi-resolution tile pyramid
+
+import os, json, zlib, struct, logging
+import numpy as np
+
+from ficture.utils.image_fn import to_dtype
+
+def _channel_order(img, bgr):
+    if bgr and img.shape[-1] >= 3:
+        img = img[..., [2, 1, 0] + list(range(3, img.shape[-1]))]
+    return img
+
+class TiledTiffWriter:
+    '''
+    Tiled, deflate compressed TIFF (BigTIFF if the raw image exceeds ~4GB),
+    tiles can be written in any order, the directory is written on close
+    '''
+    def __init__(self, file, height, width, channel, tile=512, dtype=np.uint8, bgr=False, level=6, bigtiff=None, premultiplied=False):
+        if tile % 16 != 0:
+            raise ValueError("TIFF tile size must be a multiple of 16")
+        self.height = height
+        self.width = width
+        self.channel = channel
+        self.tile = tile
+        self.dtype = np.dtype(dtype)
+        self.bgr = bgr
+        self.level = level
+        self.premultiplied = premultiplied
+        self.nty = (height + tile - 1) // tile
+        self.ntx = (width + tile - 1) // tile
+        self.offsets = np.zeros(self.nty * self.ntx, dtype=np.uint64)
+        self.counts = np.zeros(self.nty * self.ntx, dtype=np.uint64)
+        self.big = bigtiff
+        if self.big is None:
+            self.big = height * width * channel * self.dtype.itemsize > 2**32 - 2**26
+        self.known = {} # Identical (e.g. empty) tiles are stored once
+        self.fh = open(file, 'wb')
+        if self.big:
+            self.fh.write(b'II' + struct.pack('<HHHQ', 43, 8, 0, 0))
+        else:
+            self.fh.write(b'II' + struct.pack('<HI', 42, 0))
+
+    def write_tile(self, ty, tx, img):
+        data = np.zeros((self.tile, self.tile, self.channel), dtype=self.dtype.newbyteorder('<'))
+        img = _channel_order(img.reshape((img.shape[0], img.shape[1], -1)), self.bgr)
+        data[:img.shape[0], :img.shape[1], :] = img
+        raw = zlib.compress(data.tobytes(), self.level)
+        i = ty * self.ntx + tx
+        if raw in self.known:
+            self.offsets[i] = self.known[raw]
+        else:
+            self.offsets[i] = self.fh.tell()
+            self.fh.write(raw)
+            if len(raw) < 4096:
+                self.known[raw] = self.offsets[i]
+        self.counts[i] = len(raw)
+
+    def close(self):
+        missing = np.where(self.counts == 0)[0]
+        for i in missing:
+            self.write_tile(i // self.ntx, i % self.ntx, np.zeros((1, 1, self.channel), dtype=self.dtype))
+        if self.fh.tell() % 2 == 1:
+            self.fh.write(b'\0')
+        ifd_pos = self.fh.tell()
+        # (tag, type, values), type 3: SHORT, 4: LONG, 16: LONG8
+        off_type = 16 if self.big else 4
+        bits = self.dtype.itemsize * 8
+        tags = [(256, 4, [self.width]), (257, 4, [self.height]),
+                (258, 3, [bits] * self.channel), (259, 3, [8]),
+                (262, 3, [2 if self.channel >= 3 else 1]), (277, 3, [self.channel]),
+                (284, 3, [1]), (322, 4, [self.tile]), (323, 4, [self.tile]),
+                (324, off_type, self.offsets), (325, off_type, self.counts)]
+        if self.channel in [2, 4]:
+            tags.append((338, 3, [1 if self.premultiplied else 2])) # Associated or unassociated alpha
+        tags.append((339, 3, [1] * self.channel))
+        fmt = {3:'H', 4:'I', 16:'Q'}
+        if self.big:
+            head, entry, tail, field = '<Q', '<HHQ', '<Q', 8
+        else:
+            head, entry, tail, field = '<H', '<HHI', '<I', 4
+        ifd_size = struct.calcsize(head) + len(tags) * (struct.calcsize(entry) + field) + struct.calcsize(tail)
+        ifd = [struct.pack(head, len(tags))]
+        extra = []
+        extra_pos = ifd_pos + ifd_size
+        for tag, typ, val in tags:
+            data = np.asarray(val).astype('<' + fmt[typ]).tobytes()
+            ifd.append(struct.pack(entry, tag, typ, len(val)))
+            if len(data) <= field:
+                ifd.append(data.ljust(field, b'\0'))
+            else:
+                ifd.append(struct.pack('<' + ('Q' if self.big else 'I'), extra_pos))
+                extra.append(data)
+                extra_pos += len(data)
+        ifd.append(struct.pack(tail, 0))
+        self.fh.write(b''.join(ifd + extra))
+        self.fh.seek(8 if self.big else 4)
+        self.fh.write(struct.pack('<Q' if self.big else '<I', ifd_pos))
+        self.fh.close()
+
+class PngStripWriter:
+    '''
+    PNG written row by row, tiles are kept (compressed) until
+    all tiles of a band of rows are available. Memory is bounded by a band only if
+    tiles finish band by band (input blocked along Y), otherwise it holds the whole image
+    '''
+    def __init__(self, file, height, width, channel, tile=512, dtype=np.uint8, bgr=False, level=6):
+        if channel not in [1, 2, 3, 4]:
+            raise ValueError("PNG supports 1 to 4 channels")
+        self.height = height
+        self.width = width
+        self.channel = channel
+        self.tile = tile
+        self.dtype = np.dtype(dtype)
+        self.bgr = bgr
+        self.nty = (height + tile - 1) // tile
+        self.ntx = (width + tile - 1) // tile
+        self.pending = {} # band -> {tx: compressed tile}
+        self.next_band = 0
+        self.z = zlib.compressobj(level)
+        self.fh = open(file, 'wb')
+        self.fh.write(b'\x89PNG\r\n\x1a\n')
+        ctype = {1:0, 2:4, 3:2, 4:6}[channel]
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, self.dtype.itemsize * 8, ctype, 0, 0, 0))
+
+    def _chunk(self, name, data):
+        self.fh.write(struct.pack('>I', len(data)) + name + data)
+        self.fh.write(struct.pack('>I', zlib.crc32(name + data) & 0xffffffff))
+
+    def write_tile(self, ty, tx, img):
+        img = _channel_order(img.reshape((img.shape[0], img.shape[1], -1)), self.bgr)
+        self.pending.setdefault(ty, {})[tx] = (img.shape, zlib.compress(np.ascontiguousarray(img).astype(self.dtype).tobytes(), 1))
+        while len(self.pending.get(self.next_band, {})) == self.ntx:
+            self._write_band(self.next_band)
+            self.next_band += 1
+
+    def _write_band(self, ty):
+        h = min(self.tile, self.height - ty * self.tile)
+        band = np.zeros((h, self.width, self.channel), dtype=self.dtype.newbyteorder('>'))
+        for tx, (shape, raw) in self.pending.pop(ty).items():
+            img = np.frombuffer(zlib.decompress(raw), dtype=self.dtype).reshape(shape)
+            band[:shape[0], tx*self.tile:tx*self.tile+shape[1], :] = img
+        rows = np.zeros((h, 1 + band.shape[1] * self.channel * self.dtype.itemsize), dtype=np.uint8)
+        rows[:, 1:] = band.reshape((h, -1)).view(np.uint8)
+        data = self.z.compress(rows.tobytes())
+        if len(data) > 0:
+            self._chunk(b'IDAT', data)
+
+    def close(self):
+        empty = np.zeros((self.tile, self.tile, self.channel), dtype=self.dtype)
+        for ty in range(self.nty):
+            for tx in range(self.ntx):
+                if ty >= self.next_band and tx not in self.pending.get(ty, {}):
+                    self.write_tile(ty, tx, empty[:min(self.tile, self.height - ty*self.tile), :min(self.tile, self.width - tx*self.tile)])
+        self._chunk(b'IDAT', self.z.flush())
+        self._chunk(b'IEND', b'')
+        self.fh.close()
+
+class TilePyramidWriter:
+    '''
+    Tiles of the finest level are saved as they come and averaged 2x2 into
+    the next coarser level, a coarser tile is saved once all its (up to 4) children are done.
+    Tiles are stored as {output}/{z}/{x}/{y}.{fmt}, z = 0 is a single tile covering the image,
+    tiles at the right/bottom edge are padded with the background
+    '''
+    def __init__(self, output, height, width, channel=3, tile=256, fmt="png", background=None, bgr=True, info={}):
+        if tile % 2 != 0:
+            raise ValueError("Tile size must be even")
+        self.output = output
+        self.height = height
+        self.width = width
+        self.channel = channel
+        self.tile = tile
+        self.fmt = fmt
+        self.bgr = bgr
+        self.info = info
+        self.background = np.zeros(channel, dtype=np.uint8) if background is None else np.asarray(background, dtype=np.uint8)
+        # Level sizes, from the finest to the coarsest
+        self.size = [(height, width)]
+        while self.size[-1][0] > tile or self.size[-1][1] > tile:
+            h, w = self.size[-1]
+            self.size.append(((h + 1) // 2, (w + 1) // 2))
+        self.size = self.size[::-1]
+        self.n_level = len(self.size)
+        self.n_tile = [((h + tile - 1) // tile, (w + tile - 1) // tile) for h, w in self.size]
+        self.partial = {} # (z, ty, tx) -> [image, number of children received]
+
+    def write_tile(self, ty, tx, img):
+        self._save(self.n_level - 1, ty, tx, img)
+
+    def _save(self, z, ty, tx, img):
+        if img.shape[0] < self.tile or img.shape[1] < self.tile:
+            full = np.zeros((self.tile, self.tile, self.channel), dtype=np.uint8)
+            full[:] = self.background
+            full[:img.shape[0], :img.shape[1]] = img.reshape((img.shape[0], img.shape[1], -1))
+            img = full
+        path = os.path.join(self.output, str(z), str(tx))
+        os.makedirs(path, exist_ok=True)
+        import cv2
+        cv2.imwrite(os.path.join(path, f"{ty}.{self.fmt}"), img if self.bgr or self.channel < 3 else _channel_order(img, True))
+        if z == 0:
+            return
+        key = (z - 1, ty // 2, tx // 2)
+        if key not in self.partial:
+            parent = np.zeros((self.tile, self.tile, self.channel), dtype=np.uint8)
+            parent[:] = self.background
+            self.partial[key] = [parent, 0]
+        half = self.tile // 2
+        small = img.reshape((half, 2, half, 2, self.channel)).mean(axis=(1, 3))
+        y0, x0 = (ty % 2) * half, (tx % 2) * half
+        self.partial[key][0][y0:y0+half, x0:x0+half] = np.around(small).astype(np.uint8)
+        self.partial[key][1] += 1
+        nty, ntx = self.n_tile[z]
+        n_child = (min(2 * key[1] + 2, nty) - 2 * key[1]) * (min(2 * key[2] + 2, ntx) - 2 * key[2])
+        if self.partial[key][1] == n_child:
+            parent, _ = self.partial.pop(key)
+            self._save(*key, parent)
+
+    def close(self):
+        if len(self.partial) > 0:
+            logging.warning(f"{len(self.partial)} tiles are incomplete")
+        manifest = {"format": self.fmt, "tile_size": self.tile, "n_level": self.n_level,
+                    "layout": "{z}/{x}/{y}." + self.fmt,
+                    "levels": [{"z": z, "height": h, "width": w, "n_tile_y": self.n_tile[z][0], "n_tile_x": self.n_tile[z][1],
+                                "scale": 2 ** (self.n_level - 1 - z)} for z, (h, w) in enumerate(self.size)]}
+        manifest.update(self.info)
+        with open(os.path.join(self.output, "manifest.json"), 'w') as wf:
+            json.dump(manifest, wf, indent=1)
+
+def tiled_image_writer(file, height, width, channel, tile=512, dtype=np.uint8, bgr=False, premultiplied=False, block_axis=None):
+    '''
+    Tiled TIFF for .tif/.tiff output, PNG otherwise (PNG has no premultiplied alpha).
+    Set bgr if the tiles are in opencv (BGR/BGRA) channel order.
+    block_axis is the BLOCK_AXIS of the input stream: PNG rows can only be written once
+    a band of rows is complete, with X blocks that happens only at the end of the input
+    '''
+    if file.lower().endswith((".tif", ".tiff")):
+        return TiledTiffWriter(file, height, width, channel, tile, dtype, bgr, premultiplied=premultiplied)
+    if block_axis == "X":
+        logging.warning(f"Input is blocked along X, all (compressed) tiles of {file} are kept in memory until the end, use a .tif output to write tiles as they finish")
+    return PngStripWriter(file, height, width, channel, tile, dtype, bgr)
+
+def mean_renderer(background=None, dtype=np.uint8):
+    '''
+    Render the mean value of each pixel, scaled from [0, 1] to the range of dtype
+    '''
+    def render(mean, count, amax):
+        img = np.zeros(mean.shape, dtype=dtype)
+        if background is not None:
+            img[:] = background
+        kept = count > 0
+        img[kept] = to_dtype(mean[kept], dtype)
+        return img
+    return render
+
+def stream_frontier(meta, chunk, xmin, ymin, um_per_pixel):
+    '''
+    Where a chunk read by BlockIndexedLoader (sorted by block, then by position
+    within the block) ends, in image pixels: (block axis, block start, block end, position)
+    '''
+    if chunk.shape[0] == 0 or 'BLOCK_AXIS' not in meta or 'BLOCK' not in chunk.columns:
+        return None
+    axis = meta['BLOCK_AXIS']
+    b = float(chunk.BLOCK.iloc[-1])
+    bmin, pmin, p = (xmin, ymin, chunk.Y.iloc[-1]) if axis == "X" else (ymin, xmin, chunk.X.iloc[-1])
+    return axis, int(np.floor((b - bmin) / um_per_pixel)), \
+        int(np.floor((b + meta['BLOCK_SIZE'] - bmin) / um_per_pixel)), \
+        int(np.floor((p - pmin) / um_per_pixel))
+
+class TileAccumulator:
+    '''
+    Sum, count (and optionally max) planes kept only for the tiles being filled.
+    A tile is rendered and passed to the writer once the sorted input has moved past it
+    render(mean, count, max) maps the per pixel (tile*tile rows) statistics to output values
+    '''
+    def __init__(self, writer, channel, render, n_max=0):
+        self.writer = writer
+        self.tile = writer.tile
+        self.height = writer.height
+        self.width = writer.width
+        self.channel = channel
+        self.n_max = n_max
+        self.render = render
+        self.ntx = (self.width + self.tile - 1) // self.tile
+        self.nty = (self.height + self.tile - 1) // self.tile
+        ty, tx = np.divmod(np.arange(self.nty * self.ntx), self.ntx)
+        self.x_end = np.minimum((tx + 1) * self.tile, self.width)
+        self.y_end = np.minimum((ty + 1) * self.tile, self.height)
+        self.done = np.zeros(self.nty * self.ntx, dtype=bool)
+        self.open = {}
+        self.n_late = 0
+
+    def _by_tile(self, x, y, warn=True):
+        """Yield (tile id, input rows, pixel index within the tile) of the tiles hit by the input"""
+        x = np.asarray(x, dtype=np.int64)
+        y = np.asarray(y, dtype=np.int64)
+        tid = (y // self.tile) * self.ntx + x // self.tile
+        late = self.done[tid]
+        if late.any() and warn:
+            if self.n_late == 0:
+                logging.warning("Input is not sorted as expected, pixels in tiles already written are ignored")
+            self.n_late += late.sum()
+        local = (y % self.tile) * self.tile + x % self.tile
+        order = np.argsort(tid, kind='stable')
+        order = order[~late[order]]
+        u, st = np.unique(tid[order], return_index=True)
+        ed = np.append(st[1:], len(order))
+        for i, s, e in zip(u, st, ed):
+            yield i, order[s:e], local[order[s:e]]
+
+    def add(self, x, y, val, vmax=None):
+        if len(x) == 0:
+            return
+        n = self.tile * self.tile
+        for i, rows, indx in self._by_tile(x, y):
+            if i not in self.open:
+                self.open[i] = [np.zeros((n, self.channel), dtype=np.float32), np.zeros(n, dtype=np.float32), np.zeros((n, self.n_max), dtype=np.float32)]
+            plane = self.open[i]
+            plane[1] += np.bincount(indx, minlength=n)
+            for c in range(self.channel):
+                plane[0][:, c] += np.bincount(indx, weights=val[rows, c], minlength=n)
+            for c in range(self.n_max):
+                np.maximum.at(plane[2][:, c], indx, vmax[rows, c])
+
+    def _write(self, i):
+        ty, tx = divmod(i, self.ntx)
+        n = self.tile * self.tile
+        if i in self.open:
+            total, count, amax = self.open.pop(i)
+            mean = np.zeros_like(total)
+            kept = count > 0
+            mean[kept] = total[kept] / count[kept].reshape((-1, 1))
+        else:
+            mean, count, amax = np.zeros((n, self.channel), dtype=np.float32), np.zeros(n, dtype=np.float32), np.zeros((n, self.n_max), dtype=np.float32)
+        img = self.render(mean, count, amax).reshape((self.tile, self.tile, -1))
+        h = self.y_end[i] - ty * self.tile
+        w = self.x_end[i] - tx * self.tile
+        self.writer.write_tile(ty, tx, img[:h, :w])
+        self.done[i] = True
+
+    def flush(self, frontier):
+        '''
+        Write the tiles the input has passed, frontier is from stream_frontier
+        '''
+        if frontier is None:
+            return
+        axis, block_start, block_end, pos = frontier
+        b_end, p_end = (self.x_end, self.y_end) if axis == "X" else (self.y_end, self.x_end)
+        finished = ~self.done & ((b_end <= block_start) | ((b_end <= block_end) & (p_end <= pos)))
+        for i in np.where(finished)[0]:
+            self._write(i)
+
+    def close(self):
+        for i in np.where(~self.done)[0]:
+            self._write(i)
+        self.writer.close()
+        if self.n_late > 0:
+            logging.warning(f"Ignored {self.n_late} pixels in tiles already written")
+
+class SparseTileAccumulator(TileAccumulator):
+    '''
+    Many channels (e.g. one per factor) each written to its own image,
+    only the non-zero (pixel, channel, value) entries are kept for the open tiles.
+    render(mean, count, None) maps the per pixel mean value of one channel to output values.
+    n_above[k, j] counts the pixels written with mean value of channel k above thresholds[j]
+    '''
+    def __init__(self, writers, render, thresholds=[]):
+        super().__init__(writers[0], len(writers), render)
+        self.writers = writers
+        self.thresholds = np.asarray(thresholds, dtype=np.float32)
+        self.n_above = np.zeros((len(writers), len(thresholds)), dtype=np.int64)
+
+    def add(self, x, y, row, channel, val):
+        '''
+        x, y: image pixel of each input row; row, channel, val: the non-zero entries
+        '''
+        if len(x) == 0:
+            return
+        n = self.tile * self.tile
+        for i, rows, indx in self._by_tile(x, y):
+            if i not in self.open:
+                self.open[i] = [np.zeros(n, dtype=np.float32), [], [], []]
+            self.open[i][0] += np.bincount(indx, minlength=n)
+        for i, e, indx in self._by_tile(np.asarray(x)[row], np.asarray(y)[row], warn=False):
+            plane = self.open[i]
+            plane[1].append(indx)
+            plane[2].append(channel[e])
+            plane[3].append(val[e])
+
+    def _write(self, i):
+        ty, tx = divmod(i, self.ntx)
+        n = self.tile * self.tile
+        count, indx, channel, val = self.open.pop(i) if i in self.open else (np.zeros(n, dtype=np.float32), [], [], [])
+        indx = np.concatenate(indx) if len(indx) > 0 else np.zeros(0, dtype=np.int64)
+        channel = np.concatenate(channel) if len(channel) > 0 else np.zeros(0, dtype=np.int64)
+        val = np.concatenate(val) if len(val) > 0 else np.zeros(0, dtype=np.float32)
+        order = np.argsort(channel, kind='stable')
+        bound = np.searchsorted(channel[order], np.arange(self.channel + 1))
+        kept = count > 0
+        h = self.y_end[i] - ty * self.tile
+        w = self.x_end[i] - tx * self.tile
+        for k, writer in enumerate(self.writers):
+            e = order[bound[k]:bound[k+1]]
+            mean = np.zeros((n, 1), dtype=np.float32)
+            mean[kept, 0] = np.bincount(indx[e], weights=val[e], minlength=n)[kept] / count[kept]
+            self.n_above[k] += (mean[kept, 0][:, None] > self.thresholds[None, :]).sum(axis=0)
+            img = self.render(mean, count, None).reshape((self.tile, self.tile, -1))
+            writer.write_tile(ty, tx, img[:h, :w])
+        self.done[i] = True
+
+    def close(self):
+        for i in np.where(~self.done)[0]:
+            self._write(i)
+        for writer in self.writers:
+            writer.close()
+        if self.n_late > 0:
+            logging.warning(f"Ignored {self.n_late} pixels in tiles already written")
@@ -3,28 +3,19 @@
 ''' helper functions '''
 import numpy as np
 import pandas as pd
-import copy, re, os, geojson
+import copy, re, os, gzip, geojson
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from scipy import sparse
 from scipy.special import gammaln, psi, logsumexp, expit, logit
-from sklearn.preprocessing import normalize
-import scipy.stats
-import scipy.optimize
-import sklearn.cluster
-
-from matplotlib.patches import Rectangle
-import matplotlib.colors as mcolors
-import matplotlib.pyplot as plt
-from matplotlib.path import Path
-
-from sklearn.utils import check_random_state
-from sklearn.decomposition._online_lda_fast import (
-    _dirichlet_expectation_1d, _dirichlet_expectation_2d,
-)
+# sklearn, matplotlib, scipy.stats and scipy.optimize are imported in the functions
+# using them, most commands only need a few helpers from here
 
 def dirichlet_expectation(alpha):
     """
     For a vector theta ~ Dir(alpha), computes E[log(theta)] given alpha.
     """
+    from sklearn.decomposition._online_lda_fast import _dirichlet_expectation_2d
     assert alpha.min() > 0, "Expecting positive Dirichlet parameters"
     if (len(alpha.shape) == 1):
         return( _dirichlet_expectation_2d(alpha.reshape((-1, 1))) )
@@ -32,6 +23,8 @@ def dirichlet_expectation(alpha):
 
 def init_latent_vars(model, n_features, dtype=np.float64, gamma = None, ):
     """Initialize latent variables."""
+    from sklearn.utils import check_random_state
+    from sklearn.decomposition._online_lda_fast import _dirichlet_expectation_2d
     model.random_state_ = check_random_state(model.random_state)
     model.n_batch_iter_ = 1
     model.n_iter_ = 0
@@ -74,6 +67,7 @@ def pg_mean(b,c=0):
         return (b/2/c * np.tanh(c/2))
 
 def real_to_sb(mtx):
+    from sklearn.preprocessing import normalize
     assert len(mtx.shape) == 2, "Invalid matrix"
     n, K = mtx.shape
     phi = expit(mtx)
@@ -87,6 +81,7 @@ def real_to_sb(mtx):
     return phi
 
 def sb_to_real(phi):
+    from sklearn.preprocessing import normalize
     assert len(phi.shape) == 2, "Invalid matrix"
     phi = np.clip(phi, 1e-8, 1.-1e-8)
     phi = normalize(phi, norm='l1', axis=1) * (1.-1e-6)
@@ -147,6 +142,56 @@ def gen_slices_from_list(vec, bsize):
         yield vec[start:end]
         start = end
 
+def gen_text_blocks(file, chunksize=500000):
+    """
+    Yield blocks of at most chunksize raw lines from a (gzipped) text file,
+    each block starts with the header line so it can be parsed independently
+    """
+    rf = gzip.open(file, 'rt') if file.endswith('.gz') else open(file, 'r')
+    with rf:
+        header = rf.readline()
+        block = [header]
+        for line in rf:
+            block.append(line)
+            if len(block) > chunksize:
+                yield ''.join(block)
+                block = [header]
+        if len(block) > 1:
+            yield ''.join(block)
+
+def ordered_map(fn, iterable, thread=1, initializer=None, initargs=(), max_pending=-1, mp_context=None):
+    """
+    Apply fn to items of iterable in a process pool and yield results in input order
+    Shared read-only state is sent to each worker once through initializer
+    (not copied at all with a fork mp_context)
+    At most max_pending (default 2*thread) items are in flight at a time
+    """
+    if thread <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        yield from map(fn, iterable)
+        return
+    if max_pending <= 0:
+        max_pending = 2 * thread
+    with ProcessPoolExecutor(max_workers=thread, initializer=initializer, initargs=initargs, mp_context=mp_context) as executor:
+        pending = deque()
+        for item in iterable:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
+def write_rows(wf, fmt, columns):
+    """
+    Write rows formatted with a single printf style format string,
+    columns is a list of equal length arrays
+    """
+    columns = [x.tolist() if isinstance(x, np.ndarray) else x for x in columns]
+    if len(columns) == 0 or len(columns[0]) == 0:
+        return
+    wf.write('\n'.join([fmt % x for x in zip(*columns)]) + '\n')
+
 def get_string_with_integer_suff(in_array):
     out = []
     for u in in_array:
@@ -179,6 +224,7 @@ def extract_polygons_from_json(gj):
     return vertices
 
 def svg_parse_list(path):
+    from matplotlib.path import Path
     commands = {'M': (Path.MOVETO,),'L': (Path.LINETO,),
                 'Q': (Path.CURVE3,)*2,'C': (Path.CURVE4,)*3,
                 'Z': (Path.CLOSEPOLY,) }
@@ -197,6 +243,7 @@ def match_factors(mtx1, mtx2, c1, n, cmap, mode='beta'):
     """
     Harmonize a pair of LDA results
     """
+    import scipy.optimize, sklearn.cluster
     k1 = mtx1.shape[0]
     k2 = mtx2.shape[0]
     assert mtx1.shape[1] == mtx2.shape[1], "Invalid input matrices"
@@ -298,6 +345,9 @@ def plot_colortable(colors, title, sort_colors=True, ncols=4, dpi = 80,\
                     cell_width = 212, cell_height = 22,\
                     title_fontsize=24, text_fontsize=24,\
                     swatch_width = 48, margin = 12, topmargin = 40):
+    import matplotlib.colors as mcolors
+    import matplotlib.pyplot as plt
+    from matplotlib.patches import Rectangle
     # Sort colors by hue, saturation, value and name.
     if sort_colors is True:
         by_hsv = sorted((tuple(mcolors.rgb_to_hsv(mcolors.to_rgb(color))),
@@ -360,75 +410,165 @@ def read_ct_from_solo_barcodes_tsv(file, key, chunksize=500000, mu_scale=-1):
         chunk[key]=chunk[key].map(lambda x : x.split(',')[ct_idx]).astype(int)
         yield chunk
 
-def make_mtx_from_dge(file, min_ct_per_feature = 50, min_ct_per_unit = 100, feature_white_list = None, feature_list = None, unit = "random_index", key = "gn", epoch=1, epoch_id_length=2, return_df = False):
-    df = pd.DataFrame()
-    epoch_id_list = set()
-    df = pd.read_csv(file, sep='\t', usecols = [unit,'X','Y','gene',key], dtype={unit:str})
-        # unit_list = chunk[unit].str[:epoch_id_length].unique()
-        # i = 0
-        # while len(epoch_id_list) < epoch and i < len(unit_list):
-        #     epoch_id_list.add(unit_list[i])
-        #     i += 1
-        # if len(epoch_id_list) >= epoch and unit_list[-1] not in epoch_id_list:
-        #     pat = '^' + '|'.join(list(epoch_id_list))
-        #     df = pd.concat([df, chunk[chunk[unit].str.contains(pat) & chunk[key].ge(1)] ])
-        #     break
-        # df = pd.concat([df, chunk[chunk[key].ge(1)] ])
-    epoch0 = df[unit].iloc[0][:epoch_id_length]
-    one_pass = df[unit].str[:epoch_id_length].eq(epoch0)
+def make_mtx_from_dge(file, min_ct_per_feature = 50, min_ct_per_unit = 100, feature_white_list = None, feature_list = None, unit = "random_index", key = "gn", epoch=1, epoch_id_length=2, return_df = False, first_epoch_only = False, chunksize = 1000000):
+    '''
+    Read a hexagon file (grouped by unit) in two streaming passes:
+    feature totals over the first epoch and the matrix size first,
+    then fill preallocated CSR arrays with the kept features.
+    If first_epoch_only, only units in the first epoch are loaded
+    '''
+    # Pass 1: feature counts (first epoch), number of rows and units to store
+    epoch0 = None
+    feature_ct = pd.Series(dtype=np.int64)
+    feature_nrow = pd.Series(dtype=np.int64)
+    n_unit = 0
+    last_unit = None
+    for chunk in pd.read_csv(file, sep='\t', usecols = [unit,'gene',key], dtype={unit:str, 'gene':str}, chunksize=chunksize):
+        if epoch0 is None:
+            epoch0 = chunk[unit].iloc[0][:epoch_id_length]
+        one_pass = chunk[unit].str[:epoch_id_length].eq(epoch0).values
+        feature_ct = feature_ct.add(chunk.loc[one_pass].groupby('gene')[key].sum(), fill_value=0)
+        if first_epoch_only:
+            chunk = chunk.loc[one_pass]
+        if len(chunk) == 0:
+            continue
+        feature_nrow = feature_nrow.add(chunk.groupby('gene').size(), fill_value=0)
+        u = chunk[unit].values
+        n_unit += 1 + np.count_nonzero(u[1:] != u[:-1]) - int(u[0] == last_unit)
+        last_unit = u[-1]
+    if epoch0 is None:
+        raise ValueError(f"No data in {file}")
+    feature_ct = feature_ct.astype(np.int64)
     if feature_list is not None:
         feature = pd.DataFrame({"gene": feature_list})
-        ct = df[one_pass].groupby(by=['gene']).agg({key:"sum"}).reset_index()
-        feature = feature.merge(right = ct, on = 'gene', how = 'left')
-        feature[key] = feature[key].fillna(0).astype(int)
+        feature[key] = feature.gene.map(feature_ct).fillna(0).astype(int)
     else:
-        feature = df[one_pass].groupby(by=['gene']).agg({key:"sum"}).reset_index()
+        feature = feature_ct.rename(key).rename_axis('gene').reset_index()
         feature_white_list = set() if feature_white_list is None else set(feature_white_list)
         feature = feature.loc[feature[key].ge(min_ct_per_feature ) | feature.gene.isin(feature_white_list), :]
     M = len(feature)
     feature.index = np.arange(M)
     ft_dict = {x:i for i,x in enumerate(feature.gene)}
-    df.drop(index = df.index[~df.gene.isin(ft_dict)], inplace=True)
-
-    brc = df.groupby(by = unit).agg({key:"sum"}).reset_index()
-    brc.drop(index = brc.index[brc[key].lt(min_ct_per_unit)], inplace=True)
-    N = brc.shape[0]
-    brc.index = np.arange(N)
+    nnz = int(feature_nrow[feature_nrow.index.isin(ft_dict)].sum())
+
+    # Pass 2: write the kept entries, one row per (contiguous) unit
+    indptr = np.zeros(n_unit + 1, dtype=np.int64)
+    indices = np.empty(nnz, dtype=np.int32)
+    data = np.empty(nnz, dtype=np.int32)
+    unit_id = np.empty(n_unit, dtype=object)
+    xy = None
+    n_row = 0
+    n_val = 0
+    last_unit = None
+    for chunk in pd.read_csv(file, sep='\t', usecols = [unit,'X','Y','gene',key], dtype={unit:str, 'gene':str}, chunksize=chunksize):
+        kept = chunk.gene.map(ft_dict)
+        mask = kept.notna().values
+        if first_epoch_only:
+            mask = mask & chunk[unit].str[:epoch_id_length].eq(epoch0).values
+        if not mask.any():
+            continue
+        chunk = chunk.loc[mask]
+        u = chunk[unit].values
+        st = np.concatenate([[0], np.where(u[1:] != u[:-1])[0] + 1])
+        new_st = st[1:] if u[0] == last_unit else st
+        n_new = len(new_st)
+        row = n_row + np.arange(n_new)
+        unit_id[row] = u[new_st]
+        v = chunk[['X', 'Y']].values
+        if xy is None:
+            xy = np.zeros((n_unit, 2), dtype=v.dtype)
+        elif not np.can_cast(v.dtype, xy.dtype):
+            xy = xy.astype(np.result_type(xy.dtype, v.dtype))
+        xy[row] = v[new_st]
+        n = len(chunk)
+        indices[n_val:n_val+n] = kept.values[mask]
+        data[n_val:n_val+n] = chunk[key].values
+        ed = np.append(st[1:], n) + n_val
+        n_row += n_new
+        indptr[n_row - len(st) + 1:n_row + 1] = ed
+        n_val += n
+        last_unit = u[-1]
+    mtx = sparse.csr_matrix((data[:n_val], indices[:n_val], indptr[:n_row+1]), shape=(n_row, M))
+    mtx.sum_duplicates()
+    unit_id = unit_id[:n_row]
+    xy = xy[:n_row] if xy is not None else np.zeros((0, 2))
+
+    # Sort by unit id and merge units that are not contiguous in the input
+    unit_id, first, inv = np.unique(unit_id, return_index=True, return_inverse=True)
+    if len(unit_id) < n_row:
+        mtx = sparse.csr_matrix((np.ones(n_row, dtype=np.int32), (inv, np.arange(n_row))), shape=(len(unit_id), n_row)) @ mtx
+    elif not np.array_equal(first, np.arange(n_row)):
+        mtx = mtx[first, :]
+    xy = xy[first]
+    unit_sum = np.asarray(mtx.sum(axis = 1)).ravel()
+    kept = unit_sum >= min_ct_per_unit
+    if not kept.all():
+        mtx = mtx[kept, :]
+    N = kept.sum()
+    brc = pd.DataFrame({unit: unit_id[kept], key: unit_sum[kept], 'j': np.arange(N)})
     bc_dict = {x:i for i,x in enumerate(brc[unit])}
-    brc['j'] = brc[unit].map(bc_dict)
-    df.drop(index = df.index[~df[unit].isin(bc_dict)], inplace=True)
-    df['j'] = df[unit].map(bc_dict)
     brc["epoch"] = brc[unit].str[:epoch_id_length]
-    df.drop(columns = unit, inplace=True)
-    brc = brc.merge(right = df[['j','X','Y' ]].drop_duplicates(subset='j'), on = 'j', how = 'left')
-
-    mtx = sparse.coo_array((df[key].values, (df.j.values, df.gene.map(ft_dict))), shape=(N, M)).tocsr()
+    brc["X"] = xy[kept, 0]
+    brc["Y"] = xy[kept, 1]
 
-    feature["Weight"] = mtx.sum(axis = 0)
+    feature["Weight"] = np.asarray(mtx.sum(axis = 0)).ravel()
     feature.Weight = feature.Weight * 1. / feature.Weight.sum()
 
     if return_df:
+        coo = mtx.tocoo()
+        df = pd.DataFrame({'X':brc.X.values[coo.row], 'Y':brc.Y.values[coo.row], 'gene':feature.gene.values[coo.col], key:coo.data, 'j':coo.row})
         return df, feature, brc, mtx, ft_dict, bc_dict
     else:
         return feature, brc, mtx, ft_dict, bc_dict
 
 
+def topic_coherence(mtx, theta, gene_f, top_gene):
+    """
+    Co-occurrence coherence of the top genes of each factor
+    mtx: unit x gene counts, theta: unit x factor, gene_f: relative abundance of genes,
+    top_gene: list of gene indices for each factor.
+    For each pair of top genes i, j (gene_f[i] >= gene_f[j]) sum over units containing both
+    theta[:, k] * log(x_j / (x_i * gene_f[j] / gene_f[i]) + 1)
+    """
+    mtx = sparse.csc_matrix(mtx)
+    score = np.zeros(len(top_gene))
+    for k, wd in enumerate(top_gene):
+        wd = np.array(wd)[np.argsort(-gene_f[wd], kind='stable')]
+        sub = mtx[:, wd].tocsr()
+        rows = np.flatnonzero(np.diff(sub.indptr))
+        x = sub[rows, :].toarray().astype(float)
+        w = theta[rows, k]
+        for i in range(len(wd) - 1):
+            kept = x[:, i] > 0
+            ratio = x[kept, i+1:] * (gene_f[wd[i]] / gene_f[wd[i+1:]]) / x[kept, i:i+1]
+            score[k] += (w[kept, None] * np.log(ratio + 1)).sum()
+    return score
+
+def chisq_table(info, factor_header, total_k, total_umi):
+    """
+    2x2 chi-squared test (gene vs rest, factor vs rest) for all genes and factors at once
+    info: indexed by gene, with columns factor_header and gene_tot
+    Return a dataframe with columns gene, factor, Chi2, pval, FoldChange, gene_total
+    for pairs with positive count and fold change >= 1, ordered by factor
+    """
+    import scipy.stats
+    x = info.loc[:, factor_header].values.astype(float)
+    tot = info["gene_tot"].values.astype(float).reshape((-1, 1))
+    tk = np.array(total_k, dtype=float).reshape((1, -1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fd = x / tk / (tot - x) * (total_umi - tk)
+    kept = (tk > 0) & (x > 0) & ~(fd < 1)
+    k, g = np.nonzero(kept.T)
+    x, tot, tk, fd = x[g, k], tot[g, 0], tk[0, k], fd[g, k]
+    a = np.around(x, 0) + 1
+    b = np.around(tot - x, 0) + 1
+    c = np.around(tk - x, 0) + 1
+    d = np.around(total_umi - tk - tot + x, 0) + 1
+    chi2 = (a + b + c + d) * (a * d - b * c)**2 / ((a + b) * (c + d) * (a + c) * (b + d))
+    return pd.DataFrame({'gene':info.index.values[g], 'factor':np.array(factor_header)[k], \
+                         'Chi2':chi2, 'pval':scipy.stats.chi2.sf(chi2, 1), \
+                         'FoldChange':fd, 'gene_total':tot})
+
 def chisq(k,info,total_k,total_umi):
-    res = []
-    if total_k <= 0:
-        return res
-    for name, v in info.iterrows():
-        if v[k] <= 0:
-            continue
-        tab=np.zeros((2,2))
-        tab[0,0]=v[str(k)]
-        tab[0,1]=v["gene_tot"]-tab[0,0]
-        tab[1,0]=total_k-tab[0,0]
-        tab[1,1]=total_umi-total_k-v["gene_tot"]+tab[0,0]
-        fd=tab[0,0]/total_k/tab[0,1]*(total_umi-total_k)
-        if fd < 1:
-            continue
-        tab = np.around(tab, 0).astype(int) + 1
-        chi2, p, dof, ex = scipy.stats.chi2_contingency(tab, correction=False)
-        res.append([name,k,chi2,p,fd,v["gene_tot"]])
-    return res
+    res = chisq_table(info, [k], [total_k], total_umi)
+    return res.values.tolist()
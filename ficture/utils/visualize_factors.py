@@ -3,22 +3,17 @@ import numpy as np
 import pandas as pd
 import base64
 
-from sklearn.preprocessing import normalize
 # from sklearn.decomposition import TruncatedSVD, PCA
-import scipy.cluster
-import scipy.stats
-import scipy.spatial
-import scipy.linalg
-
-import ete3
-from ete3 import Tree, TreeStyle, NodeStyle
+# scipy, sklearn and ete3 (which loads Qt) are imported in the functions using them
 os.environ['QT_QPA_PLATFORM']='offscreen'
 
 def logrank(x):
+    import scipy.stats
     v = scipy.stats.rankdata(x)
     return - np.log( 1-(v-.5)/len(v) )
 
 def cor_logrank(orgmtx):
+    import scipy.stats
     K, M = orgmtx.shape
     rankmtx = np.zeros((K, M), dtype=int)
     for k in range(K):
@@ -27,6 +22,7 @@ def cor_logrank(orgmtx):
     return corlogrank
 
 def NJ_logrank(orgmtx):
+    import scipy.stats
     K, M = orgmtx.shape
     rankmtx = np.zeros((K, M), dtype=int)
     for k in range(K):
@@ -69,6 +65,10 @@ def NJ_logrank(orgmtx):
     return Z
 
 def visual_hc(model_prob, weight, top_gene, node_color=None, factor_name=None, circle=False, vertical=False, output_f=None, cprob_cut=.99):
+    import scipy.cluster.hierarchy, scipy.spatial.distance
+    from sklearn.preprocessing import normalize
+    import ete3
+    from ete3 import Tree, TreeStyle, NodeStyle
 
     K = model_prob.shape[0]
     assert len(weight) == K, "model_prob.shape[0] != len(weight)"
@@ -0,0 +1,74 @@
+### Import time of the ficture commands
+### Each command module is imported in a fresh interpreter with -X importtime,
+### report the total and the slowest top level packages it pulls in
+
+import sys, os, re, argparse, subprocess
+from collections import defaultdict
+
+def _parse_importtime(stderr):
+    for line in stderr.split('\n'):
+        m = re.match(r'^import time:\s+\d+\s+\|\s+(\d+)\s+\|\s*(\S+)$', line)
+        if m is not None:
+            yield m.group(2), int(m.group(1)) / 1e6
+
+def import_time(module, python=sys.executable, skip=set()):
+    '''
+    Import a module in a new interpreter
+    Return the total import time (s) and the cumulative time (s) of each top level package,
+    packages in skip (e.g. loaded at interpreter startup) are not reported
+    '''
+    res = subprocess.run([python, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True)
+    if res.returncode != 0:
+        return None, res.stderr.strip().split('\n')[-1]
+    total = 0
+    pkg = defaultdict(float)
+    for name, t in _parse_importtime(res.stderr):
+        if name == module:
+            total = t
+        top = name.split('.')[0]
+        if top != "ficture" and top not in skip:
+            pkg[top] = max(pkg[top], t)
+    return total, dict(pkg)
+
+def benchmark_import():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--command', type=str, nargs='*', default=[], help='Commands to test (default: all commands in the ficture CLI)')
+    parser.add_argument('--repeat', type=int, default=3, help='Report the minimum over repeated runs')
+    parser.add_argument('--top', type=int, default=3, help='Number of slowest packages to show per command')
+    parser.add_argument('--max_seconds', type=float, default=-1, help='Exit with an error if any command takes longer to import')
+    parser.add_argument('--forbid', type=str, nargs='*', default=[], help='Exit with an error if any of these packages is imported by a command, e.g. torch ete3 PyQt5')
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from ficture.cli import module_map
+    command = args.command if len(args.command) > 0 else list(module_map.keys())
+    for x in command:
+        if x not in module_map:
+            sys.exit(f"ERROR: unknown command {x}")
+
+    res = subprocess.run([sys.executable, "-X", "importtime", "-c", "pass"], capture_output=True, text=True)
+    startup = set(x.split('.')[0] for x, _ in _parse_importtime(res.stderr))
+    base, _ = import_time("ficture.cli")
+    print(f"ficture.cli\t{base:.3f}")
+    fail = []
+    for x in command:
+        module = "ficture.scripts." + module_map[x]
+        run = [import_time(module, skip=startup) for _ in range(args.repeat)]
+        if run[0][0] is None:
+            print(f"{x}\tNA\t{run[0][1]}")
+            continue
+        total = min(v[0] for v in run)
+        pkg = run[0][1]
+        slow = sorted(pkg.items(), key=lambda v: -v[1])[:args.top]
+        print(f"{x}\t{total:.3f}\t" + ", ".join(f"{k} {v:.3f}" for k, v in slow))
+        if args.max_seconds > 0 and total > args.max_seconds:
+            fail.append(f"{x} takes {total:.3f}s to import")
+        for k in args.forbid:
+            if k in pkg:
+                fail.append(f"{x} imports {k}")
+    if len(fail) > 0:
+        sys.exit("ERROR: " + "; ".join(fail))
+
+if __name__ == "__main__":
+    benchmark_import()
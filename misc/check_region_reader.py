@@ -0,0 +1,89 @@
+### Check that RegionReader (bgzf_fn) returns the same lines as a plain scan
+### Without --input, test small hand made BGZF files with the header alone in
+### the first block, lanes starting and ending inside one block, and tiny blocks
+
+import sys, os, gzip, zlib, struct, shutil, tempfile, argparse
+import numpy as np
+
+def _bgzf_block(data):
+    comp = zlib.compressobj(6, zlib.DEFLATED, -15)
+    cdata = comp.compress(data) + comp.flush()
+    bsize = len(cdata) + 25
+    head = b'\x1f\x8b\x08\x04' + b'\x00' * 4 + b'\x00\xff' + struct.pack('<H', 6) + b'BC' + struct.pack('<HH', 2, bsize)
+    return head + cdata + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+
+def write_bgzf(file, text, block_size):
+    '''
+    Write text as BGZF blocks of block_size uncompressed bytes, lines are split across blocks
+    '''
+    data = text.encode()
+    with open(file, 'wb') as wf:
+        for i in range(0, len(data), block_size):
+            wf.write(_bgzf_block(data[i:i+block_size]))
+        wf.write(_bgzf_block(b''))
+
+def plain_scan(file, regions, pos_col, seq_col=0):
+    out = []
+    for seq, st, ed in regions:
+        with gzip.open(file, 'rt') as rf:
+            _ = rf.readline()
+            for line in rf:
+                wd = line.split('\t')
+                if wd[seq_col] == str(seq) and st <= float(wd[pos_col]) <= ed:
+                    out.append(line)
+    return out
+
+def synthetic(tmp_dir):
+    '''
+    Lanes 1 (large, starts in the header block), 2 (5 lines inside one block) and 3,
+    sorted by (lane, pos), written with several block sizes
+    '''
+    rng = np.random.default_rng(0)
+    lines = ["lane\tX\tY\tgene\tCount\n"]
+    for lane, n in [("1", 3000), ("2", 5), ("3", 2000)]:
+        pos = np.sort(rng.integers(0, 20000, n)) if lane != "2" else np.arange(100, 105)
+        lines += [f"{lane}\t{p}\t{rng.integers(0, 1000)}\tg{rng.integers(0, 50)}\t1\n" for p in pos]
+    text = ''.join(lines)
+    regions = [[("1", 0, 10)], [("1", 500, 3000)], [("1", 0, 1e9)], [("2", 0, 1e9)], [("2", 102, 103)],\
+               [("3", 19000, 1e9)], [("1", 19990, 1e9), ("2", 0, 1e9), ("3", 0, 50)], [("4", 0, 1e9)]]
+    for bs in [3000, 997, 65280]:
+        file = os.path.join(tmp_dir, f"synthetic.{bs}.tsv.gz")
+        write_bgzf(file, text, bs)
+        yield file, regions
+
+def check_region_reader():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, default='', help='A sorted, bgzip compressed file to test instead of the synthetic files')
+    parser.add_argument('--regions', type=str, nargs='*', default=[], help='Regions to test as seq:start-end')
+    parser.add_argument('--pos_col', type=int, default=1, help='')
+    parser.add_argument('--seq_col', type=int, default=0, help='')
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from ficture.utils.bgzf_fn import RegionReader
+
+    tmp_dir = tempfile.mkdtemp()
+    if args.input != '':
+        regions = []
+        for x in args.regions:
+            seq, rg = x.rsplit(':', 1)
+            st, ed = rg.split('-')
+            regions.append((seq, float(st), float(ed)))
+        cases = [(args.input, [regions])]
+    else:
+        cases = synthetic(tmp_dir)
+    fail = 0
+    for file, region_list in cases:
+        for regions in region_list:
+            ref = plain_scan(file, regions, args.pos_col, args.seq_col)
+            res = list(RegionReader(file, regions, args.pos_col, args.seq_col))
+            ok = res == ref
+            fail += not ok
+            print(f"{os.path.basename(file)}\t{regions}\t{len(res)}/{len(ref)}\t{'OK' if ok else 'FAIL'}")
+    shutil.rmtree(tmp_dir)
+    if fail > 0:
+        sys.exit(f"ERROR: {fail} region sets differ from a plain scan")
+
+if __name__ == "__main__":
+    check_region_reader()